@@ -7,48 +7,372 @@
 # The Base User class defines a basic implementation of a node in the chat system
 # It serves as the abstraction template for basic functionality
 
-import select
-import sys
+import abc
 import socket
 import json
 import hashlib
 import time
 import collections
 
+import Codec
+import FailureDetector
+import Fingers
+import Fragments
+import History
+import Locations
+import Metrics
+import Pending
+import RoundTrip
+import Transport
 
-LOGIN_SERVER = ('student10.cse.nd.edu', 9999)
-BYTES = 1024
 
+BYTES = 65535        # receive buffer, large enough for any datagram
+TIMEOUT = .5         # retransmission timeout until a lap has been measured
+WINDOW = 32          # globals a node may have in flight at once
+JOIN_RETRIES = 5     # pointer updates sent before a join is abandoned
+JOIN_WINDOW = .005   # how long a join waits for others to be spliced with
+JOIN_BATCH = 64      # users spliced into the ring at once
+GAP_TIMEOUT = 1.0    # how long a missing order number holds back delivery
+ACK_FLUSH = .005     # how long acknowledgements wait for a frame to ride on
+MTU = 1024           # largest datagram sent to a neighbor
+BATCH_FLUSH = .0005  # how long a frame waits for others to share a datagram
+HEARTBEAT = .5       # time between heartbeats to each neighbor
+LOOKUP_TIMEOUT = .25 # how long direct messages wait for a user's address
+LOOKUP_RETRY = 5.0   # how long an address that was not answered goes unasked
+SUCCESSORS = 3       # nodes after this one it keeps track of; the ring
+                     # repairs itself after up to SUCCESSORS - 1 crashes
 
-class Base_User:
 
-    def __init__(self):
-        '''Constructor for User objects'''
+def node_id_of(ip, port):
+    '''Return the node id of the node at (ip, port), as its message ids carry it'''
+
+    return int.from_bytes(socket.inet_aton(ip), 'big') << 16 | port
+
+
+def address_of(node_id):
+    '''Return the (ip, port) a node id was made from'''
+
+    return (socket.inet_ntoa((node_id >> 16).to_bytes(4, 'big')), node_id & 0xFFFF)
+
+
+class Base_User(abc.ABC):
+
+    def __init__(self, transport=None):
+        ''' Constructor for User objects
+
+            - transport provides the address, socket and clock; real UDP
+              sockets by default
+        '''
+
+        self.transport = Transport.UDP() if transport is None else transport
+        self.clock = self.transport.time
+        self.login_server = self.transport.login_server
 
         self.username = None
         self.neighbors = {}
-        self.pending_table = collections.OrderedDict() # pending
-        self.history_table = set()
-        self.message_count = time.time()
-
-        self.ip = socket.gethostbyname(socket.gethostname())
-       
-        # socket to listen for and send messages
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		# find a port to bind to, which is in the range from 9000-9999
-        for port_num in range(9000, 10000):
+        self.former_prev = None     # accepted as prev during a splice
+        self.successors = []        # next_1, next_2, ... up to SUCCESSORS
+        # [key, ip, port] of nodes placed by username hash, handed out by
+        # the LoginServer; direct messages hop along them
+        self.fingers = []
+        # addresses of users this node sends direct messages to, and the
+        # lookups in flight: username -> [deadline, direct messages waiting],
+        # or [time to ask again, None] after the LoginServer did not answer
+        self.locations = Locations.Locations()
+        self.lookups = {}
+
+        # globals go around the ring, or with 'tree' straight to the
+        # SuperUser, which fans them out along the finger tables
+        self.spread = 'ring'
+        self.leader = None
+        # connect requests waiting to be spliced into the ring after this
+        # node, and the join in progress
+        self.joins = collections.deque()
+        self.join = None
+        self.join_after = None      # when the queued users are spliced in
+        self.join_count = 0
+        self.spliced = 0            # users spliced in by this node
+        self.pending_table = Pending.PendingTable() # pending
+        self.history_table = History.History() # displayed
+        # frame format used for outgoing requests; negotiated at login
+        self.wire = 'binary'
+
+        # the SuperUser stamps every global with an order number and each
+        # node displays globals in that order, so many can be in flight
+        self.window = WINDOW
+        self.in_flight = set()              # own globals not yet acknowledged
+        self.outbox = collections.deque()   # globals waiting for the window
+        self.next_order = None
+        self.reorder = {}                   # order number -> message id
+        self.gap_since = None
+
+        # acknowledgements of own globals ride on the next global this node
+        # sends, each on one only, or are flushed after ACK_FLUSH
+        self.unconfirmed = collections.OrderedDict() # sequence -> order
+        self.carried = set()                # sequences a global has carried
+        self.ack_deadline = None
+
+        # frames headed to the same neighbor share datagrams
+        self.batches = {}                   # address -> [size, frames]
+        self.batch_deadline = None
+
+        # messages too large for one datagram travel as fragments
+        self.fragments = Fragments.Reassembler()
+
+        # neighbors exchange heartbeats; one that goes quiet for too long
+        # is reported to the LoginServer
+        self.detector = FailureDetector.PhiAccrual(HEARTBEAT)
+        self.heartbeat_sent = 0
+        self.heartbeat_deadline = self.clock()
+
+        self.ip = self.transport.local_ip()
+
+        # socket to listen for and send messages, bound to the configured
+        # port or one the OS picks
+        self.sock = self.transport.bind(self.ip)
+        _, self.port = self.sock.getsockname()
+
+        # message ids are (node_id, sequence) pairs assigned by the sender;
+        # the node id packs the address and the sequence starts from the
+        # clock so a restarted node never reuses an id
+        self.node_id = node_id_of(self.ip, self.port)
+        self.sequence = int(self.clock() * 1000000)
+
+        # retransmission timeouts follow the laps of this node's globals
+        self.round_trip = RoundTrip.RoundTrip(TIMEOUT, seed=self.node_id)
+
+        # counters and histograms, answered to 'stats' requests
+        self.metrics = Metrics.Metrics(f'{self.ip}:{self.port}')
+        self.metrics.gauge('pending', lambda: len(self.pending_table))
+        self.metrics.gauge('history', lambda: self.history_table.entries())
+        self.metrics.gauge('history_senders', lambda: len(self.history_table))
+        self.metrics.gauge('history_bytes', lambda: self.history_table.memory_usage())
+        self.metrics.gauge('history_stale', lambda: self.history_table.stale)
+        self.metrics.gauge('in_flight', lambda: len(self.in_flight))
+        self.metrics.gauge('outbox', lambda: len(self.outbox))
+        self.metrics.gauge('queued_joins', lambda: len(self.joins))
+        self.metrics.gauge('lookups', lambda: sum(1 for _, waiting in
+                self.lookups.values() if waiting is not None))
+        self.metrics.gauge('suspicions',
+                lambda: self.detector.stats()['suspicions'])
+        self.metrics.gauge('false_suspicions',
+                lambda: self.detector.stats()['false_positives'])
+        self.metrics.gauge('detection_avg_seconds',
+                lambda: self.detector.stats()['detection_avg'])
+        self.metrics.gauge('detection_max_seconds',
+                lambda: self.detector.stats()['detection_max'])
+        self.metrics.gauge('rto_seconds', lambda: self.round_trip.rto)
+
+
+    def hash_data(self, data):
+        return int(hashlib.md5(data.encode('ascii')).hexdigest(), 16)
+
+
+    def stamp_message_id(self, request):
+        ''' Assign the id of a new message sent by this node
+
+            - the id is carried in the request and returned
+            - a ring held to JSON may contain peers that predate message
+              ids, so the request is stamped the way they expect instead
+        '''
+
+        if self.wire == 'json':
+            request["message_count"] = self.clock()
+            return self.hash_data(json.dumps(request))
+
+        self.sequence += 1
+        request["message_id"] = (self.node_id, self.sequence)
+        return request["message_id"]
+
+
+    def message_key(self, request):
+        ''' Return the id a global or direct request is tracked under
+
+            - requests from peers that predate sender-assigned ids
+              are identified by a hash of the request instead
+        '''
+
+        try:
+            return request['message_id']
+        except KeyError:
+            return self.hash_data(json.dumps(request))
+
+
+    def send(self, request, address, batch=False):
+        ''' Encode a request in the negotiated wire format and send it
+
+            - batch lets the frame share a datagram with others to the
+              same address
+        '''
+
+        data = Codec.encode(request, self.wire)
+        self.metrics.count('sent', request.get('purpose'))
+        if len(data) > MTU and self.wire != 'json' and request.get(
+                'purpose') in ('global', 'direct'):
+            frames = Codec.fragment(request, data, MTU)
+        else:
+            frames = [data]
+
+        for frame in frames:
+            if batch:
+                self.transmit(frame, address)
+            else:
+                self.sock.sendto(frame, tuple(address))
+                self.metrics.datagram('out', len(frame))
+
+
+    def transmit(self, data, address):
+        ''' Send an encoded frame to a neighbor, batched with others
+
+            - frames for the same address share a datagram of up to MTU bytes
+            - a batch is sent once full, or after BATCH_FLUSH
+        '''
+
+        address = tuple(address)
+        if self.wire == 'json':
+            # peers that only speak JSON cannot unpack batches
+            self.sock.sendto(data, address)
+            self.metrics.datagram('out', len(data))
+            return
+
+        size = len(data) + Codec.BATCH_ITEM.size
+        batch = self.batches.get(address)
+        if batch and batch[0] + size > MTU:
+            self.send_batch(address)
+            batch = None
+
+        if batch is None:
+            batch = self.batches[address] = [Codec.BATCH.size, []]
+        batch[0] += size
+        batch[1].append(data)
+
+        if self.batch_deadline is None:
+            self.batch_deadline = self.clock() + BATCH_FLUSH
+
+
+    def send_batch(self, address):
+        '''Send the frames waiting for an address'''
+
+        size, frames = self.batches.pop(address)
+        if len(frames) == 1:
+            self.sock.sendto(frames[0], address)
+        else:
+            self.sock.sendto(Codec.encode_batch(frames), address)
+        self.metrics.datagram('out', size)
+
+
+    def flush(self, address):
+        '''Send the frames waiting for an address right away'''
+
+        address = tuple(address)
+        if address in self.batches:
+            self.send_batch(address)
+        if not self.batches:
+            self.batch_deadline = None
+
+
+    def flush_batches(self):
+        '''Send every waiting batch'''
+
+        for address in list(self.batches):
+            self.send_batch(address)
+        self.batch_deadline = None
+
+
+    def recv(self):
+        ''' Receive the next datagram on the socket and decode its frames
+
+            Return Values:
+            ([(request, raw frame), ...], sender address); frames that
+            could not be decoded are dropped
+        '''
+
+        data, addr = self.sock.recvfrom(BYTES)
+        return (self.decode_datagram(data), addr)
+
+
+    def decode_datagram(self, data):
+        ''' Split a datagram into its frames and decode them
+
+            Return Values:
+            [(request, raw frame), ...]; frames that could not be
+            decoded are dropped
+        '''
+
+        try:
+            frames = Codec.split(data)
+        except ValueError:
+            # garbage request
+            return []
+
+        requests = []
+        for frame in frames:
             try:
-                sock.bind((self.ip,port_num))
-                break
-            except OSError:
+                request, _ = Codec.decode(frame)
+            except ValueError:
+                # garbage request
                 continue
+            requests.append((request, frame))
 
-        _, self.port = sock.getsockname()
-        self.sock = sock
+        return requests
 
 
-    def hash_data(self, data):
-        return int(hashlib.md5(data.encode('ascii')).hexdigest(), 16)
+    def receive_message(self):
+        '''Receive the next datagram on the socket and process its requests'''
+
+        data, addr = self.sock.recvfrom(BYTES)
+        self.receive_datagram(data, addr)
+
+
+    def poll(self):
+        ''' Wait for a datagram until the next timeout is due, handle it,
+            and check timeouts
+
+            - for scripts that drive a node themselves, one step at a time
+        '''
+
+        if self.transport.wait(self.sock, self.next_timeout()):
+            self.receive_message()
+        self.check_timeouts()
+
+
+    def receive_datagram(self, data, addr):
+        '''Process every request carried by a datagram'''
+
+        # any frame from a neighbor shows it is alive
+        self.detector.heard(addr, self.clock())
+        self.metrics.datagram('in', len(data))
+
+        for request, frame in self.decode_datagram(data):
+            purpose = request.get('purpose')
+            if not self.metrics.request(purpose):
+                self.process_request(request, frame, addr)
+                continue
+
+            start = time.perf_counter()
+            self.process_request(request, frame, addr)
+            self.metrics.observe('handler_seconds', purpose,
+                    time.perf_counter() - start)
+
+
+    def send_stats(self, address):
+        '''Answer a stats request with this node's metrics'''
+
+        self.sock.sendto(Metrics.stats_reply(self.metrics), tuple(address))
+
+
+    @abc.abstractmethod
+    def process_request(self, request, data, addr):
+        ''' Process a single decoded request according to its purpose
+
+            - the User and the SuperUser each handle their own purposes
+        '''
+
+
+    def handle_input(self, line):
+        '''Handle a line typed by the user'''
+
+        self.send_message(line)
 
 
     def print_user(self):
@@ -59,18 +383,19 @@ class Base_User:
         print(f'Port:      {self.port}\n')
 
 
-    def send_message(self, message):
+    def send_message(self, message, flush=True):
         ''' Send a global message to all nodes in ring
             
             - takes in a string input message
             - adds message to pending table and forwards to neighbor
+            - flush sends it right away instead of waiting for other
+              frames to share its datagram; globals released from the
+              outbox wait, since they are sent while handling a request
         '''
 
         if not self.neighbors:
             print("No other users in the chat room")
             return
-        
-        self.message_count = time.time()
 
         if message.strip() == "direct":
             user = input('@')
@@ -78,31 +403,110 @@ class Base_User:
             self.direct_message(user, content)
             return
 
+        if len(self.in_flight) >= self.window:
+            # send once an earlier global has made it around the ring
+            self.outbox.append(message)
+            return
+
         json_req = {
             "username"      : self.username,
             "purpose"       : "global",
             "message"       : message,
             "ip"            : self.ip,
-            "port"          : self.port,
-            "message_count" : self.message_count
+            "port"          : self.port
         }
+        message_id = self.stamp_message_id(json_req)
+        now = self.clock()
+
+        if self.spread_tree():
+            json_req["spread"] = "tree"
+            # copies also carry the part of the circle they cover
+            copy = dict(json_req, order=0, limit=Fingers.SPACE)
+            if len(Codec.encode(copy, self.wire)) <= MTU:
+                # the SuperUser stamps it and fans it out; it is done once
+                # this node's own copy comes back
+                self.in_flight.add(message_id)
+                self.pending_table.add(message_id, 'dirty', json_req,
+                        self.username, now, now + self.round_trip.timeout())
+                self.send(json_req, self.leader, batch=True)
+                if flush:
+                    self.flush(self.leader)
+                return
+            # fragments are relayed from neighbor to neighbor
+            del json_req["spread"]
+
+        self.sequence_global(json_req)
+        self.in_flight.add(message_id)
 
-        req = json.dumps(json_req)
-        encoded_req = req.encode('utf-8')
+        acks = self.ack_list(fresh=True)
+        if acks:
+            # acknowledgements no global has carried yet ride along, and
+            # with this message's retransmissions; flush them separately
+            # only if it does not make it around the ring
+            json_req["acks"] = acks
+            self.carried.update(sequence for sequence, _ in acks)
+            self.ack_deadline = now + self.round_trip.timeout()
 
         # add transaction to pending; mark as dirty (not yet displayed)
-        self.pending_table[self.hash_data(req)] = [
-                'dirty', json_req, self.username, time.time(), False]
+        self.pending_table.add(message_id, 'dirty', json_req, self.username,
+                now, now + self.round_trip.timeout())
 
         # forward message to neighbor
-        self.sock.sendto(encoded_req, tuple(self.neighbors['next_1']))
+        self.send(json_req, self.neighbors['next_1'], batch=True)
+        if flush:
+            self.flush(self.neighbors['next_1'])
+
+
+    def spread_tree(self):
+        ''' Determine if globals are fanned out by the SuperUser
+
+            - a node that has no finger table yet, or a ring held to JSON,
+              sends them around the ring; both kinds share one order
+        '''
+
+        return (self.spread == 'tree' and self.wire != 'json' and
+                bool(self.fingers) and self.leader is not None)
+
+
+    def handle_spread(self, request):
+        ''' Handle a copy of a global fanned out from the SuperUser
+
+            - the copy is passed on to the fingers that cover the rest of
+              the part of the circle it was sent for
+            - a copy of this node's own global completes it
+        '''
+
+        message_id = self.message_key(request)
+        if message_id in self.history_table:
+            return
+
+        limit = request.get("limit")
+        if limit is not None and self.fingers:
+            for finger, part in Fingers.broadcast(Fingers.key(self.username),
+                    self.fingers, limit):
+                request["limit"] = part
+                self.send(request, finger[1:], batch=True)
+            request["limit"] = limit
+
+        if message_id[0] == self.node_id:
+            if message_id in self.in_flight and message_id in self.pending_table:
+                self.measure_lap(self.pending_table[message_id])
+            self.in_flight.discard(message_id)
+            self.release_outbox()
+        if message_id not in self.pending_table or message_id[0] == self.node_id:
+            self.pending_table.add(message_id, 'dirty', request,
+                    request['username'], self.clock())
+
+        self.deliver(message_id, request['order'])
 
 
     def direct_message(self, username, message):
         ''' Send a direct message to a target user
             
             - takes in a string username and a string message
-            - adds message to pending table and forwards to neighbor
+            - adds message to pending table and forwards to the next hop
+            - while the target's address is being looked up, the message
+              waits for it
         '''
 
         json_req = {
@@ -111,37 +515,186 @@ class Base_User:
             "message"      : message,
             "ip"           : self.ip,
             "port"         : self.port,
-            "target"       : username,
-            "message_count": self.message_count
+            "target"       : username
         }
-        
-        req = json.dumps(json_req)
-        encoded = req.encode('utf-8');
+        self.stamp_message_id(json_req)
 
-        # add transaction to pending
-        self.pending_table[self.hash_data(req)] = [
-                'dirty', json_req, self.username, time.time(), False]
+        # straight to the target if its address is known
+        hop = self.locate(username, self.clock())
+        if hop is None and self.lookups.get(username, (None, None))[1] is not None:
+            self.lookups[username][1].append(json_req)
+            return
+
+        self.route_direct(json_req, hop)
+
+
+    def route_direct(self, json_req, hop=None):
+        ''' Send a new direct message to hop, the target's address, or else
+            along the finger table or around the ring
+        '''
+
+        if not self.neighbors:
+            print("No other users in the chat room")
+            return
+
+        username = json_req["target"]
+        message_id = self.message_key(json_req)
+        now = self.clock()
+
+        if hop is None:
+            hop = self.direct_hop(username)
+        if hop is None:
+            print(f'{username} does not exist')
+            return
+        if hop != self.neighbors['next_1']:
+            # the message skips ahead, so its receivers must not expect
+            # it from their previous neighbor
+            json_req["routed"] = True
+            if len(Codec.encode(json_req, self.wire)) > MTU:
+                # fragments are relayed from neighbor to neighbor
+                del json_req["routed"]
+                hop = self.neighbors['next_1']
+
+        # add transaction to pending; a retransmission walks the ring
+        self.pending_table.add(message_id, 'dirty', json_req, self.username,
+                now, now + self.round_trip.timeout())
+
+        # forward message to the next hop, right away
+        self.send(json_req, hop, batch=True)
+        self.flush(hop)
+
+
+    def locate(self, username, now):
+        ''' Return the cached address of a user, or None
+
+            - on a miss the LoginServer is asked for the address, once
+              however many messages are sent before it answers; a user
+              it did not answer for is not asked for again for LOOKUP_RETRY
+            - rings held to JSON never skip ahead, so nothing is cached
+        '''
+
+        if self.wire == 'json':
+            return None
+
+        address = self.locations.get(username, now)
+        if address is not None or username in self.lookups:
+            return address
+
+        self.lookups[username] = [now + LOOKUP_TIMEOUT, []]
+        self.send({
+            "username": self.username,
+            "purpose" : "locate",
+            "target"  : username
+        }, self.login_server)
+
+        return None
+
+
+    def handle_location(self, request):
+        ''' Cache the address of a user looked up from the LoginServer
+
+            - a missing address means the user left or crashed
+            - direct messages waiting for the lookup are sent on
+        '''
+
+        target = request["target"]
+        if request.get("address"):
+            self.locations.put(target, request["address"], self.clock())
+        else:
+            self.locations.discard(target)
+
+        _, waiting = self.lookups.pop(target, (None, None))
+        for json_req in waiting or ():
+            self.route_direct(json_req, request.get("address"))
+
+
+    def expire_lookups(self, now):
+        ''' Route the direct messages of lookups the LoginServer did not
+            answer in time
+
+            - the user is not looked up again for LOOKUP_RETRY, so later
+              messages to it are routed at once
+        '''
+
+        for username, (deadline, waiting) in list(self.lookups.items()):
+            if deadline > now:
+                continue
+            if waiting is None:
+                # the user may be looked up again
+                del self.lookups[username]
+                continue
+            self.lookups[username] = [now + LOOKUP_RETRY, None]
+            for json_req in waiting:
+                self.route_direct(json_req)
 
-        # forward message to neighbor
-        self.sock.sendto(encoded, tuple(self.neighbors['next_1']))
+
+    def direct_hop(self, target):
+        ''' Return the address a direct message for target is passed to
+
+            - with a finger table the message jumps to the known node
+              closest before target; otherwise it walks the ring
+            - rings held to JSON walk the ring, since older peers expect
+              every message from their previous neighbor
+
+            Return Values:
+            address, or None if the finger table shows target is not in the ring
+        '''
+
+        if not self.fingers or self.wire == 'json':
+            return self.neighbors['next_1']
+
+        place = Fingers.key(target)
+        finger, final = Fingers.closest(Fingers.key(self.username),
+                self.fingers, place)
+        if final and finger[0] != place:
+            return None
+
+        return finger[1:]
+
+
+    def handle_fingers(self, request):
+        '''Take a new finger table from the LoginServer'''
+
+        self.fingers = request["fingers"]
+
+
+    def from_prev(self, sender):
+        ''' Determine if a request was sent by the previous neighbor
+
+            - while a new user is spliced in before this node, requests from
+              the former previous neighbor are accepted until the new user
+              sends its first one
+        '''
+
+        sender = list(sender)
+        if sender == self.neighbors.get("prev"):
+            self.former_prev = None
+            return True
+
+        return self.former_prev is not None and sender == self.former_prev
 
 
     def update_pointers(self, purpose, message, leader):
         '''Update pointers to accomodate new nodes'''
 
         if (purpose == "update_pointers"):
-            if "prev" in message:
+            if "prev" in message and message["prev"] != self.neighbors.get("prev"):
+                # the leader forwards to this node until the new users
+                # have been spliced in
+                self.former_prev = self.neighbors.get("prev")
                 self.neighbors["prev"] = message["prev"]
-            if self.neighbors["next_2"] == None:
-                # next next pointer is the new node
-                self.neighbors["next_2"] = message["prev"]
+            if self.neighbors.get("next_2") == None:
+                # next next pointer is the first new node
+                self.neighbors["next_2"] = message.get("first", message["prev"])
                 # next pointer is the leader
                 self.neighbors["next_1"] = leader
     
             res = {
                 "status"   : "success",
                 "curr_next": self.neighbors["next_1"],
-                "purpose"  : "update_pointers"
+                "purpose"  : "update_pointers_res",
+                "join_id"  : message.get("join_id"),
+                "order"    : self.order_frontier()
             }
 
         # purpose = "update_last_node"
@@ -149,36 +702,282 @@ class Base_User:
             self.neighbors["next_2"] = message["next_2"]
             res = {
                 "status": "success",
-                "purpose": "update_pointers"
+                "purpose": "update_pointers_res",
+                "join_id": message.get("join_id")
             }
         
-        res = json.dumps(res).encode('utf-8')
-        self.sock.sendto(res, leader)
+        self.sync_successors()
+        self.send(res, leader)
+
+
+    def add_users(self, req):
+        ''' Queue a connect request from a new user
+
+            - the SuperUser, and any user started as a leader, splices new
+              users into the ring right after itself
+            - users that ask within JOIN_WINDOW of each other, or while a
+              splice is in progress, are linked into a chain and spliced in
+              together, in the order they asked; the ring keeps forwarding
+              messages meanwhile
+            - a repeated request from a queued user is ignored
+        '''
+
+        location = [req["ip"], req["port"]]
+        if self.join is not None and location in self.join["locations"]:
+            return
+        if any([queued["ip"], queued["port"]] == location for queued in self.joins):
+            return
+
+        self.joins.append(req)
+        if self.join is None and self.join_after is None:
+            self.join_after = self.clock() + JOIN_WINDOW
+
+
+    def start_join(self):
+        ''' Begin splicing the queued users into the ring, as one chain
+
+            - the chain costs the same two pointer updates as a single user:
+              the next neighbor points back at its last user, and the
+              previous neighbor's next_2 at its first
+        '''
+
+        self.join_after = None
+        if not self.joins:
+            return
+
+        batch = [self.joins.popleft() for _ in range(min(JOIN_BATCH, len(self.joins)))]
+        self.join_count += 1
+        self.join = {
+            "id"       : self.join_count,
+            "requests" : batch,
+            "locations": [[req["ip"], req["port"]] for req in batch],
+            "curr_next": None
+        }
+
+        # if other users, ask the next user for its next neighbor
+        if "next_1" in self.neighbors:
+            self.join_step("update_pointers", {
+                "prev" : self.join["locations"][-1],
+                "first": self.join["locations"][0]
+            }, self.neighbors["next_1"])
+        else:
+            self.finish_join()
+
+
+    def join_step(self, purpose, fields, address):
+        '''Send one pointer update of the join in progress'''
+
+        update = {"purpose": purpose}
+        update.update(fields)
+        update["join_id"] = self.join["id"]
+
+        self.join["update"] = update
+        self.join["target"] = address
+        self.join["attempts"] = 0
+        self.retry_join()
+
+
+    def retry_join(self):
+        ''' (Re)send the pending pointer update of the join in progress
+
+            - after JOIN_RETRIES attempts the join is abandoned and the
+              new users told to log in again
+        '''
+
+        join = self.join
+        if join["attempts"] >= JOIN_RETRIES:
+            for req, location in zip(join["requests"], join["locations"]):
+                print(f'{self.username}: Unable to add user {req["username"]}')
+                self.send({
+                    "status"  : "failure",
+                    "purpose" : "connect_res",
+                    "join_id" : join["id"]
+                }, location)
+            self.metrics.count('join_failures', amount=len(join["requests"]))
+            self.join = None
+            self.start_join()
+            return
+
+        if join["attempts"]:
+            self.metrics.count('retransmits', join["update"]["purpose"])
+        join["attempts"] += 1
+        join["deadline"] = self.clock() + TIMEOUT
+        self.send(join["update"], join["target"])
+
+
+    def handle_join_response(self, request, addr):
+        ''' Advance the join in progress on a reply to its pointer update
+
+            - replies are matched by join id and by the address the update
+              was sent to; stale or unrelated replies are dropped
+        '''
+
+        join = self.join
+        if (join is None or request.get("status") != "success" or
+                request.get("join_id", join["id"]) != join["id"] or
+                tuple(addr) != tuple(join["target"])):
+            return
+
+        if join["update"]["purpose"] == "update_pointers":
+            join["curr_next"] = request["curr_next"]
+            join["order"] = request.get("order")
+            # inform last node in ring that it must update next_2
+            self.join_step("update_last_node",
+                    {"next_2": join["locations"][0]}, self.neighbors["prev"])
+        else:
+            self.finish_join()
+
+
+    def finish_join(self):
+        ''' Point this node at the new users and send each its neighbors
+
+            - every new user gets its previous and next neighbors in one
+              reply, along with the SuperUser's address, which globals
+              fanned out along the finger tables go through
+        '''
+
+        join = self.join
+        chain = join["locations"]
+        me = [self.ip, self.port]
+
+        if "next_1" in self.neighbors:
+            following = [self.neighbors["next_1"], join["curr_next"]]
+        else:
+            # the chain closes the ring on this node alone
+            following = [me, chain[0] if len(chain) > 1 else None]
+        ring = [me] + chain + following
+
+        # update next pointers
+        if "next_1" in self.neighbors or len(chain) > 1:
+            self.neighbors["next_2"] = ring[2]
+        self.neighbors["next_1"] = chain[0]
+        if "prev" not in self.neighbors:
+            self.neighbors["prev"] = chain[-1]
+        self.sync_successors()
+
+        order = self.join_order()
+        for i, req in enumerate(join["requests"], 1):
+            json_res = {
+                "status"  : "success",
+                "purpose" : "connect_res",
+                "join_id" : join["id"],
+                "prev"    : ring[i - 1],
+                "next_1"  : ring[i + 1],
+                "next_2"  : ring[i + 2],
+                "order"   : order,
+                "spread"  : self.spread,
+                "leader"  : self.leader
+            }
+
+            print(f'Added User {req["username"]}')
+            self.send(json_res, ring[i])
+        self.spliced += len(chain)
+        self.metrics.count('joins', amount=len(chain))
+
+        self.join = None
+        self.start_join()
+
+
+    def join_order(self):
+        ''' First order number a user spliced in after this node sees
+
+            - the next neighbor passes the new user every order number
+              from the end of what it has received on
+        '''
+
+        return self.join.get("order")
+
+
+    def order_frontier(self):
+        '''Order number after every one this node has received, or None'''
+
+        if self.next_order is None:
+            return None
+
+        return max([self.next_order] + [order + 1 for order in self.reorder])
+
+
+    def sync_successors(self):
+        ''' Rebuild the successor list after next_1 or next_2 changed
+
+            - entries past next_2 are kept when next_2 was already on the
+              list; the rest arrive with next_1's next heartbeat
+        '''
+
+        first = [list(self.neighbors[key]) for key in ('next_1', 'next_2')
+                if self.neighbors.get(key)]
+
+        tail = []
+        if len(first) == 2 and first[1] in self.successors:
+            tail = self.successors[self.successors.index(first[1]) + 1:]
+
+        self.set_successors((first + tail)[:SUCCESSORS])
+
+
+    def set_successors(self, successors):
+        ''' Replace the successor list
+
+            - a changed list is passed straight on to the previous node,
+              whose list is this node followed by this list
+        '''
+
+        if successors == self.successors:
+            return
+
+        self.successors = successors
+        if self.neighbors.get('prev') and self.wire != 'json':
+            self.send({
+                "purpose"   : "heartbeat",
+                "successors": successors[:SUCCESSORS - 1]
+            }, self.neighbors['prev'], batch=True)
+
+
+    def handle_heartbeat(self, request, sender):
+        ''' Take the successor list carried by a heartbeat from next_1
+
+            - the list stops short of this node, so in a ring with fewer
+              than SUCCESSORS other nodes it holds all of them
+        '''
+
+        if 'successors' not in request or list(sender) != self.neighbors.get('next_1'):
+            return
+
+        me = [self.ip, self.port]
+        successors = [list(sender)]
+        for node in request['successors']:
+            if list(node) == me or len(successors) >= SUCCESSORS:
+                break
+            successors.append(list(node))
+
+        self.neighbors['next_2'] = successors[1] if len(successors) > 1 else None
+        self.set_successors(successors)
   
 
-    def handle_direct(self, message, sender):
+    def handle_direct(self, message, sender, data=None):
         ''' Handle the receival of a direct message
         
             - if target username matches self, display message and send back response
-            - else forward message around the ring
+            - else forward message along the finger table, or around the ring
+            - data is the frame as received, forwarded without re-encoding
         '''
 
-        decoded_data = json.dumps(message)
+        message_id = self.message_key(message)
 
         # check if message made it to sender without finding target
         if (self.username == message["username"]):
             print(f'{message["target"]} does not exist')
             # remove transaction from pending
             try:
-                self.pending_table.pop(self.hash_data(decoded_data))
+                self.pending_table.pop(message_id)
             except KeyError:
                 # value has already been popped from the table, just move on
                 pass
             return
 
         # check if sender does not match previous neighbor
-        # ie previous node does not know it has been kicked out
-        elif (self.neighbors["prev"] != list(sender)):
+        # ie previous node does not know it has been kicked out; messages
+        # routed by finger tables come from anywhere
+        elif not message.get("routed") and not self.from_prev(sender):
             json_res = {
                 "username"  : self.username,
                 "ip"        : self.ip,
@@ -186,9 +985,7 @@ class Base_User:
                 "purpose"   : "kicked_out"
             } 
            
-            res = json.dumps(json_res)
-            encoded = res.encode('utf-8')
-            self.sock.sendto(encoded, sender)
+            self.send(json_res, sender)
 
         # check if username matches target
         elif (self.username == message["target"]):
@@ -199,36 +996,52 @@ class Base_User:
                 "port"      : self.port,
                 "status"    : "listening",
                 "purpose"   : "dm_response",
-                "message_id": self.hash_data(decoded_data)
+                "message_id": message_id
             }
 
-            res = json.dumps(json_res)
-            encoded = res.encode('utf-8')
-            
             # display message
-            self.pending_table[self.hash_data(decoded_data)] = [
-                    "clean", message, message['username'], time.time(), False] 
-            self.display(self.hash_data(decoded_data))
-            self.sock.sendto(encoded, tuple(source))
+            self.pending_table.add(message_id, "clean", message,
+                    message['username'], self.clock())
+            self.display(message_id)
+            self.send(json_res, source)
 
-        # otherwise forward message to next
+        # otherwise forward message to the next hop
         else:
+            hop = self.direct_hop(message["target"])
+            if hop is None:
+                # hand it back to the sender, who reports the target missing
+                hop = [message["ip"], message["port"]]
+            elif hop != self.neighbors["next_1"] and not message.get("routed"):
+                # the frame no longer comes from the previous neighbor
+                message["routed"] = True
+                data = None
+
             # forward along message
-            message = json.dumps(message).encode('utf-8')
-            self.sock.sendto(message, tuple(self.neighbors["next_1"]))
+            if data is None:
+                self.send(message, hop, batch=True)
+            else:
+                self.transmit(data, hop)
+                self.metrics.count('sent', 'direct')
 
 
-    def handle_global(self, request, sender):
+    def handle_global(self, request, sender, data=None, relayed=False):
         ''' Handle the receival of global messages
 
             - determine if pending transaction is already in history (complete)
             - if the sender matches self, the message has traveled all
               the way around the ring and should send a global response
             - else add to pending table and forward to neighbors
+            - data is the frame as received, forwarded without re-encoding
+            - relayed is set for reassembled messages whose fragments
+              were already forwarded
         '''
 
-        decoded_data = json.dumps(request)
-        data = decoded_data.encode('utf-8')
+        if "limit" in request:
+            # fanned out by the SuperUser rather than sent around the ring
+            self.handle_spread(request)
+            return
+
+        message_id = self.message_key(request)
 
         # global acknowledgement response, for when message has either
         # circulated through entire ring, or message has reached a User
@@ -237,31 +1050,48 @@ class Base_User:
         json_req = {
             "username"    : self.username,
             "purpose"     : "global_response",
-            "message_id"  : self.hash_data(decoded_data)
+            "message_id"  : message_id
         }
-        req = json.dumps(json_req)
-        encoded_req = req.encode('utf-8')
+        if 'order' in request:
+            json_req["order"] = request['order']
 
         # check if incoming data is already in the history table
-        if self.hash_data(decoded_data) in self.history_table:
+        if message_id in self.history_table:
             # send back the acknowledgement messages
-            self.sock.sendto(encoded_req, tuple(self.neighbors['prev']))
+            self.send(json_req, self.neighbors['prev'])
             return
 
         # reach end of ring; send back response
         if request['username'] == self.username:
 
+            if 'order' in request:
+                # the message has reached every node; display it here and
+                # acknowledge it to the others with the next flush
+                if 'acks' in request:
+                    self.confirm_acks(request['acks'])
+                if message_id in self.pending_table:
+                    self.measure_lap(self.pending_table[message_id])
+                    # it made it around; display may still wait on an
+                    # earlier order number, but resending will not help
+                    self.pending_table.unschedule(message_id)
+                self.unconfirmed[message_id[1]] = request['order']
+                self.deliver(message_id, request['order'])
+                flush = self.clock() + ACK_FLUSH
+                if self.ack_deadline is None or flush < self.ack_deadline:
+                    self.ack_deadline = flush
+                return
+
             # update entry in pending table to having been received
-            self.pending_table[self.hash_data(decoded_data)][0] = 'clean'
+            self.pending_table[message_id].state = 'clean'
 
             # check if message is at top of queue to ensure consistent ordering
-            if self.hash_data(decoded_data) == list(self.pending_table.keys())[0]:
+            if message_id == self.pending_table.head()[0]:
                 # message to prev neighbor
-                self.sock.sendto(encoded_req, tuple(self.neighbors['prev']))
+                self.send(json_req, self.neighbors['prev'])
         
         # check if sender does not match previous neighbor
         # ie previous node does not know it has been kicked out
-        elif (self.neighbors["prev"] != list(sender)):
+        elif not self.from_prev(sender):
             json_res = {
                 "username"  : self.username,
                 "ip"        : self.ip,
@@ -269,16 +1099,287 @@ class Base_User:
                 "purpose"   : "kicked_out"
             } 
             
-            res = json.dumps(json_res)
-            encoded = res.encode('utf-8')
-            self.sock.sendto(encoded, sender)
+            self.send(json_res, sender)
 
         else:
-            self.pending_table[self.hash_data(decoded_data)] = [
-                    'dirty', request, request['username'], time.time(), False]
+            if 'acks' in request:
+                self.deliver_acks(message_id[0], request['acks'])
+
+            if self.sequence_global(request):
+                # the stamped request has to be re-encoded
+                data = None
+
+            self.pending_table.add(message_id, 'dirty', request,
+                    request['username'], self.clock())
 
             # forward message to neighbor
-            self.sock.sendto(data, tuple(self.neighbors['next_1']))
+            if relayed:
+                return
+            if data is None:
+                self.send(request, self.neighbors['next_1'], batch=True)
+            else:
+                self.transmit(data, self.neighbors['next_1'])
+                self.metrics.count('sent', 'global')
+
+
+    def handle_fragment(self, fragment, sender, data):
+        ''' Handle the receival of a fragment of a large message
+
+            - fragments are relayed to the next neighbor as they arrive
+            - fragments of globals, and of directs for this user, are also
+              reassembled here and handled like the complete message
+        '''
+
+        message_id = fragment['message_id']
+        own = message_id[0] == self.node_id
+
+        if message_id in self.history_table:
+            # answer a duplicate once, as handle_global and handle_direct
+            # do, so a sender whose answer was lost stops resending
+            if fragment['index'] != 0:
+                return
+            if fragment['inner'] == 'global':
+                json_req = {
+                    "username"  : self.username,
+                    "purpose"   : "global_response",
+                    "message_id": message_id
+                }
+                if 'order' in fragment:
+                    json_req["order"] = fragment['order']
+                self.send(json_req, self.neighbors['prev'])
+            elif fragment['target'] == self.username:
+                json_res = {
+                    "username"  : self.username,
+                    "ip"        : self.ip,
+                    "port"      : self.port,
+                    "status"    : "listening",
+                    "purpose"   : "dm_response",
+                    "message_id": message_id
+                }
+                self.send(json_res, address_of(message_id[0]))
+            return
+
+        if not own and not self.from_prev(sender):
+            # previous node does not know it has been kicked out
+            if fragment['index'] == 0:
+                json_res = {
+                    "username"  : self.username,
+                    "ip"        : self.ip,
+                    "port"      : self.port,
+                    "purpose"   : "kicked_out"
+                }
+                self.send(json_res, sender)
+            return
+
+        if fragment['inner'] == 'global':
+            if not own:
+                if self.sequence_fragment(fragment):
+                    data = Codec.encode(fragment)
+                self.transmit(data, self.neighbors['next_1'])
+                self.metrics.count('sent', 'fragment')
+
+        elif not own and fragment['target'] != self.username:
+            # direct message for someone further along the ring
+            self.transmit(data, self.neighbors['next_1'])
+            self.metrics.count('sent', 'fragment')
+            return
+
+        frame = self.fragments.add(fragment, self.clock())
+        if frame is None:
+            return
+
+        try:
+            request, _ = Codec.decode(frame)
+        except ValueError:
+            return
+        if 'order' in fragment:
+            request['order'] = fragment['order']
+
+        if fragment['inner'] == 'global':
+            self.handle_global(request, sender, frame, relayed=True)
+        else:
+            self.handle_direct(request, sender, frame)
+
+
+    def sequence_fragment(self, fragment):
+        ''' Stamp a fragment of a global message with its place in the total order
+
+            - only the SuperUser assigns order numbers
+            - returns True if the fragment was changed
+        '''
+
+        return False
+
+
+    def sequence_global(self, request):
+        ''' Stamp a global message with its place in the total order
+
+            - only the SuperUser assigns order numbers
+            - returns True if the request was changed
+        '''
+
+        return False
+
+
+    def handle_global_response(self, request, data):
+        ''' Handle the acknowledgement of a global message
+
+            - ordered messages go through the reorder buffer, others are
+              displayed right away
+            - the acknowledgement is passed back around the ring until it
+              returns to the node that created it
+        '''
+
+        if 'acks' in request:
+            if request['username'] == self.username:
+                # cumulative acknowledgement made it around the ring
+                self.confirm_acks(request['acks'])
+                return
+            self.deliver_acks(request['message_id'][0], request['acks'])
+        elif 'order' in request:
+            self.deliver(request['message_id'], request['order'])
+        else:
+            self.deliver_unordered(request['message_id'])
+
+        if request['username'] == self.username:
+            if request['message_id'] in self.in_flight:
+                self.in_flight.discard(request['message_id'])
+                self.release_outbox()
+
+            # check for additional acknowledged messages in pending
+            if 'order' not in request and self.pending_table:
+                first_val = self.pending_table.head()[1]
+                if first_val.state == "clean":
+                    self.handle_global(first_val.request, [self.ip, self.port])
+
+            # stop forwarding the acknowledgement along
+            return
+
+        # move along the acknowledgement
+        self.sock.sendto(data, tuple(self.neighbors['prev']))
+        self.metrics.count('sent', 'global_response')
+        self.metrics.datagram('out', len(data))
+
+
+    def measure_lap(self, entry):
+        ''' Measure the lap of an own global that came back
+
+            - a resent global is not measured, since the copy that came
+              back may have been any of them
+        '''
+
+        if not entry.attempts:
+            self.round_trip.sample(self.clock() - entry.time)
+
+
+    def ack_list(self, fresh=False):
+        ''' Return the acknowledgements of own globals not yet confirmed
+
+            - fresh leaves out those a global has already carried
+        '''
+
+        return [[sequence, order] for sequence, order in self.unconfirmed.items()
+                if not (fresh and sequence in self.carried)]
+
+
+    def flush_acks(self):
+        '''Send pending acknowledgements on their own once they are due'''
+
+        if self.ack_deadline is None or self.clock() < self.ack_deadline:
+            return
+
+        if not self.unconfirmed or 'prev' not in self.neighbors:
+            self.ack_deadline = None
+            return
+
+        json_req = {
+            "username"  : self.username,
+            "purpose"   : "global_response",
+            "message_id": (self.node_id, next(reversed(self.unconfirmed))),
+            "acks"      : self.ack_list()
+        }
+        self.send(json_req, self.neighbors['prev'])
+
+        # flush again if the acknowledgement does not make it around
+        self.ack_deadline = self.clock() + self.round_trip.timeout()
+
+
+    def confirm_acks(self, acks):
+        ''' Drop acknowledgements that every node has now received
+
+            - only the acknowledgements carried are confirmed; one that
+              came back late may not have ridden on any global yet
+        '''
+
+        for sequence, _ in acks:
+            if self.unconfirmed.pop(sequence, None) is not None:
+                self.carried.discard(sequence)
+                self.in_flight.discard((self.node_id, sequence))
+
+        if not self.unconfirmed:
+            self.ack_deadline = None
+        self.release_outbox()
+
+
+    def deliver_unordered(self, message_id):
+        ''' Deliver a message acknowledged without its order number
+
+            - a duplicate answered from history carries no order; the one
+              this node saw stamped on the message is used instead
+            - rings held to JSON are not stamped and display right away;
+              elsewhere the message waits for its sender's acknowledgements
+        '''
+
+        if message_id in self.pending_table:
+            order = self.pending_table[message_id].request.get('order')
+            if order is not None:
+                self.deliver(message_id, order)
+                return
+
+        if self.wire == 'json':
+            self.display(message_id)
+
+
+    def deliver_acks(self, node_id, acks):
+        '''Deliver the globals of one sender named in its acknowledgements'''
+
+        for sequence, order in acks:
+            self.deliver((node_id, sequence), order)
+
+
+    def release_outbox(self):
+        '''Send queued globals while there is room in the window'''
+
+        while self.outbox and len(self.in_flight) < self.window:
+            self.send_message(self.outbox.popleft(), flush=False)
+
+
+    def deliver(self, message_id, order):
+        ''' Display ordered messages once every earlier order number is in
+
+            - message_id is None when the SuperUser skipped a lost message
+        '''
+
+        if self.next_order is None:
+            self.next_order = order
+
+        if order < self.next_order:
+            # stamped before this node joined, or skipped as lost
+            self.display(message_id)
+            return
+
+        self.reorder[order] = message_id
+        advanced = False
+        while self.next_order in self.reorder:
+            self.display(self.reorder.pop(self.next_order))
+            self.next_order += 1
+            advanced = True
+
+        # note when delivery started waiting on a missing order number
+        if not self.reorder:
+            self.gap_since = None
+        elif advanced or self.gap_since is None:
+            self.gap_since = self.clock()
 
 
     def handle_disconnect(self, request):
@@ -288,8 +1389,10 @@ class Base_User:
             next neighbor
         '''
         
+        self.metrics.count('disconnects', request['cause'])
         if request['prev'] != 'same':
             self.neighbors['prev'] = request['prev']
+            self.former_prev = None
             if request['cause'] == 'crash':
                 json_req = {
                     "purpose": "disconnect",
@@ -298,9 +1401,7 @@ class Base_User:
                     "prev"   : "same",
                     "cause"  : "crash"
                 }
-                req = json.dumps(json_req)
-                encoded_req = req.encode('utf-8')
-                self.sock.sendto(encoded_req, tuple(self.neighbors['prev'])) 
+                self.send(json_req, self.neighbors['prev'])
                 
 
         elif request['next_1'] != 'same' and request['next_2'] != 'same':
@@ -315,9 +1416,7 @@ class Base_User:
                     "prev"   : "same",
                     "cause"  : "disconnect"
                 }
-                req = json.dumps(json_req)
-                encoded_req = req.encode('utf-8')
-                self.sock.sendto(encoded_req, tuple(self.neighbors['prev'])) 
+                self.send(json_req, self.neighbors['prev'])
  
         elif request['next_2'] != 'same':
             if self.neighbors == {}:
@@ -325,9 +1424,8 @@ class Base_User:
             self.neighbors['next_2']  = request['next_2']
             # confirm that this is the correct message to send back
             if request['cause'] == 'crash' and self.pending_table:
-                resumed_request = list(self.pending_table.values())[0][1]
-                req = json.dumps(resumed_request).encode('utf-8')
-                self.sock.sendto(req, tuple(self.neighbors['next_1']))
+                resumed_request = self.pending_table.head()[1].request
+                self.send(resumed_request, self.neighbors['next_1'])
 		
 		# case where system is super user and a single user
         if self.neighbors['next_1'] == self.neighbors['prev']:
@@ -337,9 +1435,18 @@ class Base_User:
         if tuple(self.neighbors['next_1']) == (self.ip, self.port):
             self.neighbors = {}
 
+        self.sync_successors()
+
 	
     def handle_crash(self, request):
-        '''Update pointers in the event of a node crash to preserve ring'''
+        ''' Update pointers in the event of a node crash to preserve ring
+
+            - the alert lists every user found dead recently; each run of
+              crashed users is bridged by the node before it as the alert
+              passes, using the first successor still alive
+            - when every known successor crashed, the LoginServer is told
+              the ring has failed
+        '''
         
         if self.username == 'super_user':
             if request['status'] == 'clean':
@@ -347,33 +1454,49 @@ class Base_User:
                 return
             else:
                 request['status'] = 'clean'
-        pending_keys = list(self.pending_table.keys())[:]
+
+        if not self.neighbors:
+            # no ring left to repair
+            return
+
+        crashed = request.get('crashed', [[request['username'], request['info']]])
+        self.metrics.count('crashes', amount=len(crashed))
+        owners = {username for username, _ in crashed}
+        dead = {tuple(info) for _, info in crashed}
+        for username in owners:
+            self.locations.discard(username)
+
+        pending_keys = list(self.pending_table)
         for key in pending_keys:
-            try:
-                if self.pending_table[key][2] == request['username']:
-                    self.pending_table.pop(key)
-            except KeyError:
-                pass
+            if self.pending_table[key].owner in owners:
+                self.pending_table.pop(key)
 
-        if tuple(self.neighbors['next_1']) != tuple(request['info']):
+        if tuple(self.neighbors['next_1']) not in dead:
             # forward to the next node
-            self.sock.sendto(json.dumps(
-                request).encode('utf-8'), tuple(self.neighbors['next_1']))
+            self.send(request, self.neighbors['next_1'])
             return
 
         # next node is the crashed one, start reassigning neighbors
-        try:
-            self.neighbors['next_1'] = self.neighbors['next_2']
-            if self.neighbors['next_2'] == None:
+        if not self.successors:
+            self.sync_successors()
+        alive = [node for node in self.successors if tuple(node) not in dead]
+        if not alive:
+            if self.neighbors.get('next_2') is None:
                 # server is the only one left in the system
                 self.neighbors = {}
-                return
-        except KeyError:
-            # catch the case where there are supposedly only two nodes in the system
-            # server is the only one left in the system
-            self.neighbors = {}
-            return 
-            
+                self.successors = []
+            else:
+                # every known successor crashed
+                self.send({"purpose": "total_failure"}, self.login_server)
+            return
+
+        self.neighbors['next_1'] = alive[0]
+        self.neighbors['next_2'] = alive[1] if len(alive) > 1 else None
+        if self.neighbors['next_1'] == self.neighbors.get('prev'):
+            # a single other node is left
+            self.neighbors['next_2'] = None
+        self.set_successors(alive)
+
         # notify the prev node
         json_req = {
             "purpose": "disconnect",
@@ -382,9 +1505,7 @@ class Base_User:
             "prev"   : "same",
             "cause"  : "crash"
         }
-        req = json.dumps(json_req)
-        encoded_req = req.encode('utf-8')
-        self.sock.sendto(encoded_req, tuple(self.neighbors['prev'])) 
+        self.send(json_req, self.neighbors['prev'])
 
         # notify new next node this node will need to message back with the new next_2
         json_req = {
@@ -394,14 +1515,10 @@ class Base_User:
             "prev"   : (self.ip, self.port),
             "cause"  : "crash"
         }
-
-        req = json.dumps(json_req)
-        encoded_req = req.encode('utf-8')
-        self.sock.sendto(encoded_req, tuple(self.neighbors['next_1'])) 
+        self.send(json_req, self.neighbors['next_1'])
         
         # keep forwarding along the message in the system
-        self.sock.sendto(json.dumps(
-            request).encode('utf-8'), tuple(self.neighbors['next_1']))
+        self.send(request, self.neighbors['next_1'])
     
     def display(self, message_id):
         '''Internal method to display the message with a given id'''
@@ -412,7 +1529,7 @@ class Base_User:
         if message_id not in self.pending_table:
             return
 
-        req = self.pending_table[message_id][1]
+        req = self.pending_table[message_id].request
         username = req['username']
         message = req['message']
 
@@ -428,3 +1545,147 @@ class Base_User:
         # add the message_id to the history table
         self.history_table.add(message_id)
 
+
+    def check_timeouts(self):
+        ''' Handle messages sent by this node that have not come back in time
+
+            - in rings held to JSON for older peers, the first timeout asks the
+              LoginServer to check for crashed users; elsewhere crashes are
+              found by heartbeats
+            - other timeouts resend the message to the next neighbor, or
+              to the SuperUser if it fans the message out; each resend
+              waits twice as long as the one before, and after RETRIES
+              (RoundTrip.py) the hop is reported to the LoginServer, which
+              checks whether it crashed
+            - heartbeats, acknowledgements, batches, pointer updates of the
+              join in progress and queued joins that are due are sent as well
+        '''
+
+        now = self.clock()
+        for message_id, entry in self.pending_table.expired(now):
+            self.metrics.count('retransmits', entry.request.get('purpose'))
+            hop = None
+            if not entry.sent and self.wire == 'json':
+                # it's this users responsibility to prompt the checkins
+                # tell the login server to check for timeouts
+                self.send({"purpose":"checkup"}, self.login_server)
+                entry.sent = True
+            elif entry.request.get('spread') == 'tree':
+                # the SuperUser answers with the copy it stamped, if any
+                hop = self.leader
+                self.send(entry.request, hop, batch=True)
+            else:
+                if entry.request.get('purpose') == 'direct':
+                    # the cached address may be stale; resends walk the ring
+                    self.locations.discard(entry.request['target'])
+                try:
+                    hop = self.neighbors['next_1']
+                    self.send(entry.request, hop, batch=True)
+                except KeyError:
+                    print('No other users in the chat room')
+                    self.pending_table.clear()
+                    return
+
+            self.round_trip.expired(now, entry.attempts)
+            entry.attempts += 1
+            if entry.attempts == RoundTrip.RETRIES and hop is not None:
+                # resending is not getting through; crash detection takes
+                # over, while resends go on at the longest timeout
+                self.report_suspect(hop)
+                self.metrics.count('retry_caps')
+            self.pending_table.schedule(message_id,
+                    now + self.round_trip.timeout(entry.attempts))
+
+        self.flush_acks()
+        self.fragments.expire(now)
+        self.expire_lookups(now)
+
+        if now >= self.heartbeat_deadline:
+            self.check_heartbeats(now)
+
+        # pointer update of the join in progress went unanswered
+        if (self.join is not None and "deadline" in self.join and
+                self.clock() >= self.join["deadline"]):
+            self.retry_join()
+
+        # users queued for JOIN_WINDOW are spliced in together
+        if self.join_after is not None and self.clock() >= self.join_after:
+            self.start_join()
+
+        if self.batch_deadline is not None and self.clock() >= self.batch_deadline:
+            self.flush_batches()
+
+
+    def check_heartbeats(self, now):
+        ''' Send heartbeats to the previous and next neighbors, and report
+            any neighbor that has gone quiet
+
+            - only the suspected neighbor is reported; the LoginServer
+              checks on it before declaring a crash
+            - peers that only speak JSON do not understand heartbeats, so
+              rings held to JSON rely on checkup sweeps instead
+        '''
+
+        # look for suspects a few times per heartbeat
+        self.heartbeat_deadline = now + HEARTBEAT / 4
+
+        peers = set()
+        if self.wire != 'json':
+            for key in ('prev', 'next_1'):
+                if self.neighbors.get(key):
+                    peers.add(tuple(self.neighbors[key]))
+            peers.discard((self.ip, self.port))
+        self.detector.watch(peers, now)
+
+        if now - self.heartbeat_sent >= HEARTBEAT:
+            self.heartbeat_sent = now
+            for peer in peers:
+                heartbeat = {"purpose": "heartbeat"}
+                if self.spread == 'tree' and self.next_order is not None:
+                    # lets the neighbor notice fanned out globals it missed
+                    heartbeat["order"] = self.next_order
+                # the previous node's successors are this one and its own
+                if list(peer) == self.neighbors.get('prev'):
+                    heartbeat["successors"] = self.successors[:SUCCESSORS - 1]
+                self.send(heartbeat, peer, batch=True)
+
+        for peer in self.detector.suspects(now):
+            self.report_suspect(peer)
+
+
+    def report_suspect(self, peer):
+        '''Ask the LoginServer to check whether a peer has crashed'''
+
+        self.send({
+            "username": self.username,
+            "purpose" : "suspect",
+            "suspect" : list(peer)
+        }, self.login_server)
+
+
+    def next_deadline(self):
+        ''' Return when the next retransmission, acknowledgement, batch,
+            heartbeat, join or lookup is due, or None if nothing is scheduled
+        '''
+
+        deadlines = [deadline for deadline in
+                (self.pending_table.next_deadline(), self.ack_deadline,
+                    self.batch_deadline, self.heartbeat_deadline,
+                    self.join_after)
+                if deadline is not None]
+        if self.join is not None and "deadline" in self.join:
+            deadlines.append(self.join["deadline"])
+        deadlines += [deadline for deadline, waiting in self.lookups.values()
+                if waiting is not None]
+
+        return min(deadlines) if deadlines else None
+
+
+    def next_timeout(self):
+        '''Seconds the select loop may wait before checking timeouts'''
+
+        deadline = self.next_deadline()
+        if deadline is None:
+            return TIMEOUT
+
+        return min(TIMEOUT, max(0, deadline - self.clock()))
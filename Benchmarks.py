@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+# Benchmarks.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 19, 2021
+#
+# Benchmarks.py is a benchmark suite for global and direct messages. It
+# sweeps ring size, number of concurrent senders and message size, runs
+# every ring on localhost on one event loop, and reports p50/p95/p99
+# latency and sustained throughput of each case, the median of several
+# runs of the sweep. Results can be written as JSON and compared against
+# a stored baseline to flag regressions
+#
+# Usage: ./Benchmarks.py [--quick] [--repeat RUNS] [--json FILE]
+#                        [--baseline FILE] [--tolerance FRACTION]
+
+import Harness
+import Runtime
+
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+
+MEMBERS = (5, 20, 50)          # users in the ring, besides the SuperUser
+SENDERS = (1, 4, 16)           # users sending at once
+SIZES = (32, 512, 2048)        # message bytes; 2048 is fragmented
+DURATION = 1.0                 # seconds each case keeps sending
+DRAIN = 2.0                    # seconds to wait for the last messages
+DIRECT_WINDOW = 8              # direct messages a sender keeps outstanding
+REPEAT = 3                     # runs of the sweep; each case reports its median
+TOLERANCE = {"throughput": .3, "p95_ms": .5}    # change from the baseline
+                                                # flagged as a regression
+
+QUICK = {"members": (5, 20), "senders": (1, 4), "sizes": (32, 2048),
+         "duration": .5}
+
+
+def percentile(values, p):
+    '''Return the p-th percentile of values, by nearest rank'''
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def record_displays(nodes, shown):
+    ''' Note when each node displays each benchmark message
+
+        - shown maps a message tag to [(username, time), ...]; the tag is
+          the first word of the message
+    '''
+
+    for node in nodes:
+        def display(message_id, node=node, display=node.display):
+            if (message_id in node.pending_table and
+                    message_id not in node.history_table):
+                request = node.pending_table[message_id].request
+                tag = request['message'].split(' ', 1)[0]
+                shown.setdefault(tag, []).append(
+                        (node.username, time.perf_counter()))
+            display(message_id)
+        node.display = display
+
+
+async def measure_case(kind, members, senders, size, duration):
+    ''' Keep senders sending messages of size bytes around a ring of
+        members users for duration seconds
+
+        - globals count as delivered once every node has displayed them,
+          direct messages once their target has
+        - senders stay within their window, so latency is measured in
+          the ring rather than in the outbox
+
+        Return Values:
+        dictionary of the case and its results
+    '''
+
+    leader, users, tasks = await Harness.start_ring(members)
+    nodes = [leader] + users
+    Harness.skip_lookups(nodes)
+    shown = {}
+    record_displays(nodes, shown)
+
+    choose = random.Random(members * 1000 + senders)
+    sending = users[:senders]
+    sent = {}                   # tag -> (send time, target or None)
+    outstanding = {usr.username: set() for usr in sending}
+
+    def delivered(tag):
+        target = sent[tag][1]
+        names = [username for username, _ in shown.get(tag, ())]
+        if target is None:
+            return len(names) >= len(nodes)
+        return target in names
+
+    def done_at(tag):
+        target = sent[tag][1]
+        times = [when for username, when in shown[tag]
+                if target is None or username == target]
+        return max(times)
+
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for usr in sending:
+            waiting = outstanding[usr.username]
+            waiting -= {tag for tag in waiting if delivered(tag)}
+            window = usr.window if kind == 'global' else DIRECT_WINDOW
+            while len(waiting) < window:
+                tag = f'b{count}'
+                count += 1
+                message = (tag + ' ').ljust(size, 'x')
+                if kind == 'global':
+                    sent[tag] = (time.perf_counter(), None)
+                    Runtime.call(usr, usr.send_message, message)
+                else:
+                    target = choose.choice([other for other in nodes
+                            if other is not usr])
+                    sent[tag] = (time.perf_counter(), target.username)
+                    Runtime.call(usr, usr.direct_message, target.username, message)
+                waiting.add(tag)
+        await asyncio.sleep(.0005)
+    end = time.perf_counter()
+
+    # let the messages still in the ring arrive
+    while (time.perf_counter() - end < DRAIN and
+            not all(delivered(tag) for tag in sent)):
+        await asyncio.sleep(.005)
+
+    Harness.stop_ring(tasks)
+    await asyncio.sleep(0)
+
+    finished = [tag for tag in sent if delivered(tag)]
+    latencies = [(done_at(tag) - sent[tag][0]) * 1000 for tag in finished]
+    in_time = sum(1 for tag in finished if done_at(tag) <= end)
+
+    return {
+        "kind"      : kind,
+        "members"   : members,
+        "senders"   : senders,
+        "size"      : size,
+        "sent"      : len(sent),
+        "lost"      : len(sent) - len(finished),
+        "throughput": in_time / (end - start),
+        "p50_ms"    : percentile(latencies, 50) if latencies else None,
+        "p95_ms"    : percentile(latencies, 95) if latencies else None,
+        "p99_ms"    : percentile(latencies, 99) if latencies else None
+    }
+
+
+async def run_suite(members, senders, sizes, duration):
+    '''Run every case of the sweep, one ring at a time'''
+
+    results = []
+    for kind in ('global', 'direct'):
+        for count in members:
+            for sending in senders:
+                if sending > count:
+                    continue
+                for size in sizes:
+                    results.append(await measure_case(kind, count, sending,
+                            size, duration))
+                    # let the ports of the last ring be reused
+                    await asyncio.sleep(.05)
+
+    return results
+
+
+def summarize(runs):
+    ''' Combine several runs of the sweep into one result per case
+
+        - every measurement is the median of the runs, so one slow run
+          does not move it
+
+        Return Values:
+        list of results, in the order of the first run
+    '''
+
+    summary = []
+    for results in zip(*runs):
+        result = dict(results[0])
+        for field in ("sent", "lost", "throughput", "p50_ms", "p95_ms", "p99_ms"):
+            values = [res[field] for res in results if res[field] is not None]
+            result[field] = statistics.median(values) if values else None
+        summary.append(result)
+
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    ''' Compare results against a baseline run
+
+        - a case regresses if its throughput dropped, or its p95 latency
+          grew, by more than its metric's share in tolerance
+
+        Return Values:
+        list of (case, description) of every regression
+    '''
+
+    def key(result):
+        return (result["kind"], result["members"], result["senders"],
+                result["size"])
+
+    before = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        if result["throughput"] < old["throughput"] * (1 - tolerance["throughput"]):
+            regressions.append((key(result), f'throughput {old["throughput"]:.0f}'
+                    f' -> {result["throughput"]:.0f} msgs/s'))
+        if (old["p95_ms"] is not None and result["p95_ms"] is not None and
+                result["p95_ms"] > old["p95_ms"] * (1 + tolerance["p95_ms"])):
+            regressions.append((key(result), f'p95 {old["p95_ms"]:.2f}'
+                    f' -> {result["p95_ms"]:.2f} ms'))
+
+    return regressions
+
+
+def report(results):
+    '''Print one line per case'''
+
+    print(f"\n{'kind':6} {'users':>5} {'senders':>7} {'bytes':>5} "
+          f"{'msgs/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'lost':>5}")
+    for result in results:
+        latencies = [f'{result[key]:8.2f}' if result[key] is not None
+                else f'{"-":>8}' for key in ('p50_ms', 'p95_ms', 'p99_ms')]
+        print(f"{result['kind']:6} {result['members']:5} {result['senders']:7} "
+              f"{result['size']:5} {result['throughput']:8.0f} "
+              f"{' '.join(latencies)} {result['lost']:5}")
+    print()
+
+
+def option(name, default=None):
+    '''Return the value given after a command line option, or default'''
+
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+
+def main():
+
+    sweep = {"members": MEMBERS, "senders": SENDERS, "sizes": SIZES,
+             "duration": DURATION}
+    if '--quick' in sys.argv:
+        sweep.update(QUICK)
+
+    repeat = int(option('--repeat', REPEAT))
+
+    # chat messages would otherwise flood the results
+    with Harness.quiet():
+        results = summarize([asyncio.run(run_suite(**sweep))
+                for run in range(repeat)])
+
+    report(results)
+
+    output = option('--json')
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({
+                "python" : platform.python_version(),
+                "machine": platform.machine(),
+                "cpus"   : os.cpu_count(),
+                "sweep"  : sweep,
+                "repeat" : repeat,
+                "results": results
+            }, f, indent=1)
+        print(f'Results written to {output}')
+
+    baseline = option('--baseline')
+    if baseline is not None:
+        tolerance = dict(TOLERANCE)
+        if option('--tolerance') is not None:
+            tolerance = {metric: float(option('--tolerance')) for metric in TOLERANCE}
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        for case, description in regressions:
+            print(f'REGRESSION {case}: {description}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions against {baseline}')
+
+
+if __name__ == '__main__':
+    main()
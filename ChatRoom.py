@@ -7,14 +7,29 @@
 # ChatRoom.py serves as the main file to add User nodes
 
 
+import Metrics
+import Runtime
+import Transport
 import User
 
+import sys
+
 
 def main():
     '''Main runner function to add nodes'''
 
-    new_usr = User.User()
+    # ./ChatRoom.py [ROOM] joins the named room instead of the default one;
+    # --lead also splices new users into the ring, sharing the SuperUser's
+    # load of joins; --metrics=PORT serves the user's metrics as
+    # Prometheus text on that local port; --bind=IP[:PORT] and
+    # --login=HOST:PORT set the user's address and the LoginServer's
+    transport = Transport.configure()
+    rooms = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    new_usr = User.User(room=rooms[0] if rooms else None,
+            lead='--lead' in sys.argv, transport=transport)
     new_usr.print_user()
+    Metrics.export_option(new_usr.metrics)
 
     print("Messaging Options")
     print("------------------")
@@ -23,7 +38,12 @@ def main():
     print("disconnect  - Exit System\n")
 
     new_usr.connect()
-    new_usr.listen()
+
+    # the select loop is kept as a fallback for the asyncio runtime
+    if '--select' in sys.argv:
+        new_usr.listen()
+    else:
+        Runtime.run(new_usr)
 
 
 if __name__ == '__main__':
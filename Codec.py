@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+# Codec.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 1, 2021
+#
+# Codec defines the wire format for requests exchanged between nodes.
+# Chat traffic is sent as compact binary frames; JSON is still accepted
+# (and can still be produced) so older peers can join during a rollout
+
+import json
+import socket
+import struct
+
+
+MAGIC = 0xC7
+VERSION = 4
+
+# purpose codes; append new purposes to the end so codes stay stable
+PURPOSES = (
+    'global',
+    'global_response',
+    'direct',
+    'dm_response',
+    'connect',
+    'update_pointers',
+    'update_last_node',
+    'disconnect',
+    'checkup',
+    'checkup_res',
+    'crash',
+    'kicked_out',
+    'total_failure',
+    'wire',
+    'batch',
+    'fragment',
+    'update_pointers_res',
+    'connect_res',
+    'heartbeat',
+    'suspect',
+    'fingers',
+    'locate',
+    'location',
+    'missing',
+    'stats',
+    'stats_res',
+)
+PURPOSE_CODES = {purpose: code for code, purpose in enumerate(PURPOSES, 1)}
+
+# key order of the requests built by the senders, so a decoded request
+# is identical to the one that was encoded (requests from peers without
+# message ids are still identified by a hash of the request)
+FIELD_ORDER = {
+    'global'         : ('username', 'purpose', 'message', 'ip', 'port',
+                        'message_id', 'order', 'acks', 'message_count'),
+    'direct'         : ('username', 'purpose', 'message', 'ip', 'port',
+                        'target', 'message_id', 'message_count'),
+    'global_response': ('username', 'purpose', 'message_id', 'order', 'acks'),
+    'dm_response'    : ('username', 'ip', 'port', 'status', 'purpose',
+                        'message_id'),
+}
+
+# flags marking which header slots are in use
+HAS_USERNAME = 0x01
+HAS_TARGET   = 0x02
+HAS_MESSAGE  = 0x04
+HAS_ADDR     = 0x08
+HAS_ORDER    = 0x10
+HAS_ID       = 0x20
+HAS_EXTRAS   = 0x40
+HAS_ACKS     = 0x80
+
+# magic, version, purpose, flags, message id (sender node id, sequence
+# number), order number, ip, port, sender length, target length,
+# body length, extras length, acknowledgement count
+HEADER = struct.Struct('!BBBHQQQ4sHBBIHH')
+
+# acknowledgement of one global: (sequence number, order number)
+ACK = struct.Struct('!QQ')
+
+# several frames for the same neighbor can share one datagram:
+# magic, version, batch purpose code, frame count; then each frame
+# prefixed with its length
+BATCH = struct.Struct('!BBBH')
+BATCH_ITEM = struct.Struct('!H')
+
+# frames larger than a datagram are split into fragments:
+# magic, version, fragment purpose code, purpose code of the message,
+# flags, message id, order number, fragment index, fragment count,
+# target length; then the target and a slice of the message's frame
+FRAGMENT = struct.Struct('!BBBBBQQQHHB')
+
+
+def encode(request, wire='binary'):
+    '''Encode a request dictionary into bytes
+
+        - wire selects the frame format, either 'binary' or 'json'
+        - fields without a header slot are carried as a JSON extras section
+    '''
+
+    if wire == 'json':
+        return json.dumps(request).encode('utf-8')
+
+    if request.get('purpose') == 'fragment':
+        return encode_fragment(request)
+
+    extras = dict(request)
+    flags = 0
+    purpose = PURPOSE_CODES.get(extras.get('purpose'), 0)
+    if purpose:
+        del extras['purpose']
+
+    sender = b''
+    if isinstance(extras.get('username'), str):
+        sender = extras.pop('username').encode('utf-8')
+        flags |= HAS_USERNAME
+
+    target = b''
+    if isinstance(extras.get('target'), str):
+        target = extras.pop('target').encode('utf-8')
+        flags |= HAS_TARGET
+
+    body = b''
+    if isinstance(extras.get('message'), str):
+        body = extras.pop('message').encode('utf-8')
+        flags |= HAS_MESSAGE
+
+    ip = bytes(4)
+    port = 0
+    if isinstance(extras.get('ip'), str) and isinstance(extras.get('port'), int):
+        try:
+            ip = socket.inet_aton(extras['ip'])
+            port = extras['port']
+            del extras['ip'], extras['port']
+            flags |= HAS_ADDR
+        except OSError:
+            # not a dotted address; leave it to the extras section
+            pass
+
+    node_id, sequence = 0, 0
+    if isinstance(extras.get('message_id'), (tuple, list)):
+        node_id, sequence = extras.pop('message_id')
+        flags |= HAS_ID
+
+    order = 0
+    if isinstance(extras.get('order'), int):
+        order = extras.pop('order')
+        flags |= HAS_ORDER
+
+    acks = b''
+    if isinstance(extras.get('acks'), list) and len(extras['acks']) < 1 << 16:
+        acks = b''.join(ACK.pack(*ack) for ack in extras.pop('acks'))
+        flags |= HAS_ACKS
+
+    extra = b''
+    if extras:
+        extra = json.dumps(extras).encode('utf-8')
+        flags |= HAS_EXTRAS
+
+    if len(sender) > 255 or len(target) > 255:
+        # names too long for the header; fall back to JSON
+        return json.dumps(request).encode('utf-8')
+
+    header = HEADER.pack(MAGIC, VERSION, purpose, flags, node_id, sequence,
+            order, ip, port, len(sender), len(target), len(body), len(extra),
+            len(acks) // ACK.size)
+
+    return b''.join((header, sender, target, body, acks, extra))
+
+
+def decode(data):
+    '''Decode bytes from the wire into a request dictionary
+
+        Return Values:
+        (request, wire) where wire is the format the frame was sent in
+
+        Raises ValueError for frames that cannot be decoded
+    '''
+
+    if not data or data[0] != MAGIC:
+        try:
+            request = json.loads(data.decode('utf-8'))
+        except UnicodeDecodeError as e:
+            raise ValueError(str(e))
+        # message ids are used as table keys
+        if isinstance(request, dict) and isinstance(
+                request.get('message_id'), list):
+            request['message_id'] = tuple(request['message_id'])
+        return (request, 'json')
+
+    if len(data) > 2 and data[2] == PURPOSE_CODES['fragment']:
+        return (decode_fragment(data), 'binary')
+
+    if len(data) < HEADER.size:
+        raise ValueError('truncated frame header')
+
+    (_, version, purpose, flags, node_id, sequence, order, ip, port,
+        sender_len, target_len, body_len, extra_len,
+        ack_count) = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f'unsupported frame version {version}')
+
+    offset = HEADER.size
+    acks_len = ack_count * ACK.size
+    if len(data) < (offset + sender_len + target_len + body_len + acks_len +
+            extra_len):
+        raise ValueError('truncated frame body')
+
+    sender = data[offset:offset + sender_len].decode('utf-8')
+    offset += sender_len
+    target = data[offset:offset + target_len].decode('utf-8')
+    offset += target_len
+    body = data[offset:offset + body_len].decode('utf-8')
+    offset += body_len
+    acks = [list(ack) for ack in ACK.iter_unpack(data[offset:offset + acks_len])]
+    offset += acks_len
+
+    fields = {}
+    if purpose:
+        try:
+            fields['purpose'] = PURPOSES[purpose - 1]
+        except IndexError:
+            raise ValueError(f'unknown purpose code {purpose}')
+    if flags & HAS_USERNAME:
+        fields['username'] = sender
+    if flags & HAS_TARGET:
+        fields['target'] = target
+    if flags & HAS_MESSAGE:
+        fields['message'] = body
+    if flags & HAS_ADDR:
+        fields['ip'] = socket.inet_ntoa(ip)
+        fields['port'] = port
+    if flags & HAS_ID:
+        fields['message_id'] = (node_id, sequence)
+    if flags & HAS_ORDER:
+        fields['order'] = order
+    if flags & HAS_ACKS:
+        fields['acks'] = acks
+    if flags & HAS_EXTRAS:
+        fields.update(json.loads(
+            data[offset:offset + extra_len].decode('utf-8')))
+
+    # rebuild the request in the order the sender built it
+    request = {}
+    for key in FIELD_ORDER.get(fields.get('purpose'), ()):
+        if key in fields:
+            request[key] = fields.pop(key)
+    request.update(fields)
+
+    return (request, 'binary')
+
+
+def encode_batch(frames):
+    '''Pack several encoded frames into a single datagram'''
+
+    parts = [BATCH.pack(MAGIC, VERSION, PURPOSE_CODES['batch'], len(frames))]
+    for frame in frames:
+        parts.append(BATCH_ITEM.pack(len(frame)))
+        parts.append(frame)
+
+    return b''.join(parts)
+
+
+def split(data):
+    ''' Split a datagram into the frames it carries
+
+        - datagrams that are not batches carry a single frame
+        - raises ValueError for a truncated batch
+    '''
+
+    if (len(data) < BATCH.size or data[0] != MAGIC or
+            data[2] != PURPOSE_CODES['batch']):
+        return [data]
+
+    _, version, _, count = BATCH.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f'unsupported frame version {version}')
+
+    frames = []
+    offset = BATCH.size
+    for _ in range(count):
+        if len(data) < offset + BATCH_ITEM.size:
+            raise ValueError('truncated batch')
+        (length,) = BATCH_ITEM.unpack_from(data, offset)
+        offset += BATCH_ITEM.size
+        if len(data) < offset + length:
+            raise ValueError('truncated batch')
+        frames.append(data[offset:offset + length])
+        offset += length
+
+    return frames
+
+
+def fragment(request, data, mtu):
+    ''' Split the encoded frame of a request into fragments of at most mtu bytes
+
+        - every fragment names the message and its target, so forwarding
+          nodes can relay fragments without reassembling them
+    '''
+
+    target = request.get('target') or ''
+    size = mtu - FRAGMENT.size - len(target.encode('utf-8'))
+    chunks = [data[i:i + size] for i in range(0, len(data), size)]
+
+    fragments = []
+    for index, chunk in enumerate(chunks):
+        frame = {
+            "purpose"   : "fragment",
+            "inner"     : request['purpose'],
+            "message_id": request['message_id'],
+            "index"     : index,
+            "count"     : len(chunks),
+            "target"    : target,
+            "chunk"     : chunk
+        }
+        if 'order' in request:
+            frame["order"] = request['order']
+        fragments.append(encode_fragment(frame))
+
+    return fragments
+
+
+def encode_fragment(fragment):
+    '''Encode a fragment dictionary into bytes'''
+
+    target = fragment['target'].encode('utf-8')
+    flags = 0
+    order = 0
+    if fragment.get('order') is not None:
+        order = fragment['order']
+        flags |= HAS_ORDER
+
+    node_id, sequence = fragment['message_id']
+    header = FRAGMENT.pack(MAGIC, VERSION, PURPOSE_CODES['fragment'],
+            PURPOSE_CODES[fragment['inner']], flags, node_id, sequence, order,
+            fragment['index'], fragment['count'], len(target))
+
+    return b''.join((header, target, fragment['chunk']))
+
+
+def decode_fragment(data):
+    '''Decode a fragment into a dictionary; the slice is kept as bytes'''
+
+    if len(data) < FRAGMENT.size:
+        raise ValueError('truncated fragment header')
+
+    (_, version, _, inner, flags, node_id, sequence, order, index, count,
+        target_len) = FRAGMENT.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f'unsupported frame version {version}')
+    if not 0 < inner <= len(PURPOSES) or index >= count:
+        raise ValueError('invalid fragment header')
+
+    offset = FRAGMENT.size
+    fragment = {
+        "purpose"   : "fragment",
+        "inner"     : PURPOSES[inner - 1],
+        "message_id": (node_id, sequence),
+        "index"     : index,
+        "count"     : count,
+        "target"    : data[offset:offset + target_len].decode('utf-8'),
+        "chunk"     : data[offset + target_len:]
+    }
+    if flags & HAS_ORDER:
+        fragment["order"] = order
+
+    return fragment
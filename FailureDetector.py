@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+# FailureDetector.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 13, 2021
+#
+# The PhiAccrual class is a phi accrual failure detector. It keeps the
+# recent gaps between heartbeats from each watched peer, and turns the time
+# since a peer was last heard into a suspicion level phi: the longer the
+# silence compared to how regularly the peer has been heard, the higher phi.
+# A peer is suspected once phi crosses a threshold. The spread of the gaps
+# is kept no smaller than a fraction of their mean: heartbeats on a quiet
+# network arrive so regularly that phi would otherwise leap past every
+# threshold at once, and the threshold could not trade detection time
+# against false suspicions
+
+import collections
+import math
+
+
+WINDOW = 100          # heartbeat gaps remembered per peer
+THRESHOLD = 8.0       # phi above which a peer is suspected
+MIN_SPREAD = .25      # floor on the spread of gaps, as a fraction of their mean
+
+
+class PeerState:
+
+    __slots__ = ('last', 'gaps', 'total', 'squares', 'suspected')
+
+    def __init__(self, now, interval):
+        '''Constructor for PeerState objects'''
+
+        self.last = now             # when the peer was last heard
+        self.gaps = collections.deque()
+        self.total = 0.0            # sum of gaps
+        self.squares = 0.0          # sum of squared gaps
+        self.suspected = False
+
+        # until real gaps are known, expect the nominal interval
+        self.add_gap(interval)
+        self.add_gap(interval)
+
+
+    def add_gap(self, gap):
+        self.gaps.append(gap)
+        self.total += gap
+        self.squares += gap * gap
+
+
+class PhiAccrual:
+
+    def __init__(self, interval, threshold=THRESHOLD, window=WINDOW,
+            min_spread=MIN_SPREAD, pause=None):
+        ''' Constructor for PhiAccrual objects
+
+            - pause is silence taken in stride on top of the usual gap;
+              by default a single lost heartbeat
+        '''
+
+        self.interval = interval    # nominal time between heartbeats
+        self.pause = interval if pause is None else pause
+        self.threshold = threshold
+        self.window = window
+        self.min_spread = min_spread
+        self.peers = {}             # address -> PeerState
+
+        # statistics
+        self.suspicions = 0
+        self.false_positives = 0    # suspected peers that were heard again
+        self.detection_times = collections.deque(maxlen=window)
+
+
+    def watch(self, peers, now):
+        ''' Watch exactly the given peers
+
+            - new peers count as heard at now
+            - peers no longer given are forgotten
+        '''
+
+        for peer in list(self.peers):
+            if peer not in peers:
+                del self.peers[peer]
+
+        for peer in peers:
+            if peer not in self.peers:
+                self.peers[peer] = PeerState(now, self.interval)
+
+
+    def heard(self, peer, now):
+        '''Record a heartbeat, or any other frame, from a peer'''
+
+        state = self.peers.get(peer)
+        if state is None:
+            return
+
+        if state.suspected:
+            # it was not dead after all
+            state.suspected = False
+            self.false_positives += 1
+
+        state.add_gap(now - state.last)
+        if len(state.gaps) > self.window:
+            gap = state.gaps.popleft()
+            state.total -= gap
+            state.squares -= gap * gap
+        state.last = now
+
+
+    def phi(self, peer, now):
+        ''' Return the suspicion level of a peer
+
+            - phi = -log10(probability that a peer that is alive stays
+              silent this long), with gaps taken as normally distributed
+        '''
+
+        state = self.peers[peer]
+        count = len(state.gaps)
+        mean = state.total / count
+        variance = max(0.0, state.squares / count - mean * mean)
+        stddev = max(self.min_spread * mean, math.sqrt(variance))
+
+        # logistic approximation of the normal distribution's tail
+        y = (now - state.last - mean - self.pause) / stddev
+        z = y * (1.5976 + 0.070566 * y * y)
+        if z > 30:
+            return z / math.log(10)
+        return math.log10(1 + math.exp(z))
+
+
+    def suspects(self, now):
+        '''Return the peers that became suspected since the last call'''
+
+        found = []
+        for peer, state in self.peers.items():
+            if state.suspected or self.phi(peer, now) < self.threshold:
+                continue
+            state.suspected = True
+            self.suspicions += 1
+            self.detection_times.append(now - state.last)
+            found.append(peer)
+
+        return found
+
+
+    def stats(self):
+        '''Return suspicion counts and recent detection times in seconds'''
+
+        times = self.detection_times
+        return {
+            "suspicions"     : self.suspicions,
+            "false_positives": self.false_positives,
+            "detection_avg"  : sum(times) / len(times) if times else None,
+            "detection_max"  : max(times) if times else None
+        }
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Fingers.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 14, 2021
+#
+# Finger tables let a direct message skip most of the ring. Every node is
+# placed on a circle of identifiers by the hash of its username, and knows
+# the first node at or after each power of two past its own place. A
+# message for a user is passed to the known node closest before the user's
+# place, halving the distance left with each hop, so it arrives in
+# O(log N) hops instead of walking up to the whole ring
+
+import bisect
+import hashlib
+
+
+BITS = 64              # identifiers are BITS bit numbers
+SPACE = 1 << BITS
+
+
+def key(username):
+    ''' Return the place of a username on the identifier circle
+
+        - the same hash as Base_User.hash_data, cut down to BITS bits
+    '''
+
+    return int(hashlib.md5(username.encode('utf-8')).hexdigest(), 16) % SPACE
+
+
+def distance(start, end):
+    '''Distance going clockwise around the circle from start to end'''
+
+    return (end - start) % SPACE
+
+
+def build(members):
+    ''' Compute the finger table of every member
+
+        - members maps usernames to (ip, port)
+        - a table lists [key, ip, port] of each distinct finger, ordered by
+          distance from the member; the first is its successor
+
+        Return Values:
+        dictionary of username -> finger table
+    '''
+
+    ring = sorted((key(username), username) for username in members)
+    keys = [place for place, _ in ring]
+
+    tables = {}
+    for place, username in ring:
+        table = []
+        for i in range(BITS):
+            index = bisect.bisect_left(keys, (place + (1 << i)) % SPACE)
+            finger, name = ring[index % len(ring)]
+            if not table or table[-1][0] != finger:
+                ip, port = members[name]
+                table.append([finger, ip, port])
+        tables[username] = table
+
+    return tables
+
+
+def closest(own, table, target):
+    ''' Choose the finger a message for the node at target is passed to
+
+        - own is the key of the node holding the table
+        - the successor is returned when target lies between own and it,
+          or is own itself; it is then the node with that key, if any
+
+        Return Values:
+        (finger, True if the finger is the successor of target)
+    '''
+
+    def span(finger):
+        # a lone node is its own successor, a whole circle away
+        return distance(own, finger[0]) or SPACE
+
+    left = distance(own, target)
+    if left <= span(table[0]):
+        return (table[0], True)
+
+    best = table[0]
+    for finger in table:
+        if span(finger) >= left:
+            break
+        best = finger
+
+    return (best, False)
+
+
+def broadcast(own, table, limit):
+    ''' Split the part of the circle from own up to limit among fingers
+
+        - each finger is sent a message for the part from itself up to
+          the next finger, which it splits in turn; every node in the part
+          is reached exactly once, in O(log N) rounds
+        - a limit of own covers the whole circle
+
+        Return Values:
+        list of (finger, limit of the finger's part)
+    '''
+
+    end = distance(own, limit) or SPACE
+    inside = [finger for finger in table if 0 < distance(own, finger[0]) < end]
+
+    return [(finger, inside[i + 1][0] if i + 1 < len(inside) else limit)
+            for i, finger in enumerate(inside)]
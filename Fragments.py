@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Fragments.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 8, 2021
+#
+# The Reassembler class collects the fragments of messages that were too
+# large for a single datagram, and hands back the complete frame once
+# every fragment has arrived. Partial messages expire after a timeout and
+# the buffer as a whole is held under a memory cap
+
+import collections
+
+
+TIMEOUT = 5.0             # seconds a partial message is kept
+MAX_BYTES = 4 << 20       # memory cap for all partial messages
+
+
+class Reassembler:
+
+    def __init__(self, timeout=TIMEOUT, max_bytes=MAX_BYTES):
+        '''Constructor for Reassembler objects'''
+
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        # message id -> [first arrival, fragment count, {index: chunk}, bytes]
+        self.partial = collections.OrderedDict()
+
+
+    def add(self, fragment, now):
+        ''' Add a fragment to the buffer
+
+            Return Values:
+            the reassembled frame once every fragment has arrived,
+            otherwise None
+        '''
+
+        self.expire(now)
+
+        message_id = fragment['message_id']
+        entry = self.partial.get(message_id)
+        if entry is None:
+            entry = self.partial[message_id] = [now, fragment['count'], {}, 0]
+
+        chunks = entry[2]
+        if fragment['count'] != entry[1] or fragment['index'] in chunks:
+            # duplicate, or inconsistent with earlier fragments
+            return None
+
+        chunks[fragment['index']] = fragment['chunk']
+        entry[3] += len(fragment['chunk'])
+        self.size += len(fragment['chunk'])
+
+        if len(chunks) == entry[1]:
+            self.discard(message_id)
+            return b''.join(chunks[index] for index in range(entry[1]))
+
+        # drop the oldest partial messages to stay under the cap
+        while self.size > self.max_bytes and self.partial:
+            self.discard(next(iter(self.partial)))
+
+        return None
+
+
+    def expire(self, now):
+        '''Drop partial messages whose first fragment is older than the timeout'''
+
+        while self.partial:
+            message_id, entry = next(iter(self.partial.items()))
+            if now - entry[0] < self.timeout:
+                break
+            self.discard(message_id)
+
+
+    def discard(self, message_id):
+        '''Remove a partial message from the buffer'''
+
+        entry = self.partial.pop(message_id, None)
+        if entry is not None:
+            self.size -= entry[3]
+
+
+    def __len__(self):
+        return len(self.partial)
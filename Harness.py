@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Harness.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 21, 2021
+#
+# Harness.py holds the setup TestPerformance.py and Benchmarks.py share:
+# running a SuperUser and its users joined into one ring on the current
+# event loop, and standing in for the LoginServer while they run
+
+import Runtime
+import SuperUser
+import Transport
+import User
+
+import asyncio
+import contextlib
+import os
+import socket
+
+
+@contextlib.contextmanager
+def login_sink():
+    '''Stand in for the LoginServer with a socket that collects what nodes send it'''
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.setblocking(False)
+    login_server = Transport.LOGIN_SERVER
+    Transport.LOGIN_SERVER = sink.getsockname()
+    try:
+        yield sink
+    finally:
+        Transport.LOGIN_SERVER = login_server
+        sink.close()
+
+
+@contextlib.contextmanager
+def quiet():
+    ''' Run a benchmark with chat output silenced, since it would flood the
+        results, and with login_sink standing in for the LoginServer
+
+        Return Values:
+        the sink socket
+    '''
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            login_sink() as sink:
+        yield sink
+
+
+def run_quietly(measure, *args):
+    '''Run the coroutine measure(*args) on an event loop of its own, quietly'''
+
+    with quiet():
+        return asyncio.run(measure(*args))
+
+
+def skip_lookups(nodes):
+    ''' Have nodes route direct messages without looking addresses up,
+        since login_sink never answers
+    '''
+
+    for node in nodes:
+        node.locate = lambda username, now: None
+
+
+async def join_all(leader, users):
+    '''Ask the leader to splice in every user at once, and wait until it has'''
+
+    for usr in users:
+        Runtime.call(usr, usr.request_join, [leader.ip, leader.port])
+    while not all(usr.neighbors for usr in users):
+        await asyncio.sleep(.001)
+
+
+async def start_ring(members, prefix='member'):
+    ''' Run a SuperUser and its users on the current event loop, joined
+        into one ring
+
+        Return Values:
+        (leader, users, tasks) with the task serving each node, leader first
+    '''
+
+    leader = SuperUser.SuperUser()
+    users = [User.User(f'{prefix}{i}') for i in range(members)]
+    tasks = [asyncio.ensure_future(Runtime.serve(node)) for node in [leader] + users]
+    await asyncio.sleep(0)
+
+    await join_all(leader, users)
+    return (leader, users, tasks)
+
+
+def ring_complete(leader, users):
+    '''Determine if next_1 and prev pointers link the leader and users into one ring'''
+
+    nodes = {(node.ip, node.port): node for node in [leader] + users}
+    seen = set()
+    node = leader
+    while (node.ip, node.port) not in seen:
+        seen.add((node.ip, node.port))
+        following = nodes.get(tuple(node.neighbors.get('next_1') or ()))
+        if (following is None or
+                tuple(following.neighbors.get('prev') or ()) != (node.ip, node.port)):
+            return False
+        node = following
+
+    return node is leader and len(seen) == len(nodes)
+
+
+def stop_ring(tasks):
+    '''Stop serving the nodes of a ring, closing their sockets'''
+
+    for task in tasks:
+        task.cancel()
+
+
+def delay_datagrams(nodes, latency):
+    '''Hold every datagram a node receives for latency seconds, like a network would'''
+
+    loop = asyncio.get_running_loop()
+    for node in nodes:
+        def receive(data, addr, node=node, receive=node.receive_datagram):
+            loop.call_later(latency, Runtime.call, node, receive, data, addr)
+        node.receive_datagram = receive
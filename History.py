@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# History.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 3, 2021
+#
+# The History class records which messages a node has already displayed.
+# Instead of keeping every message id forever, it keeps a high-water mark
+# per sender plus a sliding bitmap of that sender's recent sequence numbers.
+# A low-water mark per sender marks where tracking began: ids below it were
+# never tracked (e.g. the sender was evicted and came back) and count as
+# unseen. Ids that slid out of the window count as seen, and are counted
+
+import collections
+import sys
+
+
+WINDOW = 1024             # recent sequence numbers tracked per sender
+MAX_BYTES = 1 << 20       # memory cap for the whole history
+LEGACY_LIMIT = 4096       # hashed ids kept for peers without message ids
+
+
+class History:
+
+    def __init__(self, window=WINDOW, max_bytes=MAX_BYTES,
+            legacy_limit=LEGACY_LIMIT):
+        '''Constructor for History objects'''
+
+        self.window = window
+        self.max_bytes = max_bytes
+        self.legacy_limit = legacy_limit
+
+        # node id -> [high-water mark, bitmap, low-water mark]; bit i marks
+        # high - i as seen, and nothing below the low-water mark is known
+        self.senders = collections.OrderedDict()
+        # hashed ids from peers that predate (node id, sequence) ids
+        self.legacy = collections.OrderedDict()
+
+        # approximate cost of tracking one sender
+        self.sender_bytes = (2 * sys.getsizeof(0) + window // 8 +
+                sys.getsizeof([0, 0, 0]) + sys.getsizeof((0, 0)) + 100)
+
+        # statistics
+        self.stale = 0      # lookups of ids that slid out of the window
+
+
+    def __contains__(self, message_id):
+        '''Determine if the message with the given id was already seen'''
+
+        if not isinstance(message_id, tuple):
+            return message_id in self.legacy
+
+        node_id, sequence = message_id
+        try:
+            high, bitmap, low = self.senders[node_id]
+        except KeyError:
+            return False
+
+        if sequence > high or sequence < low:
+            return False
+        if high - sequence >= self.window:
+            # slid out of the window; almost surely a duplicate
+            self.stale += 1
+            return True
+        return bool(bitmap >> (high - sequence) & 1)
+
+
+    def add(self, message_id):
+        '''Record the message with the given id as seen'''
+
+        if not isinstance(message_id, tuple):
+            self.legacy[message_id] = None
+            if len(self.legacy) > self.legacy_limit:
+                self.legacy.popitem(last=False)
+            return
+
+        node_id, sequence = message_id
+        try:
+            entry = self.senders[node_id]
+            self.senders.move_to_end(node_id)
+        except KeyError:
+            entry = self.senders[node_id] = [sequence, 0, sequence]
+            self.evict()
+
+        high, bitmap, low = entry
+        if sequence - high >= self.window:
+            # the whole window slid past, e.g. the sender restarted with
+            # its clock; shifting by the gap would build a huge integer
+            bitmap = 1
+            entry[0] = sequence
+        elif sequence > high:
+            # slide the window forward
+            bitmap = (bitmap << (sequence - high) | 1) & ((1 << self.window) - 1)
+            entry[0] = sequence
+        elif high - sequence < self.window:
+            bitmap |= 1 << (high - sequence)
+            # an earlier id arriving late extends what is tracked
+            entry[2] = min(low, sequence)
+        entry[1] = bitmap
+
+
+    def evict(self):
+        '''Forget the least recently active senders to stay under the cap'''
+
+        limit = max(1, self.max_bytes // self.sender_bytes)
+        while len(self.senders) > limit:
+            self.senders.popitem(last=False)
+
+
+    def __len__(self):
+        '''Number of senders being tracked'''
+
+        return len(self.senders) + len(self.legacy)
+
+
+    def entries(self):
+        '''Return the number of message ids still recorded as seen'''
+
+        return (sum(bin(bitmap).count('1') for _, bitmap, _ in self.senders.values())
+                + len(self.legacy))
+
+
+    def memory_usage(self):
+        '''Return the approximate number of bytes used by the history'''
+
+        total = sys.getsizeof(self.senders) + sys.getsizeof(self.legacy)
+        for node_id, entry in self.senders.items():
+            total += sys.getsizeof(node_id) + sys.getsizeof(entry)
+            total += sum(sys.getsizeof(value) for value in entry)
+        for message_id in self.legacy:
+            total += sys.getsizeof(message_id)
+
+        return total
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Locations.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 15, 2021
+#
+# The Locations class caches the addresses of users a node has sent direct
+# messages to, as looked up from the LoginServer. Entries expire after a
+# time to live, and the least recently used ones are dropped once the cache
+# is full, so a node only remembers the users it actually talks to
+
+import collections
+
+
+CAPACITY = 256         # usernames remembered
+TTL = 60.0             # seconds an address is trusted
+
+
+class Locations:
+
+    def __init__(self, capacity=CAPACITY, ttl=TTL):
+        '''Constructor for Locations objects'''
+
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # username -> (address, expiry)
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, username, now):
+        '''Return the cached address of a user, or None if unknown or expired'''
+
+        entry = self.entries.get(username)
+        if entry is None or entry[1] <= now:
+            if entry is not None:
+                del self.entries[username]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(username)
+        self.hits += 1
+        return entry[0]
+
+
+    def put(self, username, address, now):
+        '''Remember the address of a user for the next TTL seconds'''
+
+        self.entries[username] = (list(address), now + self.ttl)
+        self.entries.move_to_end(username)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+    def discard(self, username):
+        '''Forget the address of a user, if cached'''
+
+        self.entries.pop(username, None)
+
+
+    def __contains__(self, username):
+        return username in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
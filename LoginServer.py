@@ -4,23 +4,66 @@
 # Authors: Kristen Friday, Carlo Preciado
 # Date: November 2, 2021
 # 
-# This program runs the login server for the peer to peer chat room.
+# This program runs the login server for the peer to peer chat rooms.
 # This server listens for new Users wishing to connect, and forwards 
-# information about the SuperUser
+# information about the SuperUser of the room they asked for
 
 # Imports
 import socket
-import json 
 import sys
 import time
-import select
+import collections
+
+import Codec
+import Fingers
+import Metrics
+import Room
+import Transport
 
 # Global Variables:
-HOST = 'student10.cse.nd.edu'
-PORT = 9999
+# the LoginServer listens where nodes are told to log in
+HOST, PORT = Transport.LOGIN_SERVER
 BUFSIZ = 4096
 
 TIMEOUT = 0.1 
+# checkup replies from every user arrive at once
+RCVBUF = 1 << 20
+
+# membership is saved here at most every SNAPSHOT_INTERVAL seconds; rooms
+# other than the default one get LoginServer.<room>.snapshot
+SNAPSHOT = 'LoginServer.snapshot'
+SNAPSHOT_INTERVAL = 1.0
+
+# finger tables are recomputed at most every FINGER_INTERVAL seconds
+FINGER_INTERVAL = .1
+
+# users admitted within ADMIT_WINDOW seconds of a checkup sweep share it
+ADMIT_WINDOW = .5
+
+# joins handed to a leader within the last LOAD_WINDOW seconds measure its load
+LOAD_WINDOW = 1.0
+
+# room of users that do not ask for one
+DEFAULT_ROOM = 'main'
+
+# sockets and clock of the LoginServer; VirtualNetwork swaps in its own
+transport = Transport.UDP()
+
+# chat rooms, by name; each has its own SuperUser and users
+rooms = {}
+
+# requests that arrived during a checkup sweep, handled once it is over
+deferred = collections.deque()
+
+# counters and histograms, answered to 'stats' requests
+metrics = Metrics.Metrics('login_server')
+metrics.gauge('rooms', lambda: len(rooms))
+metrics.gauge('users', lambda: sum(len(room.registry) for room in rooms.values()))
+metrics.gauge('deferred', lambda: len(deferred))
+
+# users found dead within the last CRASH_MEMORY seconds; every crash alert
+# names all of them, in case an earlier alert was lost at another of them
+CRASH_MEMORY = 5.0
 
 
 def socket_bind():
@@ -32,12 +75,12 @@ def socket_bind():
         Failure: None type
     '''
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        s.bind((HOST,PORT))
+        s = transport.bind(HOST, PORT)
     except OSError:
-        print("Port 9999 is in use")
+        print(f"Port {PORT} is in use")
         sys.exit(-1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
 
     return s
 
@@ -55,188 +98,544 @@ def receive_request(server_socket):
     
     data, address = server_socket.recvfrom(BUFSIZ)
 
-    return {'request': data.decode('utf-8'), 'ip': address[0], 'port': int(address[1])}
+    return {'request': data, 'ip': address[0], 'port': int(address[1])}
+
+
+def add_room(name, leader):
+    '''Set up a chat room led by the SuperUser at leader'''
+
+    snapshot = SNAPSHOT if name == DEFAULT_ROOM else f'LoginServer.{name}.snapshot'
+    rooms[name] = Room.Room(name, leader, snapshot)
+
+    return rooms[name]
+
+
+def find_room(address):
+    '''Return the room whose leader or one of whose users is at (ip, port), or None'''
+
+    for room in rooms.values():
+        if room.has_address(address):
+            return room
+
+    return None
+
+
+def ring_wire(room):
+    '''Wire format that every node in the room's ring is able to decode'''
+
+    return 'json' if room.registry.json_users else 'binary'
+
+
+def send_wire(server_socket, room, wire):
+    '''Tell the leader and all users of a room which wire format to use'''
+
+    notice = Codec.encode({"purpose": "wire", "wire": wire}, 'json')
+    server_socket.sendto(notice, room.leader)
+    for key in room.registry:
+        server_socket.sendto(notice, room.registry[key])
+
+
+def remove_user(server_socket, room, username):
+    '''Remove a user, upgrading the ring once the last JSON-only user leaves'''
+
+    registry = room.registry
+    if username not in registry:
+        return
+
+    held_back = username in registry.json_users
+    metrics.count('removed', room.name)
+    room.leaders.pop(registry.remove(username), None)
+    send_moved(server_socket, room, username)
+    if held_back and not registry.json_users:
+        send_wire(server_socket, room, 'binary')
+
 
+def send_moved(server_socket, room, username):
+    '''Tell every node that looked up a user that its address is no longer valid'''
 
-def process_request(server_socket, data, leader_info, name_list):
+    notice = {"purpose": "location", "target": username, "address": None}
+    notice = Codec.encode(notice, ring_wire(room))
+    for address in room.watchers.pop(username, ()):
+        server_socket.sendto(notice, address)
+
+
+def send_location(server_socket, data, room, username):
+    ''' Answer a node's lookup of a user's address
+
+        - the address is None if the user is not in the chat room
+    '''
+
+    if username == 'super_user':
+        address = room.leader
+    else:
+        address = room.registry.by_name.get(username)
+
+    if address is not None:
+        room.watchers.setdefault(username, set()).add((data['ip'], data['port']))
+
+    reply = {"purpose": "location", "target": username,
+             "address": list(address) if address else None}
+    server_socket.sendto(Codec.encode(reply, ring_wire(room)),
+            (data['ip'], data['port']))
+
+
+def process_request(server_socket, data):
     '''
         Converts the decoded request into a json object
         and create an encoded json response
 
         Return Values:
-        (response, client IP, client port)
+        (response, client IP, client port, room), or None if there is no reply
 
         response will vary based on the success or failure of parsing the request
         Successful response: b'{host: ~~~, port: ~~~}'
 
     '''
     
-    # reassign the name_list
     try:
-        request = json.loads(data['request'])
-    except json.decoder.JSONDecodeError:
-        # invalid json; garbage request
-        return (None, name_list)
+        request, _ = Codec.decode(data['request'])
+    except ValueError:
+        # garbage request
+        return None
+
+    purpose = request.get('purpose')
+    metrics.count('received', purpose)
+    start = time.perf_counter()
+    try:
+        return handle_request(server_socket, data, request)
+    finally:
+        metrics.observe('handler_seconds', purpose, time.perf_counter() - start)
+
+
+def handle_request(server_socket, data, request):
+    '''Act on a decoded request; returns as process_request does'''
+
+    if request['purpose'] == 'connect':
+        return admit_user(server_socket, data, request)
+
+    # counters and histograms, for monitoring
+    if request['purpose'] == 'stats':
+        server_socket.sendto(Metrics.stats_reply(metrics),
+                (data['ip'], data['port']))
+        return None
+
+    # every other request comes from a node in one of the rooms
+    room = find_room((data['ip'], data['port']))
+    if room is None:
+        return None
    
     if request['purpose'] == 'checkup':
-        name_list, user_crash = check_on_users(server_socket, name_list, leader_info)
-        return (None, name_list)
+        check_on_users(server_socket, room)
+        return None
 
     if request['purpose'] == 'disconnect':
-        name_list.pop(request['username'])
-        return (None, name_list)
+        remove_user(server_socket, room, request['username'])
+        return None
 
     if request['purpose'] == 'checkup_res':
-        return (None, name_list)
+        return None
 
-    if request['purpose'] == 'connect':
-        if request['username'] in name_list or (request['ip'], request['port']) in name_list.values():
-            # send a request for a names list to the user
-            # if username in new name_list, respond with failure
-            message = {"status": "failure", "error": "un-unique" }
-            message = json.dumps(message).encode('utf-8')
+    # a node wants to send direct messages straight to a user
+    if request['purpose'] == 'locate':
+        send_location(server_socket, data, room, request['target'])
+        return None
 
-            return ((message, data['ip'], data['port']), name_list)
+    # a node's neighbor has gone quiet; check on that user alone
+    if request['purpose'] == 'suspect':
+        username = room.registry.username_at(request['suspect'])
+        if username is not None:
+            check_on_users(server_socket, room,
+                    {username: room.registry[username]})
+        return None
 
-        else:
-            # check that the system is fine before adding the user to the system
-            name_list, user_crash = check_on_users(server_socket, name_list, leader_info)
-            if user_crash:
-                message = {"status": "failure", "error": "server_down"}
-                message = json.dumps(message).encode('utf-8')
-                return ((message, data['ip'], data['port']), name_list)
-                
-            name_list[request['username']] = (request['ip'], request['port'])
-
-    leader_ip, leader_port = leader_info
-    
-    message = {"status": "success", "leader": (leader_ip, leader_port)}
-    message = json.dumps(message).encode('utf-8')
+    # a node found crashed users next to each other, which the ring
+    # cannot bridge
+    if request['purpose'] == 'total_failure':
+        print(f"Ring of {room.name} cannot be repaired")
+        send_total_failure(server_socket, room)
+        return None
+
+    return None
 
-    return ((message, data['ip'], data['port']), name_list)
+
+def admit_user(server_socket, data, request):
+    ''' Register a user in the room it asked for
+
+        - users that do not name a room join DEFAULT_ROOM
+        - usernames are unique within a room, addresses across rooms
+
+        Return Values:
+        (response, client IP, client port, room)
+    '''
+
+    room = rooms.get(request.get('room', DEFAULT_ROOM))
+    if room is None:
+        # no SuperUser leads a room of that name
+        message = {"status": "failure", "error": "no_room"}
+        metrics.count('rejected', 'no_room')
+        message = Codec.encode(message, 'json')
+        return (message, data['ip'], data['port'], room)
+
+    registry = room.registry
+    location = (request['ip'], request['port'])
+    if request['username'] in registry or find_room(location) is not None:
+        # if username or location is taken, respond with failure
+        message = {"status": "failure", "error": "un-unique" }
+        metrics.count('rejected', 'un-unique')
+        message = Codec.encode(message, 'json')
+
+        return (message, data['ip'], data['port'], room)
+
+    # check that the system is fine before adding the user to the system;
+    # a burst of logins is covered by one sweep
+    if (transport.time() - room.checked >= ADMIT_WINDOW and
+            check_on_users(server_socket, room)):
+        message = {"status": "failure", "error": "server_down"}
+        metrics.count('rejected', 'server_down')
+        message = Codec.encode(message, 'json')
+        return (message, data['ip'], data['port'], room)
+
+    # users that do not advertise binary support hold the ring to JSON
+    wire = 'binary' if 'binary' in request.get('wire', []) else 'json'
+    if wire == 'json' and not registry.json_users:
+        send_wire(server_socket, room, 'json')
+
+    registry.add(request['username'], location, wire)
+    metrics.count('admitted', room.name)
+
+    # a user back at a crashed user's name or address must not be
+    # cut out of the ring by a later alert
+    for key, (address, _) in list(room.recent_crashes.items()):
+        if key == request['username'] or address == location:
+            del room.recent_crashes[key]
+
+    # the reply stays JSON; the user learns the ring's format from it
+    message = {"status": "success", "leader": choose_leader(room),
+               "wire": ring_wire(room)}
+    if request.get('lead'):
+        # counted busy with its own join, since joins handed to it wait
+        # until it is in the ring itself
+        room.leaders[location] = collections.deque([transport.time()])
+    message = Codec.encode(message, 'json')
+
+    return (message, data['ip'], data['port'], room)
      
 
-def send_response(server_socket, response_package, name_list, leader_info):
+def choose_leader(room):
+    ''' Pick the leader that splices a new user of a room into its ring
+
+        - the leader handed the fewest joins in the last LOAD_WINDOW
+          seconds is picked, the SuperUser on a tie
+        - leaders splice users in right after themselves, so joins at
+          different leaders go ahead side by side
+    '''
+
+    now = transport.time()
+    for joins in room.leaders.values():
+        while joins and joins[0] < now - LOAD_WINDOW:
+            joins.popleft()
+
+    leader = min(room.leaders, key=lambda address: len(room.leaders[address]))
+    room.leaders[leader].append(now)
+
+    return leader
+
+
+def send_response(server_socket, response_package):
     '''
         Simply sends the response back to the client 
     '''
-    message, ip, port = response_package
+    message, ip, port, room = response_package
     server_socket.sendto(message, (ip, port))
-    status = json.loads(message.decode('utf-8'))['status']
-    if status == 'failure':
-        check_on_users(server_socket, name_list, leader_info)
+    status = Codec.decode(message)[0]['status']
+    if status == 'failure' and room is not None:
+        check_on_users(server_socket, room)
 
 
-def send_alert(username, user_info, server_socket, leader_info):
-    ''' Send a crash alert to the super user
-        - figure out which node in the system crashed
+def send_alert(crashed, server_socket, room):
+    ''' Send a crash alert to the super user of a room
+        - crashed lists [username, (ip, port)] of every user recently
+          found dead; the alert repairs them all on one pass around the
+          ring, and repairs already made are left as they are
     '''
 
+    username, user_info = crashed[0]
     json_req = {
         "purpose" : "crash",
         "username": username,
         "info"    : user_info,
-        "status"  : "dirty"
+        "status"  : "dirty",
+        "crashed" : crashed
     }
 
-    req = json.dumps(json_req)
-    encoded_req = req.encode('utf-8')
-    server_socket.sendto(encoded_req, leader_info) 
+    server_socket.sendto(Codec.encode(json_req, ring_wire(room)), room.leader)
 
-    print(f"{username} has crashed")
 
+def send_total_failure(server_socket, room):
+    '''Tell every node of a room its ring cannot be repaired and forget all its users'''
+
+    failure = Codec.encode({"purpose": "total_failure"}, ring_wire(room))
+    server_socket.sendto(failure, room.leader)
+    for key in room.registry:
+        server_socket.sendto(failure, room.registry[key])
+
+    room.registry.clear()
+    room.recent_crashes.clear()
+    room.watchers.clear()
+    room.leaders = {room.leader: collections.deque()}
+
+
+def send_fingers(server_socket, room):
+    ''' Recompute the finger table of every node of a room and send those
+        that changed
+
+        - the SuperUser is placed on the circle like any user
+        - rings held to JSON walk direct messages around the ring, so no
+          tables are sent; all of them are sent again once it upgrades
+    '''
+
+    if ring_wire(room) == 'json':
+        room.fingers.clear()
+        return
+
+    members = dict(room.registry.by_name)
+    members['super_user'] = room.leader
+
+    tables = Fingers.build(members)
+    for username, table in tables.items():
+        if room.fingers.get(username) != table:
+            update = Codec.encode({"purpose": "fingers", "fingers": table})
+            server_socket.sendto(update, members[username])
+
+    room.fingers.clear()
+    room.fingers.update(tables)
+
+
+def probe_users(server_socket, users, wire='binary', everyone=True):
+    ''' Send a checkup to every user at once and gather the replies
+
+        - users maps usernames to (ip, port)
+        - wire is the format of the users' ring
+        - everyone is False when users are only some of the room's users
+        - replies are matched by the address they came from, and all of
+          them must arrive before a single deadline TIMEOUT away
+        - any other request that arrives meanwhile is deferred, as are
+          replies from users that were not probed, and requests for a
+          sweep unless this one covers everyone
+
+        Return Values:
+        list of usernames that did not answer
+    '''
+
+    probe = Codec.encode({"purpose": "checkup"}, wire)
+    waiting = {}
+    for key in users:
+        server_socket.sendto(probe, users[key])
+        waiting[tuple(users[key])] = key
+    probed = set(waiting)
+
+    deadline = transport.time() + TIMEOUT
+    while waiting:
+        remaining = deadline - transport.time()
+        if remaining <= 0:
+            break
+
+        if not transport.wait(server_socket, remaining):
+            break
+
+        data = receive_request(server_socket)
+        address = (data['ip'], data['port'])
+        # anything from a probed user shows it is alive
+        waiting.pop(address, None)
 
-def check_on_users(server_socket, name_list, leader_info):
-    '''Poll users in system to check if still alive'''
-    
-    # temporarily set a timeout to recieve
-    user_crash = False
-    total_failure = False
-    server_socket.settimeout(TIMEOUT)
-    name_to_remove = ""
-
-    for key in name_list:
-        server_socket.sendto(json.dumps(
-            {"purpose": "checkup"}).encode('utf-8'), name_list[key])
         try:
-            data = server_socket.recv(BUFSIZ)
-        except socket.timeout:
-            # user has already crashed; total failure
-            if user_crash:
-                total_failure = True
-                break
-
-            # send a disconnection alert and remove the username
-            send_alert(key, name_list[key], server_socket, leader_info)
-            name_to_remove = key
-            user_crash = True
-    
-    # set the time back
-    server_socket.settimeout(None)
-
-    if total_failure:
-        failure = json.dumps({"purpose": "total_failure"}).encode('utf-8')
-        server_socket.sendto(failure, leader_info)
-        for key in name_list:
-            server_socket.sendto(failure, name_list[key])
-        name_list = {}
-    else:
-        # remove unresponsive nodes
-        if name_to_remove != "":
-            name_list.pop(name_to_remove)
+            request, _ = Codec.decode(data['request'])
+            purpose = request.get('purpose')
+        except (ValueError, AttributeError):
+            continue
+
+        # replies to this sweep are consumed here; so are requests for
+        # another sweep, if this one covers them
+        if purpose == 'checkup_res' and address in probed:
+            continue
+        if purpose == 'checkup' and everyone:
+            continue
+        deferred.append(data)
+
+    return list(waiting.values())
 
-    return (name_list, user_crash)
 
+def check_on_users(server_socket, room, users=None):
+    ''' Poll users in a room to check if still alive
 
-def run_server(leader_info):
+        - users limits the poll to some users, by default it covers all
+
+        Return Values:
+        list of the usernames of every user that did not answer
+    '''
+
+    registry = room.registry
+    recent_crashes = room.recent_crashes
+    if users is None:
+        room.checked = transport.time()
+        metrics.count('sweeps', room.name)
+    crashed = probe_users(server_socket, registry if users is None else users,
+            ring_wire(room), users is None)
+    if not crashed:
+        return crashed
+    metrics.count('crashes', room.name, len(crashed))
+
+    # users that only speak JSON can repair a single crash at a time
+    if len(crashed) > 1 and ring_wire(room) == 'json':
+        for key in crashed:
+            print(f"{key} has crashed")
+        send_total_failure(server_socket, room)
+        return crashed
+
+    now = transport.time()
+    for key in crashed:
+        print(f"{key} has crashed")
+        recent_crashes[key] = (registry[key], now)
+        recent_crashes.move_to_end(key)
+    while next(iter(recent_crashes.values()))[1] < now - CRASH_MEMORY:
+        recent_crashes.popitem(last=False)
+
+    # send a disconnection alert and remove the usernames
+    send_alert([[key, address] for key, (address, _) in recent_crashes.items()],
+            server_socket, room)
+    for key in crashed:
+        remove_user(server_socket, room, key)
+
+    return crashed
+
+
+def tend_rooms(server_socket):
+    ''' Save the membership and send finger tables of rooms that are due
+
+        - rooms without a snapshot file are not saved
+
+        Return Values:
+        time the next room is due, or None if none is
+    '''
+
+    deadlines = []
+    for room in rooms.values():
+        registry = room.registry
+
+        # save membership changes once they have settled for a moment
+        if room.snapshot is not None and registry.dirty:
+            if transport.time() - room.saved >= SNAPSHOT_INTERVAL:
+                registry.save(room.snapshot, room.leader)
+                metrics.count('snapshots', room.name)
+                room.saved = transport.time()
+            else:
+                deadlines.append(room.saved + SNAPSHOT_INTERVAL)
+
+        # a burst of joins or crashes is covered by one round of tables
+        if registry.version != room.routed:
+            if transport.time() - room.routed_at >= FINGER_INTERVAL:
+                send_fingers(server_socket, room)
+                metrics.count('finger_rounds', room.name)
+                room.routed, room.routed_at = registry.version, transport.time()
+            else:
+                deadlines.append(room.routed_at + FINGER_INTERVAL)
+
+    return min(deadlines) if deadlines else None
+
+
+def serve_request(server_socket, data):
+    '''Process a request and send the reply, if there is one'''
+
+    response_package = process_request(server_socket, data)
+    if response_package is not None:
+        send_response(server_socket, response_package)
+
+
+def run_server(leaders):
     '''
         Listen for incoming Users
+
+        - leaders maps each room name to the (ip, port) of its SuperUser
     '''
     
     # create a new listening socket 
     server_socket = socket_bind()
 
-    # create a list of names
-    name_list = {}
+    for name, leader in leaders.items():
+        room = add_room(name, leader)
+
+        # recover the users of a previous run, dropping any that left meanwhile
+        if room.registry.load(room.snapshot, room.leader):
+            print(f'Recovered {len(room.registry)} users of {name} from {room.snapshot}')
+            check_on_users(server_socket, room)
+        room.saved = transport.time()
 
     # main while loop to listen for client requests
     _, port = server_socket.getsockname()
     print(f'LoginServer listening on port {port}...')
+    printed = None
     while True:
-        rlist, _, _ = select.select([server_socket], [], [])
-        if rlist:
-            data  = receive_request(server_socket) 
-            response_package, name_list = process_request(
-                    server_socket, 
-                    data, 
-                    leader_info, 
-                    name_list
-                )
-
-            print('Users in Chat Room: ', end='')
-            print(name_list)
-
-            if response_package == None:
-                continue
-            send_response(server_socket, response_package, name_list, leader_info)
+        deadline = tend_rooms(server_socket)
+
+        # requests held back by a checkup sweep come first
+        if deferred:
+            data = deferred.popleft()
         else:
-            check_on_users(server_socket, name_list, leader_info)
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - transport.time())
+            if not transport.wait(server_socket, timeout):
+                continue
+            data = receive_request(server_socket)
+
+        serve_request(server_socket, data)
+
+        # membership is printed when it changes; the rest is in the metrics
+        versions = [room.registry.version for room in rooms.values()]
+        if versions != printed:
+            print('Users in Chat Rooms: ', end='')
+            print(list(rooms.values()))
+            printed = versions
         
 
 def usage():
 
     print('Usage: [SUPERHOST_IP] [SUPERPORT]')
+    print('       [ROOM=SUPERHOST_IP:SUPERPORT] ...')
+    print('       [--login=HOST:PORT] [--metrics=PORT]')
     sys.exit(0)
 
 
 def main():
-    
-    if len(sys.argv) != 3:
+
+    global transport, HOST, PORT
+
+    # --login=HOST:PORT listens there instead of at LOGIN_SERVER (Transport.py)
+    transport = Transport.configure()
+    HOST, PORT = transport.login_server
+
+    # --metrics=PORT serves the LoginServer's metrics as Prometheus text
+    Metrics.export_option(metrics)
+
+    # a single SuperUser leads the default room
+    if len(sys.argv) == 3 and '=' not in sys.argv[1]:
+        run_server({DEFAULT_ROOM: (sys.argv[1], int(sys.argv[2]))})
+        return
+
+    leaders = {}
+    for arg in sys.argv[1:]:
+        try:
+            name, address = arg.split('=')
+            host, port = address.rsplit(':', 1)
+            leaders[name] = (host, int(port))
+        except ValueError:
+            usage()
+
+    if not leaders:
         usage()
 
-    run_server((sys.argv[1], int(sys.argv[2])))
+    run_server(leaders)
 
 
 if __name__ == "__main__":
     main()
-
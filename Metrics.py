@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+# Metrics.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 19, 2021
+#
+# The Metrics class keeps the counters and histograms of one node or of the
+# LoginServer: requests in and out by purpose, handler latency,
+# retransmissions, joins, crashes and so on. Recording is a dictionary
+# update and only one in SAMPLE requests is timed, cheap enough to leave
+# on; table sizes are read only when the metrics are asked for
+#
+# Metrics are asked for with a 'stats' request, answered with 'stats_res',
+# and can also be served as Prometheus text over HTTP on a local port
+#
+# Usage: ./Metrics.py HOST PORT asks a node or the LoginServer for its stats
+
+import bisect
+import collections
+import http.server
+import json
+import socket
+import sys
+import threading
+
+import Codec
+
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025,
+           .005, .01, .025, .05, .1)
+SAMPLE = 16            # one in SAMPLE handled requests is timed
+
+
+class Metrics:
+
+    def __init__(self, name):
+        '''Constructor for Metrics objects'''
+
+        self.name = name
+        # (metric, label) -> count
+        self.counters = collections.defaultdict(int)
+        # (metric, label) -> [count per bucket, the last one unbounded; sum]
+        self.histograms = {}
+        # metric -> function returning its current value
+        self.gauges = {}
+        self.handled = 0
+
+
+    def count(self, metric, label=None, amount=1):
+        '''Add amount to a counter'''
+
+        self.counters[(metric, label)] += amount
+
+
+    def datagram(self, direction, size):
+        '''Count a datagram of size bytes sent ('out') or received ('in')'''
+
+        counters = self.counters
+        counters[('datagrams_' + direction, None)] += 1
+        counters[('bytes_' + direction, None)] += size
+
+
+    def request(self, purpose):
+        ''' Count a request handled
+
+            Return Values:
+            True if its handler is to be timed
+        '''
+
+        self.counters[('received', purpose)] += 1
+        self.handled += 1
+        return self.handled % SAMPLE == 0
+
+
+    def observe(self, metric, label, value):
+        '''Record a value, e.g. a latency in seconds, in a histogram'''
+
+        histogram = self.histograms.get((metric, label))
+        if histogram is None:
+            histogram = self.histograms[(metric, label)] = [[0] * (len(BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(BUCKETS, value)] += 1
+        histogram[1] += value
+
+
+    def gauge(self, metric, read):
+        ''' Report the value read() returns whenever the metrics are asked for
+
+            - None stands for nothing measured yet
+        '''
+
+        self.gauges[metric] = read
+
+
+    def snapshot(self):
+        ''' Return every metric as a dictionary that can be sent as JSON
+
+            - counters and histograms are grouped by metric, then label
+        '''
+
+        counters = {}
+        for (metric, label), value in list(self.counters.items()):
+            counters.setdefault(metric, {})[str(label)] = value
+
+        histograms = {}
+        for (metric, label), (buckets, total) in list(self.histograms.items()):
+            histograms.setdefault(metric, {})[str(label)] = {
+                "buckets": list(buckets),
+                "count"  : sum(buckets),
+                "sum"    : total
+            }
+
+        return {
+            "name"      : self.name,
+            "counters"  : counters,
+            "gauges"    : {metric: read() for metric, read in list(self.gauges.items())},
+            "histograms": histograms,
+            "bounds"    : list(BUCKETS)
+        }
+
+
+    def prometheus(self):
+        '''Return every metric in the Prometheus text format'''
+
+        stats = self.snapshot()
+        node = stats["name"]
+        lines = []
+
+        for metric, values in sorted(stats["counters"].items()):
+            lines.append(f'# TYPE chat_{metric}_total counter')
+            for label, value in sorted(values.items()):
+                lines.append(f'chat_{metric}_total{labels(node, label)} {value}')
+
+        for metric, value in sorted(stats["gauges"].items()):
+            if value is None:
+                # nothing measured yet
+                continue
+            lines.append(f'# TYPE chat_{metric} gauge')
+            lines.append(f'chat_{metric}{labels(node)} {value}')
+
+        for metric, values in sorted(stats["histograms"].items()):
+            lines.append(f'# TYPE chat_{metric} histogram')
+            for label, histogram in sorted(values.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f'chat_{metric}_bucket'
+                            f'{labels(node, label, le=bound)} {cumulative}')
+                lines.append(f'chat_{metric}_sum{labels(node, label)} {histogram["sum"]}')
+                lines.append(f'chat_{metric}_count{labels(node, label)} {histogram["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def labels(node, label='None', le=None):
+    '''Format the labels of a Prometheus sample'''
+
+    pairs = [f'node="{node}"']
+    if label != 'None':
+        pairs.append(f'label="{label}"')
+    if le is not None:
+        pairs.append(f'le="{le}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+
+def serve_http(metrics, port, host='127.0.0.1'):
+    ''' Serve metrics as Prometheus text on a local port, on a thread of its own
+
+        - raises OSError if the port is taken
+    '''
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            # scrapes would otherwise be printed among the chat
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def export_option(metrics):
+    ''' Serve metrics over HTTP if --metrics=PORT is on the command line
+
+        - the option is removed from sys.argv
+    '''
+
+    for arg in list(sys.argv[1:]):
+        if arg.startswith('--metrics='):
+            sys.argv.remove(arg)
+            port = int(arg.split('=', 1)[1])
+            serve_http(metrics, port)
+            print(f'Metrics served on http://127.0.0.1:{port}/metrics')
+
+
+def stats_reply(metrics):
+    '''Encode the answer to a stats request'''
+
+    return Codec.encode({"purpose": "stats_res", "stats": metrics.snapshot()},
+            'json')
+
+
+def query(address, timeout=1.0):
+    ''' Ask a node or the LoginServer at address for its metrics
+
+        Return Values:
+        dictionary of its metrics, or None if it did not answer in time
+    '''
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        sock.sendto(Codec.encode({"purpose": "stats"}, 'json'), address)
+        while True:
+            data, _ = sock.recvfrom(1 << 16)
+            reply, _ = Codec.decode(data)
+            if reply.get('purpose') == 'stats_res':
+                return reply['stats']
+    except (socket.timeout, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+def main():
+
+    if len(sys.argv) != 3:
+        print('Usage: ./Metrics.py HOST PORT')
+        sys.exit(0)
+
+    stats = query((sys.argv[1], int(sys.argv[2])))
+    if stats is None:
+        print('No answer')
+        sys.exit(1)
+
+    print(json.dumps(stats, indent=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Pending.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 5, 2021
+#
+# The PendingTable class holds the messages a node has seen but not yet
+# displayed, in arrival order. Messages sent by the node itself also get a
+# retransmission deadline, kept in a heap so a timeout check only touches
+# the entries that have actually expired
+
+import collections
+import heapq
+import itertools
+
+
+class PendingEntry:
+
+    __slots__ = ('state', 'request', 'owner', 'time', 'sent', 'deadline',
+                 'attempts')
+
+    def __init__(self, state, request, owner, time, deadline=None):
+        '''Constructor for PendingEntry objects'''
+
+        self.state = state          # 'dirty' until the message returns
+        self.request = request
+        self.owner = owner          # username of the original sender
+        self.time = time            # when the entry was added
+        self.sent = False           # LoginServer was asked for a checkup
+        self.deadline = deadline    # retransmission deadline, if timed
+        self.attempts = 0           # times the message was resent
+
+
+class PendingTable:
+
+    def __init__(self):
+        '''Constructor for PendingTable objects'''
+
+        self.entries = collections.OrderedDict()
+        self.deadlines = []         # heap of (deadline, tiebreak, message id)
+        self.counter = itertools.count()
+
+
+    def add(self, message_id, state, request, owner, time, deadline=None):
+        ''' Add an entry to the end of the table
+
+            - entries with a deadline are returned by expired() once
+              the deadline passes
+        '''
+
+        entry = PendingEntry(state, request, owner, time)
+        self.entries[message_id] = entry
+        if deadline is not None:
+            self.schedule(message_id, deadline)
+
+        return entry
+
+
+    def schedule(self, message_id, deadline):
+        '''Set the retransmission deadline of an entry'''
+
+        self.entries[message_id].deadline = deadline
+        heapq.heappush(self.deadlines,
+                (deadline, next(self.counter), message_id))
+
+        # drop stale heap records once they outnumber the live entries
+        if len(self.deadlines) > 2 * len(self.entries) + 64:
+            self.deadlines = [(entry.deadline, next(self.counter), key)
+                    for key, entry in self.entries.items()
+                    if entry.deadline is not None]
+            heapq.heapify(self.deadlines)
+
+
+    def unschedule(self, message_id):
+        '''Stop timing an entry, which stays in the table until it is popped'''
+
+        self.entries[message_id].deadline = None
+
+
+    def expired(self, now):
+        ''' Yield (message id, entry) for every entry whose deadline passed
+
+            - an expired entry is no longer timed until it is rescheduled
+        '''
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, message_id = heapq.heappop(self.deadlines)
+            entry = self.entries.get(message_id)
+            # skip records left behind by popped or rescheduled entries
+            if entry is None or entry.deadline != deadline:
+                continue
+            entry.deadline = None
+            yield (message_id, entry)
+
+
+    def next_deadline(self):
+        '''Return the earliest retransmission deadline, or None'''
+
+        while self.deadlines:
+            deadline, _, message_id = self.deadlines[0]
+            entry = self.entries.get(message_id)
+            if entry is not None and entry.deadline == deadline:
+                return deadline
+            heapq.heappop(self.deadlines)
+
+        return None
+
+
+    def head(self):
+        '''Return (message id, entry) of the oldest entry, or None'''
+
+        for item in self.entries.items():
+            return item
+
+        return None
+
+
+    def pop(self, message_id, *default):
+        '''Remove and return an entry'''
+
+        return self.entries.pop(message_id, *default)
+
+
+    def clear(self):
+        '''Remove all entries'''
+
+        self.entries.clear()
+        self.deadlines = []
+
+
+    def __getitem__(self, message_id):
+        return self.entries[message_id]
+
+
+    def __contains__(self, message_id):
+        return message_id in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __iter__(self):
+        return iter(self.entries)
+
+
+    def items(self):
+        return self.entries.items()
+
+
+    def values(self):
+        return self.entries.values()
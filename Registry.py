@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Registry.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 12, 2021
+#
+# The Registry class holds the users known to the LoginServer. Users are
+# indexed both by username and by address, so either uniqueness check is a
+# single lookup, and the membership can be saved to a compact snapshot file
+# that a restarted LoginServer loads instead of waiting for users to rejoin
+
+import json
+import os
+
+
+class Registry:
+
+    def __init__(self):
+        '''Constructor for Registry objects'''
+
+        self.by_name = {}           # username -> (ip, port)
+        self.by_address = {}        # (ip, port) -> username
+        self.json_users = set()     # usernames that only decode JSON frames
+        self.dirty = False          # changed since the last snapshot
+        self.version = 0            # bumped on every change
+
+
+    def add(self, username, address, wire='binary'):
+        ''' Register a user under its username and address
+
+            - raises KeyError if either is already taken
+        '''
+
+        address = tuple(address)
+        if username in self.by_name or address in self.by_address:
+            raise KeyError(username)
+
+        self.by_name[username] = address
+        self.by_address[address] = username
+        if wire == 'json':
+            self.json_users.add(username)
+        self.dirty = True
+        self.version += 1
+
+
+    def remove(self, username):
+        '''Unregister a user, returning its address'''
+
+        address = self.by_name.pop(username)
+        del self.by_address[address]
+        self.json_users.discard(username)
+        self.dirty = True
+        self.version += 1
+
+        return address
+
+
+    def clear(self):
+        '''Unregister every user'''
+
+        self.by_name.clear()
+        self.by_address.clear()
+        self.json_users.clear()
+        self.dirty = True
+        self.version += 1
+
+
+    def has_address(self, address):
+        '''Determine if a user is registered at the given (ip, port)'''
+
+        return tuple(address) in self.by_address
+
+
+    def username_at(self, address):
+        '''Return the username registered at the given (ip, port), or None'''
+
+        return self.by_address.get(tuple(address))
+
+
+    def save(self, path, leader):
+        ''' Write the membership to a snapshot file
+
+            - the file is replaced in one step, so a crash while saving
+              leaves the previous snapshot intact
+        '''
+
+        snapshot = {
+            "leader": list(leader),
+            "users" : [[username, ip, port,
+                        'json' if username in self.json_users else 'binary']
+                    for username, (ip, port) in self.by_name.items()]
+        }
+
+        temp = f'{path}.tmp'
+        with open(temp, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(temp, path)
+        self.dirty = False
+
+
+    def load(self, path, leader):
+        ''' Read the membership from a snapshot file
+
+            - snapshots taken under another leader describe another ring
+              and are ignored
+
+            Return Values:
+            True if users were loaded
+        '''
+
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if snapshot.get("leader") != list(leader):
+            return False
+
+        self.clear()
+        for username, ip, port, wire in snapshot["users"]:
+            self.add(username, (ip, port), wire)
+        self.dirty = False
+
+        return True
+
+
+    def __contains__(self, username):
+        return username in self.by_name
+
+
+    def __getitem__(self, username):
+        return self.by_name[username]
+
+
+    def __iter__(self):
+        return iter(self.by_name)
+
+
+    def __len__(self):
+        return len(self.by_name)
+
+
+    def __repr__(self):
+        return repr(self.by_name)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Room.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 16, 2021
+#
+# The Room class holds what the LoginServer knows about one chat room:
+# the SuperUser leading its ring and the users in it. Rooms are independent
+# rings, each with its own leader, order of messages and membership, so
+# they can run on different hosts and carry traffic side by side
+
+import collections
+
+import Registry
+
+
+class Room:
+
+    def __init__(self, name, leader, snapshot):
+        '''Constructor for Room objects'''
+
+        self.name = name
+        self.leader = tuple(leader)     # (ip, port) of the room's SuperUser
+        self.registry = Registry.Registry()
+        self.snapshot = snapshot        # file the membership is saved to
+
+        # nodes that splice new users into the ring: the SuperUser and
+        # users started as leaders, by (ip, port) -> times joins were
+        # handed to them lately
+        self.leaders = {self.leader: collections.deque()}
+
+        # finger table last sent to each node, by username
+        self.fingers = {}
+        # addresses of the nodes that looked up each username
+        self.watchers = {}
+        # users found dead recently, by username -> ((ip, port), time)
+        self.recent_crashes = collections.OrderedDict()
+
+        # when every user was last checked on
+        self.checked = 0
+
+        # when the membership was last saved, and the registry version
+        # finger tables were last sent for
+        self.saved = 0
+        self.routed = None
+        self.routed_at = 0
+
+
+    def has_address(self, address):
+        '''Determine if the leader or a user of the room is at (ip, port)'''
+
+        return tuple(address) == self.leader or self.registry.has_address(address)
+
+
+    def __repr__(self):
+        return f'{self.name}: {self.registry!r}'
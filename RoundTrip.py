@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# RoundTrip.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 20, 2021
+#
+# The RoundTrip class estimates how long a node's globals take to come back
+# to it, from the laps of its own globals, and turns that into the timeout
+# of a retransmission. The estimate follows TCP's: a smoothed round trip
+# plus four times its smoothed deviation, so a 3 node ring on one host
+# retransmits within milliseconds while a 300 node ring waits its lap out.
+# Each retransmission of a message doubles its timeout, with some jitter so
+# nodes that lost messages at the same moment do not resend in step, and
+# the estimate itself backs off while first sends keep timing out: resent
+# globals are not measured, so laps grown under load would otherwise never
+# be learned. A single lost message does not back it off, and the next
+# clean lap measured resets it
+
+import random
+
+
+ALPHA = 1 / 8          # weight of a new sample in the smoothed round trip
+BETA = 1 / 4           # weight of a new sample in the smoothed deviation
+K = 4                  # deviations added to the round trip
+MIN_RTO = .1           # bounds of the retransmission timeout, in seconds
+MAX_RTO = 2.0
+JITTER = .25           # a backed off timeout is stretched by up to this much
+RETRIES = 6            # retransmissions before the next hop is suspected
+BACKOFF_AFTER = 2      # first sends timed out since the last lap before
+                       # the timeout backs off
+
+
+class RoundTrip:
+
+    def __init__(self, initial, seed=None):
+        ''' Constructor for RoundTrip objects
+
+            - initial is the timeout used until a lap has been measured
+        '''
+
+        self.srtt = None            # smoothed round trip, in seconds
+        self.rttvar = None          # smoothed deviation of the round trip
+        self.estimate = initial     # timeout following from the laps
+        self.rto = initial          # the estimate, backed off while
+                                    # messages time out
+        self.backed_off = None      # when the timeout was last backed off
+        self.timeouts = 0           # first sends timed out since the last lap
+        self.random = random.Random(seed)
+
+        # statistics
+        self.samples = 0
+
+
+    def sample(self, rtt):
+        ''' Fold a measured round trip into the estimate
+
+            - only messages that were never retransmitted are measured,
+              since a returning copy of a resent one could be either
+        '''
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += ALPHA * (rtt - self.srtt)
+
+        self.estimate = min(MAX_RTO, max(MIN_RTO, self.srtt + K * self.rttvar))
+        self.rto = self.estimate
+        self.backed_off = None
+        self.timeouts = 0
+        self.samples += 1
+
+
+    def expired(self, now, attempts=0):
+        ''' Back off the timeout after a message sent attempts times timed out
+
+            - only first sends count, since resends back off on their own;
+              once BACKOFF_AFTER have timed out without a lap measured in
+              between, the lap has likely outgrown the timeout
+            - it doubles at most once per timeout, however many messages
+              timed out together, until a lap is measured again
+        '''
+
+        if attempts:
+            return
+        self.timeouts += 1
+        if self.timeouts < BACKOFF_AFTER:
+            return
+
+        if self.backed_off is None or now - self.backed_off >= self.rto:
+            self.rto = min(MAX_RTO, self.rto * 2)
+            self.backed_off = now
+
+
+    def timeout(self, attempts=0):
+        ''' Return how long to wait for a message sent attempts times before
+
+            - the first send waits the current timeout; each resend waits
+              twice as long as the one before it would have from the
+              estimate, and no less than the current timeout, up to MAX_RTO
+        '''
+
+        if not attempts:
+            return self.rto
+
+        backoff = self.estimate * (1 << min(attempts, 16))
+        backoff = min(MAX_RTO, max(self.rto, backoff))
+        return backoff * (1 + JITTER * self.random.random())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Runtime.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 10, 2021
+#
+# Runtime runs chat nodes on an asyncio event loop. Datagrams and typed
+# input are handled as they arrive, and timeout checks are scheduled for
+# exactly when the next one is due instead of polling every TIMEOUT.
+# Any number of nodes can share one loop, e.g. for testing
+
+import asyncio
+import sys
+
+
+class NodeProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, node):
+        '''Constructor for NodeProtocol objects'''
+
+        self.node = node
+        node.runtime = self
+        self.loop = asyncio.get_running_loop()
+        self.timer = None
+        self.closed = self.loop.create_future()
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.rearm()
+
+
+    def datagram_received(self, data, addr):
+        self.node.receive_datagram(data, addr)
+        self.rearm()
+
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable after sending to a crashed user;
+        # crash detection works from timeouts instead
+        pass
+
+
+    def connection_lost(self, exc):
+        if self.timer is not None:
+            self.timer.cancel()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+    def input_ready(self):
+        '''Handle a line typed by the user'''
+
+        line = sys.stdin.readline()
+        if not line:
+            # end of input
+            self.loop.remove_reader(sys.stdin)
+            return
+
+        self.node.handle_input(line)
+        self.rearm()
+
+
+    def rearm(self):
+        '''Schedule the timeout check for when the next deadline is due'''
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        deadline = self.node.next_deadline()
+        if deadline is not None:
+            delay = max(0, deadline - self.node.clock())
+            self.timer = self.loop.call_later(delay, self.tick)
+
+
+    def tick(self):
+        self.timer = None
+        self.node.check_timeouts()
+        self.rearm()
+
+
+def call(node, method, *args):
+    ''' Call a method of a running node from outside its callbacks
+
+        - the node's timeout checks are rescheduled afterwards, since the
+          call may have queued frames or retransmissions
+    '''
+
+    result = method(*args)
+    node.runtime.rearm()
+    return result
+
+
+async def serve(node, stdin=False):
+    ''' Run a node until its socket is closed
+
+        - stdin makes the node read typed input as well
+    '''
+
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+            lambda: NodeProtocol(node), sock=node.sock)
+    if stdin:
+        loop.add_reader(sys.stdin, protocol.input_ready)
+
+    try:
+        await protocol.closed
+    finally:
+        if stdin:
+            loop.remove_reader(sys.stdin)
+        transport.close()
+
+
+async def serve_all(nodes):
+    '''Run several nodes on the same event loop'''
+
+    await asyncio.gather(*(serve(node) for node in nodes))
+
+
+def run(node):
+    '''Run a single node with typed input until it exits'''
+
+    asyncio.run(serve(node, stdin=True))
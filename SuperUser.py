@@ -8,146 +8,269 @@
 # chat system to allow for new User entry
 
 import Base_User
+import Fingers
+import Metrics
+import Runtime
+import Transport
 
-import socket
-import json
-import time
-import hashlib
-import queue
 import select
 import sys
 import collections
 
-LOGIN_SERVER = ('student10.cse.nd.edu', 9999)
-BYTES = 1024
-TIMEOUT = .5
-
 
 class SuperUser(Base_User.Base_User):
    
-    def __init__(self):
-        super().__init__()
+    def __init__(self, spread='ring', transport=None):
+        super().__init__(transport)
         self.username = 'super_user'
+        self.spread = spread
+        self.leader = [self.ip, self.port]
+        # globals fanned out recently, by order number, to answer resends
+        # and requests for missing ones
+        self.spread_log = collections.OrderedDict()
+        self.spread_orders = {}     # message id -> order number
+        # next order number to stamp on a global message
+        self.next_stamp = 0
+        self.next_order = 0
+        # order numbers given to fragmented globals, by message id
+        self.fragment_orders = collections.OrderedDict()
+        # node id of the sender of each global stamped lately, by order
+        # number, and of senders reported crashed; only their order
+        # numbers are ever skipped
+        self.stamped = collections.OrderedDict()
+        self.lost = collections.OrderedDict()
+
+
+    def join_order(self):
+        ''' First order number a user spliced in after the SuperUser sees
+
+            - every global stamped so far has already been passed on
+        '''
+
+        return self.next_stamp
+
+
+    def sequence_global(self, request):
+        ''' Stamp a global message with its place in the total order
+
+            - a retransmitted message keeps the order it was first given
+            - rings held to JSON for older peers keep stop-and-wait ordering
+        '''
+
+        if self.wire == 'json' or 'order' in request:
+            return False
+
+        message_id = self.message_key(request)
+        if message_id in self.pending_table:
+            stamped = self.pending_table[message_id].request
+            if 'order' in stamped:
+                request['order'] = stamped['order']
+                return True
+
+        request['order'] = self.stamp(message_id)
+        return True
+
+
+    def stamp(self, message_id):
+        '''Return the next order number, noting the sender it was given to'''
+
+        order = self.next_stamp
+        self.next_stamp += 1
+        self.stamped[order] = message_id[0]
+        if len(self.stamped) > Base_User.WINDOW * 32:
+            self.stamped.popitem(last=False)
+
+        return order
+
+
+    def sequence_fragment(self, fragment):
+        ''' Stamp a fragment of a global message with its place in the total order
+
+            - every fragment of a message gets the same order number
+        '''
+
+        if 'order' in fragment:
+            return False
+
+        message_id = fragment['message_id']
+        if message_id not in self.fragment_orders:
+            self.fragment_orders[message_id] = self.stamp(message_id)
+            if len(self.fragment_orders) > Base_User.WINDOW * 32:
+                self.fragment_orders.popitem(last=False)
+
+        fragment['order'] = self.fragment_orders[message_id]
+        return True
+
+
+    def handle_global(self, request, sender, data=None, relayed=False):
+        '''Stamp and fan out globals sent to the SuperUser for that'''
+
+        if request.get("spread") == "tree" and "limit" not in request:
+            self.spread_global(request, sender)
+            return
+
+        super().handle_global(request, sender, data, relayed)
+
+
+    def spread_global(self, request, sender):
+        ''' Stamp a global with its place in the total order and send it
+            down the tree formed by the finger tables
+
+            - a resent global is answered with the copy stamped the first
+              time, to its sender alone
+        '''
+
+        message_id = self.message_key(request)
+        if message_id in self.spread_orders:
+            self.resend_spread(self.spread_orders[message_id], sender)
+            return
+
+        if not self.sequence_global(request):
+            return
+
+        order = request['order']
+        self.spread_orders[message_id] = order
+        self.spread_log[order] = request
+        if len(self.spread_log) > Base_User.WINDOW * 32:
+            _, oldest = self.spread_log.popitem(last=False)
+            del self.spread_orders[self.message_key(oldest)]
+
+        # the SuperUser's part is the whole circle
+        request['limit'] = Fingers.key(self.username)
+        self.handle_spread(request)
+
+
+    def resend_spread(self, order, address):
+        '''Send a node the copy of a fanned out global it is missing'''
+
+        if order in self.spread_log:
+            self.send(dict(self.spread_log[order], limit=None), address,
+                    batch=True)
+
 
     def add_users(self, req):
-        '''Method to listen for incoming clients and add to chat system'''
+        '''A user back at a crashed user's address sends globals again'''
 
-        location = [req["ip"], req["port"]]
-        new_next = [self.ip, self.port]
-        new_next_next = None
+        self.lost.pop(Base_User.node_id_of(req["ip"], req["port"]), None)
+        super().add_users(req)
 
-        leader = [self.ip, self.port]
-        # if other users, inform the next user
-        if "next_1" in self.neighbors:
-            new_next = self.neighbors["next_1"]
 
-            update = {
-                "purpose": "update_pointers",
-                "prev": location
-            }
+    def handle_crash(self, request):
+        '''Note the crashed users, whose stamped globals will never be acknowledged'''
 
-            # attempt 5 retries to get next neighbor
-            count = 0
-            while True:
-                if count >= 5:
-                    print("SuperUser: Unable to retrieve next neighbor")
-                    return
+        for _, (ip, port) in request.get('crashed',
+                [[request['username'], request['info']]]):
+            self.lost[Base_User.node_id_of(ip, port)] = None
+            if len(self.lost) > Base_User.WINDOW * 32:
+                self.lost.popitem(last=False)
 
-                update_enc = json.dumps(update).encode('utf-8')
+        super().handle_crash(request)
 
-                # request current next's next neighbor
-                self.sock.sendto(update_enc, tuple(self.neighbors["next_1"]))
-                up_res = self.sock.recv(BYTES)
-                json_up_res = json.loads(up_res.decode('utf-8'))
 
-                if ("status" in json_up_res and json_up_res["status"] == "success"):
-                    new_next_next = json_up_res["curr_next"]
-                    break
+    def skippable(self):
+        ''' Determine if the missing order number was given to a global
+            whose sender crashed
 
-                count += 1
-            
-            count = 0
-            # inform last node in ring that it must update next_2
-            update = {
-                "purpose": "update_last_node",
-                "next_2": location
-            }
-            while True:
-                if count >= 5:
-                    return
-
-                update_enc = json.dumps(update).encode('utf-8')
-                self.sock.sendto(update_enc, tuple(self.neighbors["prev"]))
-                up_res, _ = self.sock.recvfrom(BYTES)
-                json_up_res = json.loads(up_res.decode('utf-8'))
-                if ("status" in json_up_res and json_up_res["status"] == "success"):
-                    break
-                count += 1
-
-            self.neighbors["next_2"] = self.neighbors["next_1"]
-            
-        # update next pointers
-        self.neighbors["next_1"] = location
-        if "prev" not in self.neighbors:
-            self.neighbors["prev"] = location
-
-        json_res = {
-            "status": "success",
-            "next_1": new_next,
-            "next_2": new_next_next
-        }
+            - an acknowledgement may take longer than GAP_TIMEOUT to come
+              around a long ring, so the order number of a sender that is
+              alive is waited for; its sender resends it if it was lost
+            - an order number stamped too long ago to be remembered is
+              skipped as before
+        '''
+
+        if self.gap_since is None:
+            return False
+
+        sender = self.stamped.get(self.next_order)
+        return sender is None or sender in self.lost
+
+
+    def next_deadline(self):
+        '''Include the time a missing order number is due to be skipped'''
+
+        deadline = super().next_deadline()
+        if self.skippable():
+            skip = self.gap_since + Base_User.GAP_TIMEOUT
+            if deadline is None or skip < deadline:
+                deadline = skip
+
+        return deadline
+
+
+    def check_timeouts(self):
+        ''' Handle retransmissions, and skip order numbers of lost messages
+
+            - a global that was stamped but never acknowledged (its sender
+              crashed) would otherwise hold back every later global
+        '''
 
-        res = json.dumps(json_res).encode('utf-8')
-        print(f'Added User {req["username"]}')
-        self.sock.sendto(res, tuple(location))
+        super().check_timeouts()
+
+        if (not self.skippable() or
+                self.clock() - self.gap_since < Base_User.GAP_TIMEOUT):
+            return
+
+        skip = {
+            "username"  : self.username,
+            "purpose"   : "global_response",
+            "message_id": None,
+            "order"     : self.next_order
+        }
+        self.deliver(None, self.next_order)
+        if 'prev' in self.neighbors:
+            self.send(skip, self.neighbors['prev'])
 
     
-    def receive_message(self):
+    def process_request(self, request, data, addr):
         ''' Process incoming messages according to their purpose '''
-        
-        # main listening loop
-        data, addr = self.sock.recvfrom(BYTES)
-        decoded_data = data.decode('utf-8')
-        try:
-            request = json.loads(decoded_data)
-        except json.decoder.JSONDecodeError:
-            # invalid json; garbage request
-            return
 
-        purpose = request['purpose']
+        purpose = request.get('purpose')
        
         # process the request accordingly
         if purpose == 'global':
-            self.handle_global(request, addr)
+            self.handle_global(request, addr, data)
             
         elif purpose == 'global_response':
-            # display the message
-            self.display(request['message_id'])
-
-            if request['username'] == self.username:
-                # check for additional acknowledged messages in pending
-                if self.pending_table:
-                    first_val = list(self.pending_table.values())[0]
-                    if first_val[0] == "clean":
-                        self.handle_global(first_val[1], [self.ip, self.port])
-
-                # stop forwarding the acknowledgement along
-                return
-            else:
-                # move along the acknowledgement
-                self.sock.sendto(data, tuple(self.neighbors['prev']))
+            self.handle_global_response(request, data)
         
         elif purpose == 'dm_response':
             # put private message into display queue
             self.display(request['message_id'])
 
+        # reply to a pointer update of a join in progress; older users
+        # answer with the purpose of the update itself
+        elif (purpose == "update_pointers_res" or
+                (purpose == "update_pointers" and "status" in request)):
+            self.handle_join_response(request, addr)
+
         # update pointers for a new node
         elif (purpose == "update_pointers" or purpose == "update_last_node"):
             self.update_pointers(purpose, request, addr)
         
+        # neighbor is alive; the detector has already noted it
+        elif (purpose == "heartbeat"):
+            self.handle_heartbeat(request, addr)
+
+        # finger table for routing direct messages
+        elif (purpose == "fingers"):
+            self.handle_fingers(request)
+
+        # address of a user to send direct messages to
+        elif (purpose == "location"):
+            self.handle_location(request)
+
         # direct message
         elif (purpose == "direct"):
-            self.handle_direct(request, addr)
+            self.handle_direct(request, addr, data)
+
+        # piece of a message too large for one datagram
+        elif (purpose == "fragment"):
+            self.handle_fragment(request, addr, data)
+
+        # fanned out globals never reached a node
+        elif (purpose == "missing"):
+            for order in request['orders']:
+                self.resend_spread(order, addr)
 
         elif (purpose == "connect"):
             self.add_users(request)
@@ -156,13 +279,21 @@ class SuperUser(Base_User.Base_User):
             self.handle_disconnect(request)
 
         elif (purpose == "checkup"):
-            self.sock.sendto(json.dumps({"status":"ok"}).encode('utf-8'), LOGIN_SERVER)
+            self.send({"status":"ok"}, self.login_server)
+
+        elif (purpose == "wire"):
+            # a peer in the ring only speaks this format
+            self.wire = request["wire"]
         
         elif (purpose == "crash"):
             self.handle_crash(request)
 
         elif (purpose == "total_failure"):
             self.neighbors = {}
+
+        # counters and histograms, for monitoring
+        elif (purpose == "stats"):
+            self.send_stats(addr)
         
         else:
             print(f"Unknown purpose: {purpose}")
@@ -174,48 +305,38 @@ class SuperUser(Base_User.Base_User):
         print(f'SuperUser: Listening on port {self.port}...')
         while True:
 
-            rlist, _, _ = select.select([sys.stdin, self.sock], [], [], TIMEOUT)
+            rlist, _, _ = select.select(
+                    [sys.stdin, self.sock], [], [], self.next_timeout())
 
             # user entered input
             for read_s in rlist:
                 # read input
                 if read_s == sys.stdin:
-                    self.send_message(sys.stdin.readline())
+                    self.handle_input(sys.stdin.readline())
 
                 # read incoming messages
                 else:
                     self.receive_message()
 			
-            # check if there have been timeouts for a message at top of pending queue
-            if not self.pending_table:
-                continue
-
-            for idx, value in enumerate(list(self.pending_table.values())):
-                req = value[1]
-                name = value[2]
-                user_time = value[3]
-                sent = value[4]
-    
-                if time.time() - user_time > TIMEOUT and name == self.username:
-                    if sent == False:
-                        # it's this users responsibility to prompt the checkins
-                        # tell the login server to check for timeouts
-                        self.sock.sendto(json.dumps(
-                            {"purpose":"checkup"}).encode('utf-8'), LOGIN_SERVER)
-                        self.pending_table[
-                                list(self.pending_table.keys())[idx]][4] = True
-                    else:
-                        try:
-                            self.sock.sendto(json.dumps(req)
-                                    .encode('utf-8'),tuple(self.neighbors['next_1']))  
-                        except KeyError:
-                            print('No other users in the chat room')
-                            self.pending_table = collections.OrderedDict()
-               
+            # check if there have been timeouts for messages sent by this user
+            self.check_timeouts()
 
 if __name__ == '__main__':
 
-    super_usr = SuperUser()
+    # --tree fans globals out along the finger tables instead of sending
+    # them around the ring; --metrics=PORT serves the SuperUser's metrics
+    # as Prometheus text on that local port; --bind=IP[:PORT] and
+    # --login=HOST:PORT set the SuperUser's address and the LoginServer's
+    transport = Transport.configure()
+    super_usr = SuperUser('tree' if '--tree' in sys.argv else 'ring',
+            transport)
     super_usr.print_user()
-    super_usr.listen()
+    Metrics.export_option(super_usr.metrics)
+
+    # the select loop is kept as a fallback for the asyncio runtime
+    if '--select' in sys.argv:
+        super_usr.listen()
+    else:
+        print(f'SuperUser: Listening on port {super_usr.port}...')
+        Runtime.run(super_usr)
  
@@ -17,17 +17,18 @@ def test_direct(usr):
     
     usr.direct_message("super_user", "test direct message")
     # receive response
-    usr.receive_message()
+    while usr.check_pending():
+        usr.poll()
 
 
 def test_global(usr):
     '''Test functionality of global messaging'''
     
     usr.send_message("test global message")
-    # receive original message
-    usr.receive_message()
-    # receive global response
-    usr.receive_message()
+    # receive original message, once it has been delivered in order
+    message_id = (usr.node_id, usr.sequence)
+    while message_id not in usr.history_table:
+        usr.poll()
 
 
 def main():
@@ -42,7 +43,7 @@ def main():
     start = time.time()
     while time.time() - start < 4:
 
-        rlist, _, _ = select.select(socks, [], [], 1)
+        rlist, _, _ = select.select(socks, [], [], usr1.next_timeout())
 
         # user entered input
         for read_s in rlist:
@@ -59,6 +60,9 @@ def main():
             else:
                 usr1.receive_message()
 
+        # acknowledgements, heartbeats and retransmissions
+        usr1.check_timeouts()
+
     usr1.disconnect()
 
 
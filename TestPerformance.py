@@ -7,11 +7,39 @@
 # TestPerformance.py evaluates the latency and throughput of message delivery
 
 # NOTE ABOUT PERFORMANCE:
-#   *** Comment out line 408 in Base_User.py to remove all print statements***
+#   *** Comment out the print statement in Base_User.display to remove all print statements***
 #   *** Will yield the most accurate performance results ***
 
 
+import Base_User
 import User
+import SuperUser
+import LoginServer
+import Codec
+import FailureDetector
+import Fingers
+import History
+import Metrics
+import Pending
+import Registry
+import Room
+import RoundTrip
+import Runtime
+import Transport
+import VirtualNetwork
+import Harness
+
+import asyncio
+import collections
+import multiprocessing
+import os
+import random
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 
 
@@ -24,7 +52,9 @@ def test_direct(usr):
 
     while elapsed <= 3000000000:
         usr.direct_message("super_user", f"test message {count}")
-        usr.receive_message()
+        # receive response
+        while usr.check_pending():
+            usr.poll()
         count += 1
         elapsed = time.time_ns() - start
 
@@ -44,10 +74,10 @@ def test_global(usr):
 
     while elapsed <= 3000000000:
         usr.send_message(f"test message {count}")
-        # receive original
-        usr.receive_message()
-        # receive response
-        usr.receive_message()
+        # receive original, once it has been delivered in order
+        message_id = (usr.node_id, usr.sequence)
+        while message_id not in usr.history_table:
+            usr.poll()
         count += 1
         elapsed = time.time_ns() - start
 
@@ -58,9 +88,1145 @@ def test_global(usr):
     print(f"Latency (avg time/op): {(elapsed / count):.0f} nanoseconds/op\n")
 
 
+def test_pending(outstanding=10000, ticks=1000):
+    '''Measure the per-tick cost of timeout checks with many pending messages'''
+
+    timeout = Base_User.TIMEOUT
+    start = time.time()
+    # deadlines spread evenly over one timeout window
+    step = timeout / outstanding
+
+    # previous approach: scan every pending entry on every tick
+    table = collections.OrderedDict()
+    for i in range(outstanding):
+        table[i] = ['dirty', {}, 'test_user', start + i * step - timeout, True]
+
+    begin = time.perf_counter_ns()
+    for tick in range(ticks):
+        now = start + tick * timeout / ticks
+        for idx, value in enumerate(list(table.values())):
+            if now - value[3] > timeout and value[2] == 'test_user':
+                value[3] = now
+    scan_ns = (time.perf_counter_ns() - begin) / ticks
+
+    # deadline heap: only expired entries are touched
+    table = Pending.PendingTable()
+    for i in range(outstanding):
+        table.add(i, 'dirty', {}, 'test_user', start, start + i * step)
+
+    expired = 0
+    begin = time.perf_counter_ns()
+    for tick in range(ticks):
+        now = start + tick * timeout / ticks
+        for message_id, entry in table.expired(now):
+            table.schedule(message_id, now + timeout)
+            expired += 1
+    heap_ns = (time.perf_counter_ns() - begin) / ticks
+
+    print(f"\nPerformance of Timeout Checks ({outstanding} pending):")
+    print(f"Ticks:                 {ticks} ticks")
+    print(f"Expired per tick:      {expired / ticks:.1f} entries")
+    print(f"Full scan (avg/tick):  {scan_ns:.0f} nanoseconds/tick")
+    print(f"Deadline heap (avg):   {heap_ns:.0f} nanoseconds/tick\n")
+
+
+async def measure_joins(members, joiners, interval):
+    ''' Run a SuperUser and its users on one event loop, then time a burst
+        of concurrent joins while every member keeps sending globals
+    '''
+
+    leader, ring, tasks = await Harness.start_ring(members)
+
+    # chat traffic from every member until the joins are done
+    sent = 0
+    joining = True
+    async def chat():
+        nonlocal sent
+        while joining:
+            for usr in ring:
+                Runtime.call(usr, usr.send_message, f'test message {sent}')
+                sent += 1
+            await asyncio.sleep(interval)
+
+    traffic = asyncio.ensure_future(chat())
+    await asyncio.sleep(.1)
+
+    new_users = [User.User(f'joiner{i}') for i in range(joiners)]
+    tasks += [asyncio.ensure_future(Runtime.serve(usr)) for usr in new_users]
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    sent_before = sent
+    await Harness.join_all(leader, new_users)
+    elapsed = time.perf_counter() - start
+    chatted = sent - sent_before
+
+    joining = False
+    await traffic
+    # let the last globals make it around the grown ring
+    await asyncio.sleep(1)
+
+    complete = Harness.ring_complete(leader, ring + new_users)
+    unconfirmed = sum(len(usr.in_flight) + len(usr.outbox) for usr in ring)
+
+    Harness.stop_ring(tasks)
+    await asyncio.sleep(0)
+
+    return (elapsed, chatted, complete, unconfirmed)
+
+
+def test_joins(members=8, joiners=50, interval=.01):
+    '''Measure how many users can join per second under active chat traffic'''
+
+    elapsed, chatted, complete, unconfirmed = Harness.run_quietly(measure_joins,
+            members, joiners, interval)
+
+    print(f"\nPerformance of Joins ({members} members chatting):")
+    print(f"Elapsed Time:          {elapsed:.3f} seconds")
+    print(f"Total Joins:           {joiners} joins")
+    print(f"Joins per second:      {joiners / elapsed:.0f} joins/second")
+    print(f"Globals sent meanwhile:{chatted:>6} messages")
+    print(f"Unconfirmed globals:   {unconfirmed} messages")
+    print(f"Ring complete:         {complete}\n")
+
+
+async def measure_leaders(members, joiners, count, latency):
+    ''' Run a ring with count leaders on one event loop, the SuperUser and
+        the others spread around the ring, and time a burst of joins each
+        handed to the leader the LoginServer picks
+    '''
+
+    leader, ring, tasks = await Harness.start_ring(members)
+
+    leaders = [leader] + [ring[i * members // count] for i in range(1, count)]
+    room = Room.Room('bench', (leader.ip, leader.port), None)
+    for node in leaders[1:]:
+        node.lead = True
+        room.leaders[(node.ip, node.port)] = collections.deque()
+
+    new_users = [User.User(f'joiner{i}') for i in range(joiners)]
+    tasks += [asyncio.ensure_future(Runtime.serve(usr)) for usr in new_users]
+    await asyncio.sleep(0)
+    # each join waits on round trips to its leader's neighbors
+    Harness.delay_datagrams([leader] + ring + new_users, latency)
+
+    start = time.perf_counter()
+    for usr in new_users:
+        Runtime.call(usr, usr.request_join, list(LoginServer.choose_leader(room)))
+    while not all(usr.neighbors for usr in new_users):
+        await asyncio.sleep(.001)
+    elapsed = time.perf_counter() - start
+
+    # let the last pointer updates settle
+    await asyncio.sleep(.1 + 4 * latency)
+    complete = Harness.ring_complete(leader, ring + new_users)
+    spliced = [node.spliced for node in leaders]
+
+    Harness.stop_ring(tasks)
+    await asyncio.sleep(0)
+
+    return (elapsed, complete, spliced)
+
+
+def test_leaders(counts=(1, 2, 4), members=8, joiners=100, latency=.002):
+    ''' Measure join throughput of a burst of joins spread over several leaders
+
+        - latency is added to every datagram, since joins at one leader
+          are held up by round trips rather than by processing
+    '''
+
+    results = [(count, Harness.run_quietly(measure_leaders, members, joiners, count,
+            latency)) for count in counts]
+
+    print(f"\nPerformance of Joins by Leaders ({members} members, "
+          f"{joiners} joins at once, {latency * 1000:.0f} ms latency):")
+    for count, (elapsed, complete, spliced) in results:
+        print(f"{count} leaders:  {joiners / elapsed:6.0f} joins/second   "
+              f"spliced by each: {spliced}   ring complete: {complete}")
+    print()
+
+
+async def measure_batches(members, joiners, latency):
+    ''' Run a SuperUser and its users on one event loop and time a burst
+        of joins, as spliced into the ring by the SuperUser
+    '''
+
+    leader, ring, tasks = await Harness.start_ring(members)
+    splices = leader.join_count
+
+    new_users = [User.User(f'joiner{i}') for i in range(joiners)]
+    tasks += [asyncio.ensure_future(Runtime.serve(usr)) for usr in new_users]
+    await asyncio.sleep(0)
+    Harness.delay_datagrams([leader] + ring + new_users, latency)
+
+    start = time.perf_counter()
+    await Harness.join_all(leader, new_users)
+    elapsed = time.perf_counter() - start
+
+    await asyncio.sleep(.1 + 4 * latency)
+    complete = Harness.ring_complete(leader, ring + new_users)
+    splices = leader.join_count - splices
+
+    Harness.stop_ring(tasks)
+    await asyncio.sleep(0)
+
+    return (elapsed, complete, splices)
+
+
+def test_batches(sizes=(1, Base_User.JOIN_BATCH), members=8, joiners=200,
+        latency=.002):
+    ''' Compare join throughput of a burst of joins spliced in one user at
+        a time and in chains of up to JOIN_BATCH users
+    '''
+
+    results = []
+    batch = Base_User.JOIN_BATCH
+    for size in sizes:
+        Base_User.JOIN_BATCH = size
+        try:
+            results.append((size, Harness.run_quietly(measure_batches, members,
+                    joiners, latency)))
+        finally:
+            Base_User.JOIN_BATCH = batch
+
+    print(f"\nPerformance of Batched Joins ({members} members, "
+          f"{joiners} joins at once, {latency * 1000:.0f} ms latency):")
+    for size, (elapsed, complete, splices) in results:
+        print(f"up to {size:3} users per splice:  {joiners / elapsed:6.0f} joins/second   "
+              f"{splices:4} splices   ring complete: {complete}")
+    print()
+
+
+def simulate(members, spread, latency, bandwidth):
+    ''' Run a SuperUser, the LoginServer and members Users on a virtual
+        network, and time how long a global takes to reach everyone
+
+        Return Values:
+        (virtual seconds to log everyone in, virtual seconds for the
+         global, datagrams sent, wall clock seconds)
+    '''
+
+    begin = time.perf_counter()
+    network = VirtualNetwork.VirtualNetwork(latency=latency, bandwidth=bandwidth)
+    leader = SuperUser.SuperUser(spread, transport=network)
+    network.serve_node(leader)
+    with network.serve_login({LoginServer.DEFAULT_ROOM: (leader.ip, leader.port)}):
+        users = [User.User(f'member{i}', transport=network) for i in range(members)]
+        network.join(users)
+        joined = network.now
+
+        # let finger tables reach everyone
+        network.run(network.now + 1)
+        sent = network.sent
+        start = network.now
+        network.call(users[0], users[0].send_message, 'test message')
+        network.run(network.now + 60,
+                lambda: all(len(usr.history_table) for usr in [leader] + users[1:]))
+
+        return (joined, network.now - start, network.sent - sent,
+                time.perf_counter() - begin)
+
+
+def test_simulate(sizes=(100, 1000), latency=.001, bandwidth=12.5e6):
+    ''' Log in and chat in rooms of up to 1000 users, all in this process,
+        on a virtual network with latency and limited bandwidth
+    '''
+
+    results = []
+    with Harness.quiet():
+        for members in sizes:
+            for spread in ('ring', 'tree'):
+                results.append((members, spread,
+                        simulate(members, spread, latency, bandwidth)))
+
+    print(f"\nSimulated Chat Rooms ({latency * 1000:.0f} ms latency, "
+          f"{bandwidth * 8 / 1e6:.0f} Mbit/s links, virtual time):")
+    for members, spread, (joined, spread_time, sent, wall) in results:
+        print(f"{members:5} users, {spread}:  logged in after {joined:6.2f} s   "
+              f"global reached everyone in {spread_time * 1000:7.1f} ms "
+              f"({sent} datagrams)   simulated in {wall:5.1f} s")
+    print()
+
+
+class FixedRoundTrip(RoundTrip.RoundTrip):
+    '''Retransmission timeouts of TIMEOUT, as before laps were measured'''
+
+    def sample(self, rtt):
+        pass
+
+    def expired(self, now, attempts=0):
+        pass
+
+    def timeout(self, attempts=0):
+        return Base_User.TIMEOUT
+
+
+def measure_backoff(members, senders, messages, interval, latency, loss, adaptive):
+    ''' Have senders users of a ring on a virtual network send messages
+        globals each, one every interval seconds, with some datagrams lost
+
+        Return Values:
+        (virtual seconds until every global came back, retransmissions,
+         datagrams sent, final timeout of the first sender)
+    '''
+
+    network = VirtualNetwork.VirtualNetwork(latency=latency, seed=members)
+    leader = SuperUser.SuperUser(transport=network)
+    network.serve_node(leader)
+    with network.serve_login({LoginServer.DEFAULT_ROOM: (leader.ip, leader.port)}):
+        users = [User.User(f'member{i}', transport=network) for i in range(members)]
+        network.join(users)
+        network.run(network.now + 1)
+        nodes = [leader] + users
+        if not adaptive:
+            for node in nodes:
+                node.round_trip = FixedRoundTrip(Base_User.TIMEOUT)
+
+        network.loss = loss
+        sent = network.sent
+        start = network.now
+        sending = users[:senders]
+        for usr in sending:
+            for i in range(messages):
+                network.schedule(start + i * interval, network.call, usr,
+                        usr.send_message, f'message {i}')
+        last = start + (messages - 1) * interval
+        network.run(last + 300, lambda: network.now > last and
+                not any(usr.in_flight or usr.outbox for usr in sending))
+
+        retransmits = sum(value for node in nodes
+                for (metric, _), value in node.metrics.counters.items()
+                if metric == 'retransmits')
+
+        return (network.now - start, retransmits, network.sent - sent,
+                sending[0].round_trip.timeout())
+
+
+def test_backoff(sizes=(10, 300), senders=10, messages=20, interval=.25,
+        latency=.002, loss=.0002):
+    ''' Compare fixed and adaptive retransmission timeouts in rings of
+        different sizes on a virtual network that loses datagrams
+    '''
+
+    results = []
+    with Harness.quiet():
+        for members in sizes:
+            for adaptive in (False, True):
+                results.append((members, adaptive, measure_backoff(members,
+                        senders, messages, interval, latency, loss, adaptive)))
+
+    print(f"\nRetransmissions ({senders} senders x {messages} globals, one every "
+          f"{interval * 1000:.0f} ms, {latency * 1000:.0f} ms latency, "
+          f"{loss * 100:.2f}% loss, virtual time):")
+    for members, adaptive, (elapsed, retransmits, sent, rto) in results:
+        kind = 'adaptive' if adaptive else 'fixed   '
+        print(f"{members:4} users, {kind}:  done in {elapsed:6.2f} s   "
+              f"{retransmits:6} retransmissions   {sent:7} datagrams   "
+              f"timeout {rto * 1000:6.1f} ms")
+    print()
+
+
+def display_orders(members, latency, delay):
+    ''' Have the user right after the SuperUser send a global, and the one
+        right before it another delay seconds later, in a ring on a virtual
+        network
+
+        Return Values:
+        {order the two globals were displayed in: nodes displaying them so}
+    '''
+
+    network = VirtualNetwork.VirtualNetwork(latency=latency)
+    leader = SuperUser.SuperUser(transport=network)
+    network.serve_node(leader)
+    with network.serve_login({LoginServer.DEFAULT_ROOM: (leader.ip, leader.port)}):
+        users = [User.User(f'member{i}', transport=network) for i in range(members)]
+        network.join(users)
+        network.run(network.now + 1)
+
+        nodes = [leader] + users
+        shown = {node.username: [] for node in nodes}
+        for node in nodes:
+            def display(message_id, node=node, display=node.display):
+                if (message_id in node.pending_table and
+                        message_id not in node.history_table):
+                    shown[node.username].append(
+                            node.pending_table[message_id].request['message'])
+                display(message_id)
+            node.display = display
+
+        # users are spliced in right after the SuperUser, so the last one's
+        # global and its acknowledgement each go around the whole ring before
+        # the SuperUser delivers it
+        start = network.now
+        network.schedule(start, network.call, users[-1], users[-1].send_message, 'far')
+        network.schedule(start + delay, network.call, users[0],
+                users[0].send_message, 'near')
+        network.run(start + 30, lambda: all(len(seen) == 2 for seen in shown.values()))
+
+        orders = collections.Counter(tuple(seen) for seen in shown.values())
+        return dict(orders)
+
+
+def test_order(members=400, latency=.002, delays=(.5, .7, .95)):
+    ''' Check that every node displays globals in the same order when an
+        acknowledgement takes longer than GAP_TIMEOUT to come around a long
+        ring, and no node has crashed
+    '''
+
+    results = []
+    with Harness.quiet():
+        for delay in delays:
+            results.append((delay, display_orders(members, latency, delay)))
+
+    print(f"\nDisplay Order ({members} users, {latency * 1000:.0f} ms latency, "
+          f"virtual time):")
+    for delay, orders in results:
+        print(f"second global {delay * 1000:.0f} ms later:  " +
+              ', '.join(f'{count} nodes {order}' for order, count in orders.items()))
+    print()
+
+    for delay, orders in results:
+        assert len(orders) == 1, f'display order diverged: {orders}'
+
+
+def answer_duplicate(members):
+    ''' Have a user of a ring on a virtual network hold a stamped global
+        that is not yet due, then get the answer to a duplicate of it,
+        which carries no order number
+
+        Return Values:
+        (displayed before the earlier order number arrived, displayed after)
+    '''
+
+    network = VirtualNetwork.VirtualNetwork(latency=.001)
+    leader = SuperUser.SuperUser(transport=network)
+    network.serve_node(leader)
+    with network.serve_login({LoginServer.DEFAULT_ROOM: (leader.ip, leader.port)}):
+        users = [User.User(f'member{i}', transport=network) for i in range(members)]
+        network.join(users)
+        network.call(users[0], users[0].send_message, 'first')
+        network.run(network.now + 5)
+
+        node, sender = users[-1], users[0]
+        due = node.next_order
+        message_id = (sender.node_id, sender.sequence + 1000)
+        request = {"username": sender.username, "purpose": "global",
+                   "message": "late", "order": due + 1}
+        node.pending_table.add(message_id, 'dirty', request,
+                sender.username, network.now)
+
+        response = {"username": sender.username, "purpose": "global_response",
+                    "message_id": message_id}
+        network.call(node, node.handle_global_response, response,
+                Codec.encode(response, node.wire))
+        early = message_id in node.history_table
+
+        node.deliver(None, due)
+        return (early, message_id in node.history_table)
+
+
+def test_duplicates(members=3):
+    ''' Check that the answer to a duplicate global, which carries no order
+        number, does not display the message ahead of its place in the order
+    '''
+
+    with Harness.quiet():
+        early, late = answer_duplicate(members)
+
+    print(f"\nDuplicate Answers ({members} users, virtual time):")
+    print(f"Displayed out of order:  {early}")
+    print(f"Displayed in order:      {late}\n")
+
+    assert not early, 'answer to a duplicate displayed the message out of order'
+    assert late, 'message was not displayed once its order number came up'
+
+
+def answer_fragments(members, size):
+    ''' Send a global and a direct message of size bytes, fragmented, in a
+        ring on a virtual network, then hand a user the first fragment of
+        each again once it has displayed them
+
+        Return Values:
+        (purposes of what the user answered the global's fragment with,
+         purposes of what the target answered the direct's fragment with)
+    '''
+
+    network = VirtualNetwork.VirtualNetwork(latency=.001)
+    leader = SuperUser.SuperUser(transport=network)
+    network.serve_node(leader)
+    with network.serve_login({LoginServer.DEFAULT_ROOM: (leader.ip, leader.port)}):
+        users = [User.User(f'member{i}', transport=network) for i in range(members)]
+        network.join(users)
+        network.run(network.now + 1)
+        sender, node = users[0], users[-1]
+        Harness.skip_lookups([sender])
+
+        received = []
+        for usr in users[1:]:
+            def handle(fragment, source, data, usr=usr, handle=usr.handle_fragment):
+                if fragment['index'] == 0:
+                    received.append((usr, fragment, source, data))
+                handle(fragment, source, data)
+            usr.handle_fragment = handle
+
+        network.call(sender, sender.send_message, 'g'.ljust(size, 'x'))
+        network.call(sender, sender.direct_message, node.username, 'd'.ljust(size, 'x'))
+        network.run(network.now + 5)
+
+        answers = []
+        for inner in ('global', 'direct'):
+            usr, fragment, source, data = next(entry for entry in received
+                    if entry[0] is node and entry[1]['inner'] == inner)
+            assert fragment['message_id'] in usr.history_table
+            sent = []
+            def send(request, address, batch=False, send=usr.send):
+                sent.append(request['purpose'])
+                send(request, address, batch)
+            usr.send = send
+            usr.handle_fragment(fragment, source, data)
+            del usr.send
+            answers.append(sent)
+
+        return tuple(answers)
+
+
+def test_fragments(members=3, size=3000):
+    ''' Check that a duplicate fragment of a message already displayed is
+        answered, so its sender stops resending it
+    '''
+
+    with Harness.quiet():
+        answered_global, answered_direct = answer_fragments(members, size)
+
+    print(f"\nDuplicate Fragments ({members} users, {size} byte messages, virtual time):")
+    print(f"Global answered with:  {answered_global}")
+    print(f"Direct answered with:  {answered_direct}\n")
+
+    assert answered_global == ['global_response'], answered_global
+    assert answered_direct == ['dm_response'], answered_direct
+
+
+def test_history(jump=600000000, messages=1000):
+    ''' Time recording messages from a sender that restarted jump
+        microseconds later, so its sequence numbers leap far past the window
+    '''
+
+    history = History.History()
+    node_id = Base_User.node_id_of('10.0.0.1', 9000)
+    for sequence in range(messages):
+        history.add((node_id, sequence))
+
+    restarted = messages + jump
+    begin = time.perf_counter_ns()
+    history.add((node_id, restarted))
+    jump_ns = time.perf_counter_ns() - begin
+
+    begin = time.perf_counter_ns()
+    for sequence in range(restarted + 1, restarted + messages):
+        history.add((node_id, sequence))
+    add_ns = (time.perf_counter_ns() - begin) / (messages - 1)
+
+    print(f"\nPerformance of History ({jump / 1e6:.0f} s restart gap):")
+    print(f"Add after the jump:    {jump_ns:.0f} nanoseconds")
+    print(f"Add (avg after it):    {add_ns:.0f} nanoseconds/add")
+    print(f"Entries kept:          {history.entries()} entries\n")
+
+    # shifting the window by the whole gap took about 0.1 s and 150 MB
+    assert jump_ns < 10000000, f'add after the jump took {jump_ns} ns'
+    assert (node_id, restarted) in history
+    assert (node_id, restarted + messages) not in history
+    assert history.entries() == messages
+    assert history.senders[node_id][1].bit_length() <= history.window
+
+
+def test_sweep(users=500, dead=5):
+    '''Measure one LoginServer checkup sweep over many users, some of them dead'''
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, LoginServer.RCVBUF)
+    server.bind(('127.0.0.1', 0))
+
+    # every user is a bare socket; the live ones answer from one thread
+    socks = []
+    name_list = {}
+    for i in range(users):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        socks.append(sock)
+        name_list[f'test_user{i}'] = sock.getsockname()
+    alive = socks[dead:]
+
+    reply = Codec.encode({"status": "ok", "purpose": "checkup_res"})
+    running = True
+    def answer():
+        while running:
+            rlist, _, _ = select.select(alive, [], [], .05)
+            for sock in rlist:
+                sock.recv(LoginServer.BUFSIZ)
+                sock.sendto(reply, server.getsockname())
+
+    responder = threading.Thread(target=answer)
+    responder.start()
+
+    begin = time.perf_counter()
+    crashed = LoginServer.probe_users(server, name_list)
+    elapsed = time.perf_counter() - begin
+
+    running = False
+    responder.join()
+    for sock in socks + [server]:
+        sock.close()
+
+    print(f"\nPerformance of Checkup Sweep ({users} users, {dead} dead):")
+    print(f"Elapsed Time:          {elapsed:.3f} seconds")
+    print(f"Dead users found:      {len(crashed)} of {dead} users\n")
+
+
+def test_admission(registered=10000, joins=1000):
+    '''Measure the LoginServer's uniqueness check and registration of new users'''
+
+    def address(i):
+        return (f'10.0.{i // 250}.{i % 250}', 9000 + i % 1000)
+
+    # previous approach: a plain dict, scanning its values for the address
+    name_list = {f'test_user{i}': address(i) for i in range(registered)}
+    begin = time.perf_counter_ns()
+    for i in range(registered, registered + joins):
+        username = f'test_user{i}'
+        if username in name_list or address(i) in name_list.values():
+            continue
+        name_list[username] = address(i)
+    scan_ns = (time.perf_counter_ns() - begin) / joins
+
+    # registry indexed by username and by address
+    registry = Registry.Registry()
+    for i in range(registered):
+        registry.add(f'test_user{i}', address(i))
+    begin = time.perf_counter_ns()
+    for i in range(registered, registered + joins):
+        username = f'test_user{i}'
+        if username in registry or registry.has_address(address(i)):
+            continue
+        registry.add(username, address(i))
+    index_ns = (time.perf_counter_ns() - begin) / joins
+
+    # snapshot of every registered user, and recovery from it
+    leader = ('127.0.0.1', 9000)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'LoginServer.snapshot')
+        begin = time.perf_counter()
+        registry.save(path, leader)
+        save_s = time.perf_counter() - begin
+        size = os.path.getsize(path)
+
+        begin = time.perf_counter()
+        Registry.Registry().load(path, leader)
+        load_s = time.perf_counter() - begin
+
+    print(f"\nPerformance of Join Admission ({registered} users registered):")
+    print(f"Joins:                 {joins} joins")
+    print(f"Dict scan (avg/join):  {scan_ns:.0f} nanoseconds/join")
+    print(f"Registry (avg/join):   {index_ns:.0f} nanoseconds/join")
+    print(f"Snapshot size:         {size} bytes")
+    print(f"Snapshot save:         {save_s * 1000:.1f} milliseconds")
+    print(f"Snapshot load:         {load_s * 1000:.1f} milliseconds\n")
+
+
+def test_detector(heartbeats=20000, jitter=.05, loss=.01):
+    ''' Measure false positives and detection time of the heartbeat failure
+        detector on a simulated clock, for several thresholds
+    '''
+
+    interval = User.Base_User.HEARTBEAT
+    tick = interval / 4
+
+    print("\nPerformance of Heartbeat Failure Detection:")
+    print(f"Heartbeats:            {heartbeats} heartbeats "
+          f"({jitter * 1000:.0f} ms jitter, {loss:.0%} lost)")
+
+    for threshold in (1.0, 3.0, 8.0, 12.0):
+        rand = random.Random(1)
+        detector = FailureDetector.PhiAccrual(interval, threshold)
+        peer = ('127.0.0.1', 9000)
+        detector.watch({peer}, 0.0)
+
+        # the peer is alive: every suspicion is a false positive
+        now = 0.0
+        sent = 0.0
+        for _ in range(heartbeats):
+            sent += interval
+            arrival = sent + abs(rand.gauss(0, jitter))
+            while now + tick < arrival:
+                now += tick
+                detector.suspects(now)
+            if rand.random() >= loss:
+                detector.heard(peer, arrival)
+        false_positives = detector.suspicions
+
+        # then it crashes
+        crashed = now
+        while not detector.suspects(now):
+            now += tick / 10
+        detection = now - crashed
+
+        print(f"Threshold phi {threshold:<5}   {false_positives:>4} false positives, "
+              f"crash detected after {detection:.2f} seconds")
+    print()
+
+
+async def measure_repair(members, crashes, sink):
+    ''' Crash a run of consecutive users in a ring and time its repair
+
+        - the crash alert the LoginServer would send is given straight to
+          the leader, so the time does not include detection
+        - if the ring reports a total failure, the time is that of every
+          remaining user rejoining instead
+
+        Return Values:
+        (seconds, True if repaired in place)
+    '''
+
+    leader, users, tasks = await Harness.start_ring(members)
+    # successor lists fill in over a few heartbeats
+    await asyncio.sleep(Base_User.HEARTBEAT * (Base_User.SUCCESSORS + 1))
+
+    # users joined in order sit next to each other in the ring
+    first = members // 2
+    crashed = users[first:first + crashes]
+    for usr in crashed:
+        tasks[1 + users.index(usr)].cancel()
+    alive = [usr for usr in users if usr not in crashed]
+    await asyncio.sleep(0)
+
+    alert = {
+        "purpose" : "crash",
+        "username": crashed[0].username,
+        "info"    : [crashed[0].ip, crashed[0].port],
+        "status"  : "dirty",
+        "crashed" : [[usr.username, [usr.ip, usr.port]] for usr in crashed]
+    }
+
+    start = time.perf_counter()
+    Runtime.call(leader, leader.handle_crash, alert)
+
+    failed = False
+    while not Harness.ring_complete(leader, alive):
+        try:
+            request, _ = Codec.decode(sink.recv(Base_User.BYTES))
+            failed = request.get('purpose') == 'total_failure'
+        except BlockingIOError:
+            pass
+        if failed:
+            break
+        await asyncio.sleep(.001)
+
+    if failed:
+        # everyone is told to log in again and rejoins at once
+        for node in [leader] + alive:
+            node.neighbors = {}
+            node.successors = []
+            node.pending_table.clear()
+        await Harness.join_all(leader, alive)
+
+    elapsed = time.perf_counter() - start
+
+    Harness.stop_ring(tasks)
+    await asyncio.sleep(0)
+
+    return (elapsed, not failed)
+
+
+def test_repair(members=20):
+    '''Measure time to repair the ring after consecutive users crash at once'''
+
+    results = []
+    with Harness.quiet() as sink:
+        for crashes in range(1, Base_User.SUCCESSORS + 1):
+            results.append((crashes,
+                    asyncio.run(measure_repair(members, crashes, sink))))
+
+    print(f"\nPerformance of Crash Repair ({members} users, "
+          f"{Base_User.SUCCESSORS} successors each):")
+    for crashes, (elapsed, repaired) in results:
+        outcome = 'repaired in place' if repaired else 'total failure, all rejoined'
+        print(f"{crashes} crashed in a row:     {elapsed * 1000:.1f} milliseconds ({outcome})")
+    print()
+
+
+def route_hops(members, samples=2000):
+    ''' Count the hops of direct messages in a ring of members users
+        joined one after another, walking the ring and along finger tables
+
+        - the hops include handing a message for a missing user back to
+          its sender
+
+        Return Values:
+        (average ring hops, average finger hops, most finger hops,
+         ring hops to a missing user, average finger hops to one)
+    '''
+
+    names = ['super_user'] + [f'member{i}' for i in range(members)]
+    addresses = {name: ('127.0.0.1', 9000 + i) for i, name in enumerate(names)}
+    by_address = {address: name for name, address in addresses.items()}
+    tables = Fingers.build(addresses)
+
+    # each user is spliced in right after the SuperUser
+    ring = ['super_user'] + names[:0:-1]
+    place = {name: i for i, name in enumerate(ring)}
+
+    def finger_route(source, target):
+        node, hops = source, 0
+        while node != target:
+            finger, final = Fingers.closest(Fingers.key(node), tables[node],
+                    Fingers.key(target))
+            hops += 1
+            if final and finger[0] != Fingers.key(target):
+                return hops
+            node = by_address[tuple(finger[1:])]
+        return hops
+
+    rng = random.Random(members)
+    ring_total = finger_total = finger_most = missing_total = 0
+    for i in range(samples):
+        source, target = rng.sample(names, 2)
+        ring_total += (place[target] - place[source]) % len(ring)
+        hops = finger_route(source, target)
+        finger_total += hops
+        finger_most = max(finger_most, hops)
+        missing_total += finger_route(source, f'missing{i}')
+
+    return (ring_total / samples, finger_total / samples, finger_most,
+            len(ring), missing_total / samples)
+
+
+async def measure_direct(members, messages, mode):
+    ''' Time direct messages between random nodes of a ring, from sending
+        one to its sender hearing back from the target
+
+        - mode 'fingers' hands every node its finger table, as the
+          LoginServer would, and 'cached' fills every node's location
+          cache as if it had looked up all users; with 'ring' messages
+          walk the ring
+
+        Return Values:
+        average seconds per message
+    '''
+
+    leader, users, tasks = await Harness.start_ring(members)
+    nodes = [leader] + users
+    if mode != 'cached':
+        Harness.skip_lookups(nodes)
+    if mode == 'fingers':
+        tables = Fingers.build({node.username: (node.ip, node.port) for node in nodes})
+        for node in nodes:
+            node.handle_fingers({"fingers": tables[node.username]})
+    if mode == 'cached':
+        for node in nodes:
+            for other in nodes:
+                node.handle_location({"target": other.username,
+                                      "address": [other.ip, other.port]})
+
+    rng = random.Random(members)
+    total = 0
+    for _ in range(messages):
+        source, target = rng.sample(nodes, 2)
+        start = time.perf_counter()
+        Runtime.call(source, source.direct_message, target.username, 'test message')
+        message_id = (source.node_id, source.sequence)
+        while message_id in source.pending_table:
+            await asyncio.sleep(0)
+        total += time.perf_counter() - start
+
+    Harness.stop_ring(tasks)
+    await asyncio.sleep(0)
+
+    return total / messages
+
+
+def test_routing(sizes=(10, 100, 1000), timed=(10, 100), messages=200):
+    ''' Compare direct message hops and latency of finger tables and
+        cached locations against the ring walk
+    '''
+
+    print("\nDirect Message Hops (ring walk vs finger tables):")
+    for members in sizes:
+        ring, routed, most, missing_ring, missing_routed = route_hops(members)
+        print(f"{members:>5} users:  ring {ring:7.1f} avg   fingers {routed:5.2f} avg, "
+              f"{most} max   missing user: ring {missing_ring}, fingers {missing_routed:.2f}")
+
+    results = [(members, *(Harness.run_quietly(measure_direct, members, messages, mode)
+            for mode in ('ring', 'fingers', 'cached'))) for members in timed]
+
+    print("\nDirect Message Latency (one event loop, loopback sockets):")
+    for members, ring, routed, cached in results:
+        print(f"{members:>5} users:  ring {ring * 1000:7.3f} ms   "
+              f"fingers {routed * 1000:7.3f} ms   cached {cached * 1000:7.3f} ms")
+    print()
+
+
+async def measure_spread(members, messages, spread):
+    ''' Time global messages from random users, from sending one until
+        every node has displayed it
+
+        - spread 'tree' has the SuperUser fan globals out along finger
+          tables handed to every node, as the LoginServer would
+
+        Return Values:
+        (average seconds per message, most seconds for one)
+    '''
+
+    leader, users, tasks = await Harness.start_ring(members)
+    nodes = [leader] + users
+    tables = Fingers.build({node.username: (node.ip, node.port) for node in nodes})
+    for node in nodes:
+        node.handle_fingers({"fingers": tables[node.username]})
+        node.spread = spread
+
+    rng = random.Random(members)
+    total = most = 0
+    for i in range(messages):
+        source = rng.choice(users)
+        start = time.perf_counter()
+        Runtime.call(source, source.send_message, f'test message {i}')
+        message_id = (source.node_id, source.sequence)
+        while not all(message_id in node.history_table for node in nodes):
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        most = max(most, elapsed)
+
+    Harness.stop_ring(tasks)
+    await asyncio.sleep(0)
+
+    return (total / messages, most)
+
+
+def test_spread(sizes=(10, 50, 100, 200), messages=50):
+    '''Compare global message delivery latency of the ring and the SuperUser's tree'''
+
+    results = [(members, *(Harness.run_quietly(measure_spread, members, messages, spread)
+            for spread in ('ring', 'tree'))) for members in sizes]
+
+    print("\nGlobal Message Delivery to Every Node (one event loop, loopback sockets):")
+    for members, (ring, ring_most), (tree, tree_most) in results:
+        print(f"{members:>5} users:  ring {ring * 1000:7.2f} ms avg, {ring_most * 1000:7.2f} max   "
+              f"tree {tree * 1000:6.2f} ms avg, {tree_most * 1000:6.2f} max")
+    print()
+
+
+class NoMetrics(Metrics.Metrics):
+    '''Metrics that record nothing, to measure what recording costs'''
+
+    def count(self, metric, label=None, amount=1):
+        pass
+
+    def datagram(self, direction, size):
+        pass
+
+    def request(self, purpose):
+        return False
+
+    def observe(self, metric, label, value):
+        pass
+
+
+async def measure_room(members, duration, interval, record=True):
+    ''' Keep every user of one room sending globals for a while
+
+        - record=False turns the nodes' metrics off
+
+        Return Values:
+        globals delivered at the SuperUser per second
+    '''
+
+    leader, users, tasks = await Harness.start_ring(members)
+    if not record:
+        for node in [leader] + users:
+            node.metrics = NoMetrics(node.metrics.name)
+
+    start = time.perf_counter()
+    first = leader.next_order
+    while time.perf_counter() - start < duration:
+        for usr in users:
+            # stay just ahead of what the window lets through
+            if len(usr.outbox) < usr.window:
+                Runtime.call(usr, usr.send_message, 'test message')
+        await asyncio.sleep(interval)
+    delivered = leader.next_order - first
+    elapsed = time.perf_counter() - start
+
+    Harness.stop_ring(tasks)
+    await asyncio.sleep(0)
+
+    return delivered / elapsed
+
+
+def run_room(args):
+    '''Run one room on its own event loop, in its own process'''
+
+    return Harness.run_quietly(measure_room, *args)
+
+
+def test_rooms(counts=(1, 2, 4), members=10, duration=3, interval=.001):
+    '''Measure aggregate global throughput of independent rooms run side by side'''
+
+    results = []
+    for count in counts:
+        with multiprocessing.Pool(count) as pool:
+            results.append((count, pool.map(run_room,
+                    [(members, duration, interval)] * count)))
+
+    print(f"\nThroughput of Rooms ({members} users each, one process per room, "
+          f"{os.cpu_count()} cores):")
+    for count, rates in results:
+        print(f"{count} rooms:  {sum(rates):8.0f} globals/second in total, "
+              f"{sum(rates) / count:8.0f} per room")
+    print()
+
+
+def test_metrics(members=10, duration=3, interval=.001, calls=1000000):
+    '''Measure what recording metrics costs, per call and in global throughput'''
+
+    metrics = Metrics.Metrics('test')
+    begin = time.perf_counter_ns()
+    for _ in range(calls):
+        metrics.count('received', 'global')
+    count_ns = (time.perf_counter_ns() - begin) / calls
+
+    begin = time.perf_counter_ns()
+    for _ in range(calls):
+        metrics.observe('handler_seconds', 'global', .00002)
+    observe_ns = (time.perf_counter_ns() - begin) / calls
+
+    rates = [(record, Harness.run_quietly(measure_room, members, duration, interval, record))
+            for record in (False, True, False, True)]
+    off = sum(rate for record, rate in rates if not record) / 2
+    on = sum(rate for record, rate in rates if record) / 2
+
+    print(f"\nCost of Metrics ({members} users, one event loop):")
+    print(f"count():             {count_ns:.0f} nanoseconds/call")
+    print(f"observe():           {observe_ns:.0f} nanoseconds/call")
+    print(f"Metrics off:         {off:.0f} globals/second")
+    print(f"Metrics on:          {on:.0f} globals/second ({(on / off - 1) * 100:+.1f}%)\n")
+
+
+def test_startup(launches=10, busy=500, lookups=20):
+    ''' Measure node startup: finding the address and binding the socket,
+        and the time from launching a User process to the LoginServer's
+        answer to its connect request
+    '''
+
+    # previous approach: look the host name up, then bind the first free
+    # port from 9000, with busy of them taken
+    taken = []
+    for port in range(9000, 9000 + busy):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(('127.0.0.1', port))
+            taken.append(sock)
+        except OSError:
+            sock.close()
+
+    begin = time.perf_counter()
+    for _ in range(lookups):
+        socket.gethostbyname(socket.gethostname())
+    lookup_ms = (time.perf_counter() - begin) * 1000 / lookups
+
+    begin = time.perf_counter()
+    for _ in range(lookups):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for port in range(9000, 10000):
+            try:
+                sock.bind(('127.0.0.1', port))
+                break
+            except OSError:
+                continue
+        sock.close()
+    scan_ms = (time.perf_counter() - begin) * 1000 / lookups
+
+    transport = Transport.UDP()
+    begin = time.perf_counter()
+    for _ in range(lookups):
+        transport.local_ip()
+    route_ms = (time.perf_counter() - begin) * 1000 / lookups
+
+    begin = time.perf_counter()
+    for _ in range(lookups):
+        transport.bind('127.0.0.1').close()
+    bind_ms = (time.perf_counter() - begin) * 1000 / lookups
+
+    for sock in taken:
+        sock.close()
+
+    # a LoginServer on localhost, and User processes logging in with it
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    login = f'127.0.0.1:{probe.getsockname()[1]}'
+    probe.close()
+    env = dict(os.environ, LOGIN_SERVER=login)
+    here = os.path.dirname(os.path.abspath(__file__))
+    user = ("import sys, time; sys.path.insert(0, {!r}); import Codec, User;"
+            "usr = User.User('startup{}'); usr.connect_to_login();"
+            "print(time.time());"
+            "usr.sock.sendto(Codec.encode({{'purpose': 'disconnect',"
+            " 'username': usr.username}}, 'json'), usr.login_server)")
+
+    times = []
+    with tempfile.TemporaryDirectory() as directory:
+        server = subprocess.Popen([sys.executable, os.path.join(here, 'LoginServer.py'),
+                '127.0.0.1', '1'], cwd=directory, env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            # the LoginServer is up once it says so
+            server.stdout.readline()
+            for i in range(launches):
+                start = time.time()
+                answered = subprocess.run([sys.executable, '-c', user.format(here, i)],
+                        env=env, capture_output=True, text=True).stdout
+                times.append((float(answered.split()[-1]) - start) * 1000)
+        finally:
+            server.kill()
+            server.wait()
+
+    print(f"\nNode Startup ({busy} ports of 9000-9999 taken):")
+    print(f"Host name lookup:      {lookup_ms:7.3f} ms    route lookup: {route_ms:7.3f} ms")
+    print(f"Bind scanning ports:   {scan_ms:7.3f} ms    OS port:      {bind_ms:7.3f} ms")
+    print(f"Launch to connect response ({launches} User processes): "
+          f"{sum(times) / len(times):.1f} ms avg, {min(times):.1f} ms min, "
+          f"{max(times):.1f} ms max\n")
+
+
+# benchmarks that do not need a running chat room, by the name they are run by
+BENCHMARKS = {
+    'pending'   : test_pending,
+    'joins'     : test_joins,
+    'sweep'     : test_sweep,
+    'admission' : test_admission,
+    'detector'  : test_detector,
+    'repair'    : test_repair,
+    'routing'   : test_routing,
+    'spread'    : test_spread,
+    'leaders'   : test_leaders,
+    'batches'   : test_batches,
+    'simulate'  : test_simulate,
+    'rooms'     : test_rooms,
+    'metrics'   : test_metrics,
+    'startup'   : test_startup,
+    'backoff'   : test_backoff,
+    'order'     : test_order,
+    'duplicates': test_duplicates,
+    'fragments' : test_fragments,
+    'history'   : test_history
+}
+
+
 def main():
     '''Runner function for performance testing'''
 
+    if len(sys.argv) > 1 and sys.argv[1] in BENCHMARKS:
+        BENCHMARKS[sys.argv[1]]()
+        return
+
     name = f"test_user{time.time()}"
     usr = User.User(name)
     usr.print_user()
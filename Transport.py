@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Transport.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 18, 2021
+#
+# A transport gives a node its address, a socket to send and receive
+# datagrams on, the clock its timeouts are measured against and the
+# address of the LoginServer. The UDP class is the real one: UDP sockets
+# on this host and the wall clock. VirtualNetwork.py implements the same
+# interface in memory, so the same nodes can be run by the thousand in one
+# process
+#
+# Sockets handed out by a transport need sendto, recvfrom, recv,
+# getsockname, settimeout and close, as Python's sockets have
+
+import os
+import select
+import socket
+import sys
+import time
+
+
+def address(text):
+    '''Parse HOST:PORT into (host, port); raises ValueError if it is not one'''
+
+    host, port = text.rsplit(':', 1)
+    return (host, int(port))
+
+
+# the LoginServer every node logs in with; LOGIN_SERVER=HOST:PORT in the
+# environment, or --login=HOST:PORT, overrides it
+LOGIN_SERVER = address(os.environ.get('LOGIN_SERVER', 'student10.cse.nd.edu:9999'))
+
+# a node's address is that of the interface it would reach this one
+# through; nothing is sent to it, it only has to be routable
+ROUTE_PROBE = ('192.0.2.1', 9)
+
+
+class UDP:
+
+    def __init__(self, ip=None, port=None, login_server=None):
+        ''' Constructor for UDP objects
+
+            - ip and port are the interface and port nodes bind to; by
+              default the interface of the route out of this host and a
+              port the OS picks
+            - login_server is the LoginServer's (host, port), LOGIN_SERVER
+              by default
+        '''
+
+        self.ip = ip
+        self.port = port
+        self.login_server = LOGIN_SERVER if login_server is None else login_server
+
+
+    def time(self):
+        '''Return the current time, in seconds'''
+
+        return time.time()
+
+
+    def local_ip(self):
+        ''' Return the IP address nodes on this host are reached at
+
+            - found from the routing table rather than by looking up the
+              host name, which may block on DNS
+        '''
+
+        if self.ip is not None:
+            return self.ip
+
+        # the interface towards the LoginServer, if its address is known
+        # without a lookup
+        target = ROUTE_PROBE
+        try:
+            socket.inet_aton(self.login_server[0])
+            target = self.login_server
+        except OSError:
+            pass
+
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.connect(target)
+            return probe.getsockname()[0]
+        except OSError:
+            # no route out of this host
+            return '127.0.0.1'
+        finally:
+            probe.close()
+
+
+    def bind(self, ip, port=None):
+        ''' Return a UDP socket bound to (ip, port)
+
+            - without a port, the configured one is taken, or else one the
+              OS picks
+            - raises OSError if the port is taken
+        '''
+
+        if port is None:
+            port = 0 if self.port is None else self.port
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((ip, port))
+        except OSError:
+            sock.close()
+            raise
+
+        return sock
+
+
+    def wait(self, sock, timeout):
+        ''' Wait up to timeout seconds for a datagram on sock
+
+            Return Values:
+            True if one arrived
+        '''
+
+        rlist, _, _ = select.select([sock], [], [], timeout)
+        return bool(rlist)
+
+
+def configure():
+    ''' Build the UDP transport given on the command line
+
+        - --bind=IP[:PORT] sets the interface and port to bind to
+        - --login=HOST:PORT sets the LoginServer
+        - the options are removed from sys.argv
+
+        Return Values:
+        UDP object
+    '''
+
+    ip, port, login_server = None, None, None
+    for arg in list(sys.argv[1:]):
+        if arg.startswith('--bind='):
+            sys.argv.remove(arg)
+            ip = arg.split('=', 1)[1]
+            if ':' in ip:
+                ip, port = address(ip)
+        elif arg.startswith('--login='):
+            sys.argv.remove(arg)
+            login_server = address(arg.split('=', 1)[1])
+
+    return UDP(ip, port, login_server)
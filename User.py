@@ -8,77 +8,104 @@
 # It serves as the abstraction template for basic functionality
 
 import Base_User
+import Codec
 
 import socket
-import json
-import hashlib
-import queue
-import time
 import sys
 import select
 
 
-LOGIN_SERVER = ('student10.cse.nd.edu', 9999)
-BYTES = 1024
-TIMEOUT = .5
+GAP_ASKS = 3    # requests for a missing fanned out global before skipping it
 
 
 class User(Base_User.Base_User):
 
-    def __init__(self, username=None):
-        super().__init__()
+    def __init__(self, username=None, room=None, lead=False, transport=None):
+        super().__init__(transport)
         if username is None:
             self.username = input("Enter your username: ")
         else:
             self.username = username
+        # chat room to join; the LoginServer picks its default if None
+        self.room = room
+        # a leader splices new users into the ring after itself, taking
+        # part of the load of joins off the SuperUser
+        self.lead = lead
+        # requests received before the SuperUser spliced this user in
+        self.early = []
+        # order number last asked from the SuperUser, and how many times
+        self.gap_asked = [None, 0]
+        # highest order number a neighbor has delivered up to
+        self.order_seen = 0
 
 
     def connect_to_login(self):
         '''Method to set up UDP connection with LoginServer'''
 
+        # advertise the supported wire formats; the request itself is
+        # JSON since the LoginServer may not understand binary frames
         json_req = {
             "username": self.username,
             "purpose" : "connect",
             "ip"      : self.ip,
-            "port"    : self.port
+            "port"    : self.port,
+            "wire"    : ["binary", "json"]
         }
+        if self.room is not None:
+            json_req["room"] = self.room
+        if self.lead:
+            json_req["lead"] = True
 
-        req = json.dumps(json_req)
-        encoded_req = req.encode('utf-8')
-
-        self.sock.sendto(encoded_req, LOGIN_SERVER)
+        self.sock.sendto(Codec.encode(json_req, 'json'), self.login_server)
 
         # throw exception if LoginServer doesn't respond in 3 seconds
         self.sock.settimeout(3)
         try:
-            data = self.sock.recv(BYTES)
+            data = self.sock.recv(Base_User.BYTES)
             self.sock.settimeout(None)
         except socket.timeout:
             print(f"User {self.username} could not connect to LoginServer")
             sys.exit(-1)
           
-        res = data.decode('utf-8')
-        json_res = json.loads(res)
         try:
+            json_res, _ = Codec.decode(data)
             status = json_res["status"]
-        except KeyError:
+        except (ValueError, KeyError):
             print(f"User {self.username} could not connect to LoginServer")
             sys.exit(-1)
 
         if (status == "success"):
+            # a LoginServer that does not negotiate only speaks JSON
+            self.wire = json_res.get("wire", "json")
             return json_res["leader"]
         else:
             if (json_res["error"]) == "un-unique":
                 raise Exception(f'The Username or (IP,PORT) is already in use')
             if (json_res["error"]) == "server_down":
                 raise Exception(f'The System currently under repair due to a crashed user. Please reconnect in a moment')
+            if (json_res["error"]) == "no_room":
+                raise Exception(f'There is no chat room named {self.room}')
  
 
     def connect(self):
         '''Allow user to enter chat ring'''
 
         leader = self.connect_to_login()
+        self.request_join(leader)
+
+        # wait for the SuperUser to splice this user into the ring
+        while not self.neighbors:
+            self.receive_message()
+
 
+    def request_join(self, leader):
+        ''' Ask a leader to splice this user into the ring
+
+            - leader is the node chosen by the LoginServer: the SuperUser,
+              or a user started as a leader
+        '''
+
+        self.leader = leader
         json_req = {
             "username": self.username,
             "purpose": "connect",
@@ -86,22 +113,42 @@ class User(Base_User.Base_User):
             "port": self.port
         }
 
-        req = json.dumps(json_req)
-        encoded_req = req.encode('utf-8')
+        # send connection message to the leader
+        self.send(json_req, leader)
+
 
-        # send connection message to SuperUser
-        self.sock.sendto(encoded_req, tuple(leader))
-        data = self.sock.recv(BYTES)
-        data = json.loads(data.decode('utf-8'))
+    def join_ring(self, data):
+        ''' Take the neighbors given by the leader once spliced in
 
-        self.neighbors["prev"] = leader
+            - from then on self.leader is the SuperUser
+        '''
+
+        if data["status"] != "success":
+            print("Unable to join chat room. Please retry logging in.")
+            sys.exit(-1)
+
+        # users spliced in together follow each other
+        self.neighbors["prev"] = data.get("prev", self.leader)
+        self.leader = data.get("leader", self.leader)
         self.neighbors["next_1"] = data["next_1"]
         self.neighbors["next_2"] = data["next_2"]
+        # first order number this user will see
+        self.next_order = data.get("order")
+        self.spread = data.get("spread", "ring")
+        self.sync_successors()
+
+        # handle what arrived while the join was in progress
+        early, self.early = self.early, []
+        for request, frame, addr in early:
+            self.process_request(request, frame, addr)
 
     
     def disconnect(self):
         '''Allow user to cleanly exit chat ring'''
         
+        # send anything still waiting to be batched
+        self.flush_batches()
+
         # make the first disconnection request to the next neighbor
         json_req = {
             "purpose"  : "disconnect",
@@ -110,10 +157,7 @@ class User(Base_User.Base_User):
             "prev"     : self.neighbors['prev'],
             "cause"    : "disconnect"
         }
-
-        req = json.dumps(json_req)
-        encoded_req = req.encode('utf-8')
-        self.sock.sendto(encoded_req, tuple(self.neighbors['next_1']))
+        self.send(json_req, self.neighbors['next_1'])
 
         # make the second disconnection request to the prev neighbors
         json_req = {
@@ -123,72 +167,87 @@ class User(Base_User.Base_User):
             "prev"     : "same",
             "cause"    : "disconnect"
         }
-
-        req = json.dumps(json_req)
-        encoded_req = req.encode('utf-8')
-        self.sock.sendto(encoded_req, tuple(self.neighbors['prev']))
+        self.send(json_req, self.neighbors['prev'])
 
         # final request to login server to notify name removal from system
         json_req = {
 		    "purpose": "disconnect",
             "username": self.username
         }
-        req = json.dumps(json_req)
-        encoded_req = req.encode('utf-8')
-        self.sock.sendto(encoded_req, LOGIN_SERVER)
+        self.send(json_req, self.login_server)
         sys.exit(0)
 
 
-    def receive_message(self):
-        '''Listen for incoming messages and process accordingly'''
+    def process_request(self, request, data, addr):
+        '''Process a single decoded request according to its purpose'''
 
-        # main listening loop
-        data, addr = self.sock.recvfrom(BYTES)
-        decoded_data = data.decode('utf-8')
-        request = json.loads(decoded_data)
         purpose = request['purpose']
 
+        # the next user points back at this one before the SuperUser's
+        # reply arrives, so ring traffic can come first
+        if not self.neighbors and purpose != 'connect_res':
+            self.early.append((request, data, addr))
+            return
+
         # process the request accordingly
         if purpose == 'global':
-            self.handle_global(request, addr)
+            self.handle_global(request, addr, data)
 
         elif purpose == 'global_response':
-            # display the message
-            self.display(request["message_id"])
-
-            if request['username'] == self.username:
-                # check for additional acknowledged messages in pending
-                if self.pending_table:
-                    first_val = list(self.pending_table.values())[0]
-                    if first_val[0] == "clean":
-                        self.handle_global(first_val[1], [self.ip, self.port])
-
-                # stop forwarding the acknowledgement along
-                return
-            else:
-                # move along the acknowledgement
-                self.sock.sendto(data, tuple(self.neighbors['prev']))
+            self.handle_global_response(request, data)
         
         elif purpose == 'dm_response':
             # display private message
             self.display(request['message_id'])
 
+        # spliced into the ring by the leader
+        elif purpose == 'connect_res':
+            self.join_ring(request)
+
+        # new user to splice into the ring after this one
+        elif purpose == 'connect' and self.lead:
+            self.add_users(request)
+
+        # reply to a pointer update of a join in progress
+        elif purpose == "update_pointers_res":
+            self.handle_join_response(request, addr)
+
         # update pointers for a new node
         elif (purpose == "update_pointers" or purpose == "update_last_node"):
             self.update_pointers(purpose, request, addr)
         
+        # neighbor is alive; the detector has already noted it
+        elif (purpose == "heartbeat"):
+            self.handle_heartbeat(request, addr)
+
+        # finger table for routing direct messages
+        elif (purpose == "fingers"):
+            self.handle_fingers(request)
+
+        # address of a user to send direct messages to
+        elif (purpose == "location"):
+            self.handle_location(request)
+
         # direct message
         elif (purpose == "direct"):
-            self.handle_direct(request, addr)
+            self.handle_direct(request, addr, data)
+
+        # piece of a message too large for one datagram
+        elif (purpose == "fragment"):
+            self.handle_fragment(request, addr, data)
         
         elif (purpose == "disconnect"):
             self.handle_disconnect(request)
 
         elif (purpose == "checkup"):
-            self.sock.sendto(json.dumps({
+            self.send({
                 "status":"ok",
                 "purpose": "checkup_res"
-            }).encode('utf-8'), LOGIN_SERVER)
+            }, self.login_server)
+
+        elif (purpose == "wire"):
+            # a peer in the ring only speaks this format
+            self.wire = request["wire"]
         
         elif (purpose == "crash"):
             self.handle_crash(request)
@@ -200,17 +259,98 @@ class User(Base_User.Base_User):
         elif (purpose == "total_failure"):
             print("Multiple users crashed. Please retry logging in.")
             sys.exit(-1)
+
+        # counters and histograms, for monitoring
+        elif (purpose == "stats"):
+            self.send_stats(addr)
         
         else:
             print(f"Unknown purpose: {purpose}")
 
 
+    def next_deadline(self):
+        '''Include the time a missing fanned out global is asked for'''
+
+        deadline = super().next_deadline()
+        if self.spread == 'tree' and self.gap_since is not None:
+            gap = self.gap_since + Base_User.GAP_TIMEOUT
+            if deadline is None or gap < deadline:
+                deadline = gap
+
+        return deadline
+
+
+    def handle_heartbeat(self, request, sender):
+        ''' Also learn from a neighbor's heartbeat of fanned out globals
+            that never reached this user, even when no later one did
+        '''
+
+        super().handle_heartbeat(request, sender)
+
+        order = request.get('order')
+        if (self.spread == 'tree' and order is not None and
+                self.next_order is not None and order > self.next_order):
+            self.order_seen = max(self.order_seen, order)
+            if self.gap_since is None:
+                self.gap_since = self.clock()
+
+
+    def check_timeouts(self):
+        ''' Also recover globals lost on the way down the SuperUser's tree
+
+            - once the next order number has been missing for GAP_TIMEOUT,
+              the SuperUser is asked for it and any later holes; after
+              GAP_ASKS unanswered requests it is skipped
+        '''
+
+        super().check_timeouts()
+
+        if self.spread != 'tree' or self.gap_since is None:
+            return
+        now = self.clock()
+        if now - self.gap_since < Base_User.GAP_TIMEOUT:
+            return
+
+        # every hole before the latest order number seen is asked at once
+        upto = max(list(self.reorder) + [self.order_seen])
+        holes = [order for order in range(self.next_order, upto)
+                if order not in self.reorder]
+        if not holes:
+            self.gap_since = None
+            return
+
+        if self.gap_asked[0] != self.next_order:
+            self.gap_asked = [self.next_order, 0]
+
+        if self.gap_asked[1] < GAP_ASKS:
+            self.gap_asked[1] += 1
+            self.gap_since = now
+            self.send({"purpose": "missing", "orders": holes[:Base_User.WINDOW]},
+                    self.leader)
+        else:
+            self.deliver(None, self.next_order)
+
+
     def check_pending(self):
         '''Determine if direct messages are still pending'''
-        for key in self.pending_table:
-            if self.username == self.pending_table[key][2]:
+        for entry in self.pending_table.values():
+            if self.username == entry.owner:
                 return True
-        return False
+        # direct messages waiting for their target's address
+        return any(waiting for _, waiting in self.lookups.values())
+
+
+    def handle_input(self, usr_input):
+        '''Handle a line typed by the user'''
+
+        if usr_input.strip() == "disconnect":
+            if not self.check_pending():
+                self.disconnect()
+                sys.exit(0)
+            else:
+                print('processing messages, please try disconnecting later')
+        else:        
+            self.send_message(usr_input)
 
 
     def listen(self):
@@ -218,46 +358,18 @@ class User(Base_User.Base_User):
         
         while True:
 
-            rlist, _, _ = select.select([sys.stdin, self.sock], [], [], TIMEOUT)
+            rlist, _, _ = select.select(
+                    [sys.stdin, self.sock], [], [], self.next_timeout())
 
             for read_s in rlist:
 
                 # read input
                 if read_s == sys.stdin:
-                    usr_input = sys.stdin.readline()
-                    if usr_input.strip() == "disconnect":
-                        if not self.check_pending():
-                            self.disconnect()
-                            sys.exit(0)
-                        else:
-                            print('processing messages, please try disconnecting later')
-                    else:        
-                        self.send_message(usr_input)
+                    self.handle_input(sys.stdin.readline())
 
                 # read incoming messages
                 else:
                     self.receive_message()
                     
-            # check if there have been timeouts for a message at top of pending queue
-            if not self.pending_table:
-                continue
-
-            for idx, value in enumerate(list(self.pending_table.values())):
-                req  = value[1]
-                name = value[2]
-                user_time = value[3]
-                sent = value[4]
-                
-                if time.time() - user_time > TIMEOUT and name == self.username:
-                    if sent == False:
-                        # it's this users responsibility to prompt the checkins
-                        # tell the login server to check for timeouts
-                        self.sock.sendto(json.dumps(
-                            {"purpose":"checkup"}).encode('utf-8'), LOGIN_SERVER)
-                        self.pending_table[
-                                list(self.pending_table.keys())[idx]][4] = True
-                    else:
-                        self.sock.sendto(json.dumps(
-                            req).encode('utf-8'), tuple(self.neighbors['next_1']))
-            
-
+            # check if there have been timeouts for messages sent by this user
+            self.check_timeouts()
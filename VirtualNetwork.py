@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+# VirtualNetwork.py
+# Authors: Kristen Friday, Carlo Preciado
+# Date: December 18, 2021
+#
+# The VirtualNetwork class is an in-memory transport for simulating large
+# chat rooms in one process. Datagrams are delivered after a configurable
+# latency, may be lost, and queue up behind each other on a sender's link
+# of limited bandwidth. Time is virtual: it jumps from one event to the
+# next, so a run is deterministic for a given seed and takes only as long
+# as the nodes need to process their messages
+#
+# Unchanged Users, SuperUsers and the LoginServer run on it: each gets a
+# VirtualSocket in place of a UDP socket, and reads the network's clock
+
+import collections
+import contextlib
+import heapq
+import itertools
+import random
+import socket
+
+import LoginServer
+
+
+RESOLUTION = 1e-6      # smallest step of the virtual clock between checks
+PORTS = range(9000, 10000)     # ports handed out to sockets bound without one
+
+
+class VirtualSocket:
+
+    def __init__(self, network, address):
+        '''Constructor for VirtualSocket objects'''
+
+        self.network = network
+        self.address = address
+        self.inbox = collections.deque()    # (data, sender) not yet read
+        self.timeout = None
+        self.closed = False
+        self.link_free = 0.0        # when the sender's link is next idle
+
+        # set by VirtualNetwork.serve: datagrams and due deadlines are
+        # handed to the node instead of waiting in the inbox
+        self.receive = None
+        self.check = None
+        self.deadline = None
+        self.busy = False           # the node is handling an event
+        self.timer = None           # [time, generation] of the next check
+
+
+    def sendto(self, data, address):
+        if not self.closed:
+            self.network.transmit(self, bytes(data), tuple(address))
+        return len(data)
+
+
+    def recvfrom(self, bufsize):
+        ''' Return the next datagram and its sender
+
+            - blocks by running the network until one arrives, for up to
+              the socket's timeout; raises socket.timeout after that
+        '''
+
+        if not self.inbox and not self.wait(self.timeout):
+            raise socket.timeout('timed out')
+
+        data, sender = self.inbox.popleft()
+        return (data[:bufsize], sender)
+
+
+    def recv(self, bufsize):
+        return self.recvfrom(bufsize)[0]
+
+
+    def wait(self, timeout):
+        ''' Run the network until a datagram is waiting, for up to timeout
+            seconds, or for as long as there are events if timeout is None
+
+            Return Values:
+            True if one is waiting
+        '''
+
+        until = None if timeout is None else self.network.now + timeout
+        self.network.run(until, lambda: bool(self.inbox))
+
+        return bool(self.inbox)
+
+
+    def getsockname(self):
+        return self.address
+
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+
+    def setsockopt(self, *args):
+        # buffers are unbounded
+        pass
+
+
+    def close(self):
+        self.closed = True
+        self.network.sockets.pop(self.address, None)
+
+
+    def dispatch(self):
+        ''' Hand waiting datagrams to the node serving this socket
+
+            - a node blocked in recvfrom or wait reads them itself
+        '''
+
+        if self.receive is None or self.busy or not self.inbox:
+            return
+
+        self.busy = True
+        try:
+            while self.inbox and not self.closed:
+                self.receive(*self.inbox.popleft())
+        finally:
+            self.busy = False
+        self.rearm()
+
+
+    def rearm(self, earliest=None):
+        ''' Schedule a check for when the node's next deadline is due
+
+            - a check already scheduled no later is kept; it schedules the
+              next one once it has run
+            - earliest keeps a check that just ran from being scheduled
+              for the same instant again, like a real clock that has
+              moved on: a deadline that rounds to now is then still due
+        '''
+
+        if self.deadline is None or self.closed:
+            return
+
+        due = self.deadline()
+        if due is None:
+            return
+        due = max(due, self.network.now if earliest is None else earliest)
+        if self.timer is not None and self.timer[0] <= due:
+            return
+
+        generation = self.timer[1] + 1 if self.timer else 0
+        self.timer = [due, generation]
+        self.network.schedule(due, self.tick, generation)
+
+
+    def tick(self, generation):
+        if self.timer is None or self.timer[1] != generation or self.closed:
+            return
+        self.timer = None
+        if self.busy:
+            # checked once the node is done with its current event
+            return
+
+        self.busy = True
+        try:
+            self.check()
+        finally:
+            self.busy = False
+        self.dispatch()
+        self.rearm(self.network.now + RESOLUTION)
+
+
+class VirtualNetwork:
+
+    def __init__(self, latency=.001, jitter=0.0, loss=0.0, bandwidth=None,
+            seed=0):
+        ''' Constructor for VirtualNetwork objects
+
+            - latency is the one way delay in seconds, plus up to jitter
+            - loss is the chance a datagram is dropped
+            - bandwidth is bytes per second each sender's link carries, or
+              None for no limit
+        '''
+
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+
+        self.now = 0.0
+        self.events = []            # heap of (time, sequence, action, args)
+        self.sequence = itertools.count()
+        self.sockets = {}           # (ip, port) -> VirtualSocket
+        self.hosts = 0
+        # where nodes log in; serve_login runs the LoginServer there
+        self.login_server = (LoginServer.HOST, LoginServer.PORT)
+
+        # statistics
+        self.sent = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.bytes = 0
+
+
+    # transport interface
+
+    def time(self):
+        '''Return the network's virtual time, in seconds'''
+
+        return self.now
+
+
+    def local_ip(self):
+        '''Return the address of a new host; every node gets its own'''
+
+        self.hosts += 1
+        return f'10.{self.hosts >> 16 & 255}.{self.hosts >> 8 & 255}.{self.hosts & 255}'
+
+
+    def bind(self, ip, port=None):
+        ''' Return a socket bound to (ip, port)
+
+            - without a port, the first free one of PORTS is taken
+            - raises OSError if it is taken
+        '''
+
+        ports = PORTS if port is None else [port]
+        for port_num in ports:
+            if (ip, port_num) not in self.sockets:
+                sock = VirtualSocket(self, (ip, port_num))
+                self.sockets[(ip, port_num)] = sock
+                return sock
+
+        raise OSError(f'Address in use: {ip}')
+
+
+    def wait(self, sock, timeout):
+        return sock.wait(timeout)
+
+
+    # simulation
+
+    def serve(self, sock, receive, check, deadline):
+        ''' Hand what arrives on a socket to a node, as Runtime.serve does
+
+            - receive(data, sender) is called with every datagram, check()
+              whenever deadline() has come
+        '''
+
+        sock.receive, sock.check, sock.deadline = receive, check, deadline
+        sock.dispatch()
+        sock.rearm()
+
+
+    def serve_node(self, node):
+        '''Run a User or SuperUser on the network'''
+
+        self.serve(node.sock, node.receive_datagram, node.check_timeouts,
+                node.next_deadline)
+
+
+    @contextlib.contextmanager
+    def serve_login(self, leaders):
+        ''' Run the LoginServer on the network, at the network's login_server,
+            for the length of a with block
+
+            - leaders maps each room name to the (ip, port) of its SuperUser
+            - rooms are not saved to snapshot files
+            - the LoginServer module's transport, rooms and deferred requests
+              are this network's inside the block, and put back after it
+
+            Return Values:
+            the LoginServer's socket
+        '''
+
+        saved = (LoginServer.transport, LoginServer.rooms, LoginServer.deferred)
+        LoginServer.transport = self
+        LoginServer.rooms = {}
+        LoginServer.deferred = collections.deque()
+        try:
+            for name, leader in leaders.items():
+                LoginServer.add_room(name, leader).snapshot = None
+
+            server = self.bind(*self.login_server)
+            def receive(data, sender):
+                LoginServer.serve_request(server, {'request': data,
+                        'ip': sender[0], 'port': int(sender[1])})
+                # requests held back by a checkup sweep
+                while LoginServer.deferred:
+                    LoginServer.serve_request(server, LoginServer.deferred.popleft())
+
+            # rooms are tended between requests, as in LoginServer.run_server
+            tend = lambda: LoginServer.tend_rooms(server)
+            self.serve(server, receive, tend, tend)
+
+            yield server
+        finally:
+            LoginServer.transport, LoginServer.rooms, LoginServer.deferred = saved
+
+
+    def join(self, users, timeout=60.0):
+        ''' Log users in and have them spliced into their rings
+
+            - users are served on the network once the LoginServer has
+              answered them
+
+            Return Values:
+            True if every user was spliced in within timeout seconds
+        '''
+
+        for usr in users:
+            leader = usr.connect_to_login()
+            self.serve_node(usr)
+            self.call(usr, usr.request_join, leader)
+
+        return self.run(self.now + timeout,
+                lambda: all(usr.neighbors for usr in users))
+
+
+    def call(self, node, method, *args):
+        '''Call a method of a served node from outside its events, as Runtime.call does'''
+
+        result = method(*args)
+        node.sock.dispatch()
+        node.sock.rearm()
+        return result
+
+
+    def schedule(self, when, action, *args):
+        '''Run action(*args) once the clock reaches when'''
+
+        heapq.heappush(self.events, (when, next(self.sequence), action, args))
+
+
+    def transmit(self, sock, data, address):
+        '''Send a datagram from a socket, unless it is lost'''
+
+        self.sent += 1
+        self.bytes += len(data)
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        # datagrams leave one after the other on the sender's link
+        departure = self.now
+        if self.bandwidth:
+            start = max(self.now, sock.link_free)
+            sock.link_free = departure = start + len(data) / self.bandwidth
+
+        arrival = departure + self.latency
+        if self.jitter:
+            arrival += self.random.random() * self.jitter
+        self.schedule(arrival, self.deliver, data, sock.address, address)
+
+
+    def deliver(self, data, sender, address):
+        sock = self.sockets.get(address)
+        if sock is None:
+            # nobody there, e.g. a crashed user
+            self.dropped += 1
+            return
+
+        self.delivered += 1
+        sock.inbox.append((data, sender))
+        sock.dispatch()
+
+
+    def run(self, until=None, condition=None):
+        ''' Process events in time order
+
+            - stops once the next event is after until, once condition()
+              holds, or once there are no events left; the clock is then
+              moved up to until
+
+            Return Values:
+            True if condition() holds
+        '''
+
+        while self.events:
+            if condition is not None and condition():
+                return True
+            when, _, action, args = self.events[0]
+            if until is not None and when > until:
+                break
+            heapq.heappop(self.events)
+            self.now = max(self.now, when)
+            action(*args)
+
+        if until is not None:
+            self.now = max(self.now, until)
+
+        return condition is not None and condition()
+
+
+    def stats(self):
+        '''Return datagram counts since the network was created'''
+
+        return {
+            "sent"     : self.sent,
+            "delivered": self.delivered,
+            "dropped"  : self.dropped,
+            "bytes"    : self.bytes
+        }